@@ -0,0 +1,41 @@
+import argparse
+import logging
+from pathlib import Path
+
+from simple_bookmark import LOGGING_NAME  # 导入时会完成日志配置
+from llm_bookmark.config import conf
+from llm_bookmark.pdf_tools import apply_bookmarks
+
+LOGGER = logging.getLogger(LOGGING_NAME)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("title_json_path", help="生成书签时得到的json文件(save_tmp_json为true时与pdf在同一个文件夹)")
+    parser.add_argument("pdf_paths", nargs="+", help="需要写入这份书签的pdf，可以有多个")
+    parser.add_argument("--output-dir", type=str, default=None, help="结果文件夹，不指定则与原pdf在同一个文件夹")
+    parser.add_argument("--max-workers", type=int, default=conf.get_conf()["pdf_2_pics"]["max_workers"],
+                        help="同时写几个pdf")
+    args = parser.parse_args()
+    return args
+
+
+def get_dest_pdf_paths(pdf_paths: list, output_dir=None):
+    """
+    结果文件名为原文件名加上batch.dest_suffix，output_dir为None则与原pdf在同一个文件夹
+    """
+    dest_suffix = conf.get_conf()["batch"]["dest_suffix"]
+    dest_pdf_paths = []
+    for pdf_path in pdf_paths:
+        pdf_path = Path(pdf_path)
+        dest_dir = Path(output_dir) if output_dir else pdf_path.parent
+        dest_pdf_paths.append(dest_dir / (pdf_path.stem + dest_suffix + pdf_path.suffix))
+    return dest_pdf_paths
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dest_pdf_paths = get_dest_pdf_paths(args.pdf_paths, output_dir=args.output_dir)
+    results = apply_bookmarks(args.pdf_paths, dest_pdf_paths, args.title_json_path, max_workers=args.max_workers)
+    for pdf_path, e in results:
+        print(f"{pdf_path}: {'ok' if e is None else e}")
@@ -0,0 +1,43 @@
+import argparse
+import json
+import logging
+
+from simple_bookmark import LOGGING_NAME  # 导入时会完成日志配置
+from llm_bookmark.bookmark import LLMBookmark
+from llm_bookmark.batch import BatchBookmark, load_jobs
+from llm_bookmark.config import conf
+
+LOGGER = logging.getLogger(LOGGING_NAME)
+
+
+def parse_args():
+    batch_conf = conf.get_conf()["batch"]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", help="pdf所在的文件夹，或者jsonl格式的任务清单，每行一个任务，例如："
+                                           "{\"pdf_path\": \"d:/a.pdf\", \"dest_pdf_path\": \"d:/a_带书签.pdf\", "
+                                           "\"skip_page_ranges\": [[0, 2]], \"extra_prompt_path\": \"d:/a.txt\"}，"
+                                           "只有pdf_path是必填的")
+    parser.add_argument("--output-dir", type=str, default=None, help="结果文件夹，不指定则与原pdf在同一个文件夹")
+    parser.add_argument("--report-path", type=str, default="batch_report.jsonl",
+                        help="报告文件路径，每处理完一个pdf追加一行。用同一个报告重新运行时，会跳过已经成功的pdf")
+    parser.add_argument("--max-concurrent-docs", type=int, default=batch_conf["max_concurrent_docs"],
+                        help="同时处理几个pdf")
+    parser.add_argument("--max-inflight-requests", type=int, default=batch_conf["max_inflight_requests"],
+                        help="所有pdf共用的模型请求并发上限")
+    parser.add_argument("--resume", action="store_true",
+                        help="上次没完成的pdf从中断的地方继续，而不是从第一页重新处理")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    batch_conf = conf.get_conf()["batch"]
+    jobs = load_jobs(args.input_path, output_dir=args.output_dir, dest_suffix=batch_conf["dest_suffix"])
+    batch_bookmarkor = BatchBookmark(LLMBookmark(), args.report_path,
+                                     max_concurrent_docs=args.max_concurrent_docs,
+                                     max_inflight_requests=args.max_inflight_requests,
+                                     render_workers=conf.get_conf()["pdf_2_pics"]["max_workers"],
+                                     resume=args.resume)
+    summary = batch_bookmarkor.run(jobs)
+    print(json.dumps({k: v for k, v in summary.items() if k != "records"}, ensure_ascii=False))
@@ -0,0 +1,335 @@
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from benchmarks.synthetic_book import decode_page_marker
+from llm_bookmark.llm_cache import iter_text_cache
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_replay_index(cache_path):
+    """
+    读取LLmCache的文本缓存，用于回放。content模式的key由图片内容hash和提示词hash组成，
+    服务端从请求中也能算出来，故按(图片hash，提示词hash)建索引，与模型名、resize参数无关；
+    其它key(比如llm_model的缓存，key就是提示词)按原文建索引。path模式的key里是图片路径，无法从请求中还原。
+    """
+    by_hash = {}
+    by_text = {}
+    for key, value in iter_text_cache(cache_path):
+        fields = dict(line.split("=", 1) for line in key.split("\n") if "=" in line)
+        if "images" in fields and "prompt" in fields:
+            by_hash[(fields["images"], fields["prompt"])] = value
+        else:
+            by_text[key] = value
+    LOGGER.info('load_replay_index return, cache_path: %s, by_hash: %d, by_text: %d',
+                cache_path, len(by_hash), len(by_text))
+    return by_hash, by_text
+
+
+def parse_model_values(items: list[str]):
+    """
+    :param items: ["模型名=数值"]
+    :return: {模型名: 数值}
+    """
+    values = {}
+    for item in items:
+        model, value = item.rsplit("=", 1)
+        values[model] = float(value)
+    return values
+
+
+def image_tokens(image_bytes):
+    gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return 0
+    height, width = gray.shape
+    return math.ceil(width / 28) * math.ceil(height / 28)
+
+
+class FakeChatServer:
+    """
+    本地的OpenAI兼容chat/completions服务，用于离线压测，不消耗API额度。
+    回答的来源依次为：回放缓存文件中的结果；根据图片中的页码标记查合成书的标准答案，生成合法的"最终答案"；都没有则返回空答案。
+    可以注入延迟、抖动、429和超时。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, truth_paths: list=None, replay_cache_paths: list=None,
+                 latency=0.2, jitter=0.1, error_429_rate=0.0, timeout_rate=0.0, timeout_seconds=5.0, blur_tokens=0,
+                 model_latencies: dict=None, model_error_rates: dict=None, seed=None):
+        """
+        :param port: 0则自动选一个空闲端口
+        :param truth_paths: synthetic_book生成的标准答案，多本书的页码标记会冲突，同时只用一本时才准
+        :param replay_cache_paths: LLmCache的文本缓存文件
+        :param latency: 每个请求的基础延迟，秒
+        :param jitter: 在基础延迟上随机增加0到jitter秒
+        :param error_429_rate: 返回429的概率
+        :param timeout_rate: 先等timeout_seconds秒再回答的概率，大于客户端的timeout即为超时
+        :param blur_tokens: 当前页图片的token数小于此值时模拟看不清：要求自评置信度的请求返回低置信度的空答案，
+                            否则返回格式不对的内容。用于测试分辨率分档
+        :param model_latencies: {模型名: 基础延迟}，用于模拟vl_cascade中较快的模型，没有的用latency
+        :param model_error_rates: {模型名: 概率}，按此概率把这个模型的回答弄错(格式不对、包在code wrapper中、级别跳级或者漏掉标题)，
+                                  用于模拟vl_cascade中较弱的模型
+        """
+        self.page_titles = {}
+        for truth_path in truth_paths or []:
+            self.load_truth(truth_path)
+        self.replay_by_hash = {}
+        self.replay_by_text = {}
+        for cache_path in replay_cache_paths or []:
+            by_hash, by_text = load_replay_index(cache_path)
+            self.replay_by_hash.update(by_hash)
+            self.replay_by_text.update(by_text)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429_rate = error_429_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.blur_tokens = blur_tokens
+        self.model_latencies = model_latencies or {}
+        self.model_error_rates = model_error_rates or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "replayed": 0, "synthesized": 0, "errors_429": 0, "timeouts": 0, "blurred": 0,
+                      "corrupted": 0, "gzipped": 0, "connections": 0}
+
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def load_truth(self, truth_path):
+        with open(truth_path, 'rt', encoding='utf-8') as f:
+            truth = json.load(f)
+        self.page_titles = {int(index): titles for index, titles in truth["page_titles"].items()}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        LOGGER.info('FakeChatServer started, base_url: %s', self.base_url)
+        return self
+
+    def stop(self):
+        # 没有start过时shutdown会一直等
+        if self.thread is not None:
+            self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # 支持keep-alive，connections统计客户端建立了多少个连接
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                server.count("connections")
+
+            def log_message(self, format, *args):
+                LOGGER.debug(format, *args)
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_json(404, {"error": {"message": f"unknown path: {self.path}"}})
+                    return
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    server.count("gzipped")
+                    data = gzip.decompress(data)
+                body = json.loads(data)
+                server.count("requests")
+                with server.lock:
+                    delay = server.model_latencies.get(body.get("model"), server.latency) + \
+                        server.random.uniform(0, server.jitter)
+                if server.roll(server.error_429_rate):
+                    server.count("errors_429")
+                    self.send_json(429, {"error": {"message": "rate limited by fake server", "type": "rate_limit",
+                                                   "code": "rate_limit_exceeded"}})
+                    return
+                if server.roll(server.timeout_rate):
+                    server.count("timeouts")
+                    delay = server.timeout_seconds
+                time.sleep(delay)
+                texts, image_datas = server.parse_messages(body.get("messages", []))
+                content = server.answer(texts, image_datas, body.get("model"))
+                # 图片按max_image_tokens的默认值1280估算
+                prompt_tokens = sum(len(text) for text in texts) + len(image_datas) * 1280
+                completion = server.completion(body.get("model", ""), content, prompt_tokens)
+                try:
+                    if body.get("stream"):
+                        self.send_stream(completion)
+                    else:
+                        self.send_json(200, completion)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端已超时断开
+                    pass
+
+            def send_json(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_stream(self, completion):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                # 没有Content-Length，写完即关闭连接
+                self.send_header("Connection", "close")
+                self.close_connection = True
+                self.end_headers()
+                chunk = dict(completion, object="chat.completion.chunk")
+                chunk["choices"] = [{"index": 0, "delta": dict(completion["choices"][0]["message"]),
+                                     "finish_reason": "stop"}]
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        return Handler
+
+    @staticmethod
+    def completion(model, content, prompt_tokens):
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                      "total_tokens": prompt_tokens + len(content)},
+        }
+
+    @staticmethod
+    def parse_messages(messages):
+        """
+        :return: 所有文本，所有图片的base64数据
+        """
+        texts = []
+        image_datas = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                texts.append(content)
+                continue
+            for part in content or []:
+                if part.get("type") == "text":
+                    texts.append(part["text"])
+                elif part.get("type") == "image_url":
+                    image_datas.append(part["image_url"]["url"].split("base64,", 1)[-1])
+        return texts, image_datas
+
+    def answer(self, texts, image_datas, model=None):
+        human_message_text = texts[-1] if texts else ""
+        if image_datas and self.roll(self.model_error_rates.get(model, 0.0)):
+            self.count("corrupted")
+            return self.corrupt(self.synthesize(human_message_text, image_datas))
+
+        replayed = self.replay(human_message_text, image_datas)
+        if replayed is not None:
+            self.count("replayed")
+            return replayed
+        self.count("synthesized")
+        return self.synthesize(human_message_text, image_datas)
+
+    def replay(self, human_message_text, image_datas):
+        if not image_datas:
+            return self.replay_by_text.get(human_message_text)
+        image_hashes = ",".join(hashlib.sha256(image_data.encode("utf-8")).hexdigest() for image_data in image_datas)
+        prompt_hash = hashlib.sha256(human_message_text.encode("utf-8")).hexdigest()
+        return self.replay_by_hash.get((image_hashes, prompt_hash))
+
+    def corrupt(self, content):
+        with self.lock:
+            mode = self.random.choice(("garbage", "fenced", "skip_grade", "drop"))
+        if mode == "fenced":
+            return f"```json\n{content}\n```\n以上是本页的标题。"
+        response = json.loads(content) if content.startswith("{") else None
+        if mode == "garbage" or not response or not response.get("最终答案"):
+            return "我看到这一页的标题是：" + content[:20]
+        if mode == "skip_grade":
+            for answer in response["最终答案"]:
+                answer[-3] += 2
+        else:
+            response["最终答案"] = []
+        return json.dumps(response, ensure_ascii=False)
+
+    def synthesize(self, human_message_text, image_datas):
+        if not image_datas:
+            # llm_model判断是否目录页
+            return "不是"
+        if "是不是目录页" in human_message_text:
+            return json.dumps({"关键思考": "", "是目录页": False, "最终答案": []}, ensure_ascii=False)
+
+        match = re.search(r"最后(\d+)页", human_message_text)
+        page_count = int(match.group(1)) if match else 1
+        if self.blur_tokens and any(image_tokens(base64.b64decode(image_data)) < self.blur_tokens
+                                    for image_data in image_datas[-page_count:]):
+            self.count("blurred")
+            if "置信度" in human_message_text:
+                return json.dumps({"关键思考": "图片太模糊", "置信度": 0.2, "最终答案": []}, ensure_ascii=False)
+            return "图片太模糊，看不清标题"
+
+        answers = []
+        for pos, image_data in enumerate(image_datas[-page_count:]):
+            index = decode_page_marker(base64.b64decode(image_data))
+            for grade, title_name, abstract in self.page_titles.get(index, []):
+                answers.append([pos + 1, grade, title_name, abstract] if match else [grade, title_name, abstract])
+        return json.dumps({"关键思考": "", "最终答案": answers}, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地的OpenAI兼容chat/completions服务，用于离线压测")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--truth-path", action="append", default=[], help="synthetic_book生成的标准答案")
+    parser.add_argument("--replay-cache-path", action="append", default=[],
+                        help="LLmCache的文本缓存文件(cache_key_mode为content时生成的)，命中则直接回放")
+    parser.add_argument("--latency", type=float, default=0.2, help="每个请求的基础延迟，秒")
+    parser.add_argument("--jitter", type=float, default=0.1, help="随机增加的延迟上限，秒")
+    parser.add_argument("--error-429-rate", type=float, default=0.0, help="返回429的概率")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="超时的概率")
+    parser.add_argument("--timeout-seconds", type=float, default=5.0, help="超时的请求等多少秒再回答")
+    parser.add_argument("--blur-tokens", type=int, default=0, help="当前页图片的token数小于此值时模拟看不清")
+    parser.add_argument("--model-latency", action="append", default=[], help="模型名=基础延迟，可以指定多个")
+    parser.add_argument("--model-error-rate", action="append", default=[], help="模型名=答错的概率，可以指定多个")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fake_server = FakeChatServer(args.host, args.port, truth_paths=args.truth_path,
+                                 replay_cache_paths=args.replay_cache_path, latency=args.latency, jitter=args.jitter,
+                                 error_429_rate=args.error_429_rate, timeout_rate=args.timeout_rate,
+                                 timeout_seconds=args.timeout_seconds, blur_tokens=args.blur_tokens,
+                                 model_latencies=parse_model_values(args.model_latency),
+                                 model_error_rates=parse_model_values(args.model_error_rate))
+    print(f"openai_api_base: {fake_server.base_url}")
+    try:
+        fake_server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        fake_server.stop()
@@ -0,0 +1,93 @@
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).parent.parent
+
+# 各条命令执行时导入的模块，以及不允许被导入的较重的依赖(为空则只统计耗时)
+HEAVY_MODULES = ("langchain_core", "langchain_openai", "openai", "cv2", "numpy", "pydantic")
+TARGETS = {
+    "cli": (["bookmark_cli"], HEAVY_MODULES),
+    "render": (["bookmark_cli", "llm_bookmark.pdf_tools"], HEAVY_MODULES),
+    "apply": (["bookmark_cli", "apply_bookmarks"], HEAVY_MODULES),
+    "cache": (["bookmark_cli", "llm_bookmark.llm_cache"], HEAVY_MODULES),
+    # 标题结构Title用pydantic，只导入bookmark模块时允许导入pydantic
+    "bookmark": (["llm_bookmark.bookmark"], HEAVY_MODULES[:-1] + ("httpx",)),
+}
+
+
+def measure_import(modules: list[str]):
+    """
+    在新的解释器中用python -X importtime导入modules，解释器启动时本来就会导入的模块(site等)不计入
+    :return: {顶层模块名: 累计耗时(秒)}，导入的所有模块名
+    """
+    code = "; ".join(f"import {module}" for module in modules) or "pass"
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=PROJECT_DIR,
+                               capture_output=True, text=True, encoding="utf-8")
+    if completed.returncode != 0:
+        raise RuntimeError(f"import failed, modules: {modules}\n{completed.stderr}")
+
+    top_level = {}
+    imported = set()
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package，被嵌套导入的模块名前有缩进
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative_us, name = line.split("|")
+        if not cumulative_us.strip().isdigit():
+            continue
+        imported.add(name.strip())
+        if not name[1:].startswith(" "):
+            top_level[name.strip()] = int(cumulative_us) / 1e6
+    return top_level, imported
+
+
+def startup_modules():
+    top_level, _ = measure_import([])
+    return set(top_level)
+
+
+def check_target(name, repeat=3, baseline=None):
+    """
+    :param baseline: startup_modules的结果
+    :return: 这条命令的导入耗时(取repeat次中最快的一次)，以及被导入的较重的依赖
+    """
+    modules, forbidden = TARGETS[name]
+    best_seconds = None
+    imported = set()
+    for _ in range(repeat):
+        top_level, target_imported = measure_import(modules)
+        seconds = sum(seconds for module, seconds in top_level.items() if module not in (baseline or ()))
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+        imported.update(target_imported)
+    heavy = sorted(module for module in forbidden if module in imported)
+    return {"target": name, "modules": modules, "import_seconds": round(best_seconds, 3), "heavy_modules": heavy}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导入耗时的回归检查：不调模型的命令不能导入langchain、cv2等较重的依赖")
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--repeat", type=int, default=3, help="每条命令测几次，取最快的一次")
+    parser.add_argument("--max-seconds", type=float, default=0,
+                        help="不允许导入较重依赖的命令，导入耗时的上限，0为不检查耗时")
+    args = parser.parse_args()
+
+    baseline = startup_modules()
+    results = [check_target(name, repeat=args.repeat, baseline=baseline) for name in args.targets]
+    failed = []
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+        forbidden = TARGETS[result["target"]][1]
+        if result["heavy_modules"]:
+            failed.append(f'{result["target"]} imports {result["heavy_modules"]}')
+        elif forbidden and args.max_seconds and result["import_seconds"] > args.max_seconds:
+            failed.append(f'{result["target"]} takes {result["import_seconds"]}s > {args.max_seconds}s')
+    if failed:
+        print("import time regression: " + "; ".join(failed), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
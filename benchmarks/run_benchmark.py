@@ -0,0 +1,256 @@
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import yaml
+
+LOGGER = logging.getLogger(__name__)
+
+PROJECT_DIR = Path(__file__).parent.parent
+
+# 预设的流水线配置，结构与conf.yaml一致，只写需要覆盖的项
+PRESETS = {
+    "baseline": {},
+    "concurrent": {"bookmark": {"vl_concurrency": 4, "vl_prefetch_pages": 16}},
+    "batch4": {"bookmark": {"vl_batch_pages": 4}},
+    "memory_jpeg": {"pdf_2_pics": {"render_mode": "memory"},
+                    "bookmark": {"image_format": "jpeg", "color_mode": "gray"}},
+    "text_layer": {"bookmark": {"text_layer": True}},
+    "streaming": {"pdf_2_pics": {"streaming": True}, "bookmark": {"vl_concurrency": 4}},
+    "context_auto": {"bookmark": {"context_tiers": ["text", "crop", "thumbnail", "full"], "context_token_budget": 1024}},
+    "context_crop": {"bookmark": {"context_tiers": ["crop", "thumbnail"], "context_token_budget": 1024}},
+    "resolution": {"bookmark": {"resolution_tiers": [320, 640], "resolution_min_confidence": 0.6}},
+    "cascade": {"vl_cascade": {"models": [{"name": "fast", "model_name": "fake-fast"}], "sample_rate": 0.05}},
+    "tolerant": {"bookmark": {"tolerant": True}},
+    "http": {"vl_model": {"transport": "http"}, "llm_model": {"transport": "http"}},
+    "http_gzip": {"vl_model": {"transport": "http", "http_gzip": True}, "llm_model": {"transport": "http"}},
+}
+
+
+def percentile(values, ratio):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(ratio * (len(values) - 1)))]
+
+
+def peak_rss_mb():
+    """
+    :return: 本进程和已结束的子进程(pdf转图片的进程池)的峰值内存，单位MB，取不到则为None
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 1024 / 1024, 1), None
+        except (ImportError, AttributeError):
+            return None, None
+    # linux上ru_maxrss的单位是KB，mac上是字节
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit, 1))
+
+
+def score_outline(titles: list[dict], truth_titles: list[dict]):
+    """
+    按(规范化后的标题，页码)匹配，计算准确率、召回率、F1，以及匹配上的标题中级别正确的比例
+    """
+    from llm_bookmark.contents import normalize_title_name
+
+    truth = {(normalize_title_name(title["title_name"]), title["page_number"]): title["grade"]
+             for title in truth_titles}
+    matched = 0
+    grade_matched = 0
+    for title in titles:
+        key = (normalize_title_name(title["title_name"]), title["page_number"])
+        if key in truth:
+            matched += 1
+            grade_matched += truth.pop(key) == title["grade"]
+    precision = matched / len(titles) if titles else 0.0
+    recall = matched / (matched + len(truth)) if matched + len(truth) else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": round(precision, 4), "recall": round(recall, 4), "f1": round(f1, 4),
+            "grade_accuracy": round(grade_matched / matched, 4) if matched else 0.0}
+
+
+def run_one(job):
+    """
+    在子进程中跑一次，这样峰值内存互不影响。缓存用一个新的文件名，即每次都是冷缓存，跑完删除。
+    :param job: pdf_path，truth_path，base_url，name，overrides，use_async，work_dir
+    :return: 这次的结果
+    """
+    from llm_bookmark.bookmark import LLMBookmark
+    from llm_bookmark.config import merge_conf
+
+    pdf_path = Path(job["pdf_path"])
+    metrics_dir = Path(job["work_dir"]) / "metrics" / job["name"]
+    cache_name = f"benchmark_{uuid.uuid4().hex}"
+    model_overrides = {"openai_api_base": job["base_url"], "openai_api_key": "sk-benchmark",
+                       "cache_file_name": cache_name}
+    forced = {
+        "bookmark": {"journal": False, "save_tmp_json": False, "cache_key_mode": "content"},
+        "pdf_2_pics": {"override": True},
+        "metrics": {"enabled": True, "output_dir": str(metrics_dir)},
+        "vl_model": model_overrides,
+        "llm_model": dict(model_overrides, cache_file_name=cache_name + "_llm"),
+    }
+    llm_bookmarkor = LLMBookmark(conf_overrides=merge_conf(job["overrides"], forced))
+    dest_pdf_path = Path(job["work_dir"]) / f"{pdf_path.stem}_{job['name']}.pdf"
+
+    start = time.perf_counter()
+    try:
+        if job["use_async"]:
+            import asyncio
+            titles = asyncio.run(llm_bookmarkor.ado_bookmark(str(pdf_path), str(dest_pdf_path)))
+        else:
+            titles = llm_bookmarkor.do_bookmark(str(pdf_path), str(dest_pdf_path))
+    finally:
+        for cache_path in (PROJECT_DIR / "cache").glob(cache_name + "*"):
+            cache_path.unlink()
+    seconds = time.perf_counter() - start
+
+    with open(job["truth_path"], 'rt', encoding='utf-8') as f:
+        truth = json.load(f)
+    with open(metrics_dir / f"{pdf_path.stem}.metrics.json", 'rt', encoding='utf-8') as f:
+        run_metrics = json.load(f)
+    # 每页的延迟：计入这一页的各阶段耗时之和，多页合并的请求计入最后一页；文字层等没调模型的页不算
+    page_latencies = [sum(value for key, value in page.items() if key.endswith("_seconds"))
+                      for page in run_metrics["pages"].values()]
+    rss_mb, children_rss_mb = peak_rss_mb()
+    counters = run_metrics["counters"]
+    result = {
+        "name": job["name"],
+        "pdf": pdf_path.name,
+        "pages": truth["page_count"],
+        "seconds": round(seconds, 3),
+        "pages_per_second": round(truth["page_count"] / seconds, 3),
+        "p50_page_latency": percentile(page_latencies, 0.5),
+        "p99_page_latency": percentile(page_latencies, 0.99),
+        "mean_page_latency": round(statistics.mean(page_latencies), 4) if page_latencies else None,
+        "peak_rss_mb": rss_mb,
+        "children_peak_rss_mb": children_rss_mb,
+        "vl_model_calls": counters.get("vl_model_calls", 0),
+        "vl_model_retries": counters.get("vl_model_retries", 0),
+        "vl_model_prompt_tokens": counters.get("vl_model_prompt_tokens", 0),
+        "vl_model_image_tokens": counters.get("vl_model_image_tokens", 0),
+    }
+    result.update({name: value for name, value in counters.items()
+                   if name.startswith(("context_tier_", "resolution_", "cascade_"))
+                   or name in ("page_retries", "quarantined_pages", "grade_clamped")})
+    result.update(score_outline([title.model_dump() for title in titles], truth["titles"]))
+    return result
+
+
+def run_child(job):
+    completed = subprocess.run([sys.executable, "-m", "benchmarks.run_benchmark", "--child", json.dumps(job)],
+                               cwd=PROJECT_DIR, capture_output=True, text=True, encoding="utf-8")
+    if completed.returncode != 0:
+        LOGGER.error('benchmark failed, name: %s, pdf: %s\n%s', job["name"], job["pdf_path"], completed.stderr[-4000:])
+        return {"name": job["name"], "pdf": Path(job["pdf_path"]).name, "error": completed.stderr.strip()[-300:]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def load_configs(names, config_path=None):
+    configs = dict(PRESETS)
+    if config_path:
+        with open(config_path, 'rt', encoding='utf-8') as f:
+            configs.update(yaml.safe_load(f) or {})
+    names = names or list(configs)
+    unknown = [name for name in names if name not in configs]
+    if unknown:
+        raise ValueError(f'unknown configs: {unknown}, available: {list(configs)}')
+    return {name: configs[name] or {} for name in names}
+
+
+def print_table(results):
+    columns = ["name", "pdf", "pages", "seconds", "pages_per_second", "p50_page_latency", "p99_page_latency",
+               "peak_rss_mb", "vl_model_calls", "vl_model_retries", "vl_model_image_tokens", "f1", "grade_accuracy"]
+    rows = [[("%.4g" % result[column]) if isinstance(result.get(column), float) else str(result.get(column, ""))
+             for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[pos]) for row in rows)) for pos, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def parse_args():
+    from benchmarks.synthetic_book import BOOK_SIZES
+
+    parser = argparse.ArgumentParser(description="离线压测：本地模拟服务 + 合成pdf，对比不同配置的吞吐、延迟、内存和准确率")
+    parser.add_argument("--work-dir", default=str(PROJECT_DIR / "benchmarks" / "work"),
+                        help="合成pdf、结果和统计文件的目录")
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=list(BOOK_SIZES))
+    parser.add_argument("--configs", nargs="+", default=None, help=f"要跑的配置，默认全部，预设：{list(PRESETS)}")
+    parser.add_argument("--config-path", default=None,
+                        help="自定义配置的yaml文件，{配置名: 要覆盖的conf}，与预设合并")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="用ado_bookmark跑")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟服务每个请求的基础延迟，秒")
+    parser.add_argument("--jitter", type=float, default=0.1, help="随机增加的延迟上限，秒")
+    parser.add_argument("--error-429-rate", type=float, default=0.0, help="返回429的概率")
+    parser.add_argument("--timeout-rate", type=float, default=0.0,
+                        help="超时的概率，超时的请求等timeout-seconds秒再回答，配置中的vl_model.timeout要比它小")
+    parser.add_argument("--timeout-seconds", type=float, default=5.0)
+    parser.add_argument("--blur-tokens", type=int, default=0,
+                        help="当前页图片的token数小于此值时模拟服务返回看不清，用于测试分辨率分档")
+    parser.add_argument("--model-latency", action="append", default=[],
+                        help="模型名=基础延迟，比如fake-fast=0.05，用于模拟vl_cascade中较快的模型")
+    parser.add_argument("--model-error-rate", action="append", default=[],
+                        help="模型名=答错的概率，比如fake-fast=0.1，用于模拟vl_cascade中较弱的模型")
+    parser.add_argument("--replay-cache-path", action="append", default=[],
+                        help="LLmCache的文本缓存文件(cache_key_mode为content时生成的)，命中则直接回放")
+    parser.add_argument("--report-path", default=None, help="结果追加写入的jsonl文件，默认为work-dir下的report.jsonl")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    from benchmarks.fake_server import FakeChatServer, parse_model_values
+    from benchmarks.synthetic_book import make_books
+
+    args = parse_args()
+    if args.child:
+        print(json.dumps(run_one(json.loads(args.child)), ensure_ascii=False))
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    configs = load_configs(args.configs, args.config_path)
+    work_dir = Path(args.work_dir).resolve()
+    books = make_books(work_dir, args.sizes)
+    report_path = Path(args.report_path or work_dir / "report.jsonl")
+
+    results = []
+    for size, pdf_path in books.items():
+        truth_path = pdf_path.with_suffix(".truth.json")
+        # 页码标记只有页索引，不同的书会冲突，故每本书单独起一个模拟服务
+        fake_server = FakeChatServer(truth_paths=[truth_path], replay_cache_paths=args.replay_cache_path,
+                                     latency=args.latency, jitter=args.jitter, error_429_rate=args.error_429_rate,
+                                     timeout_rate=args.timeout_rate, timeout_seconds=args.timeout_seconds,
+                                     blur_tokens=args.blur_tokens,
+                                     model_latencies=parse_model_values(args.model_latency),
+                                     model_error_rates=parse_model_values(args.model_error_rate), seed=0).start()
+        try:
+            for name, overrides in configs.items():
+                LOGGER.info('benchmark enter, size: %s, config: %s', size, name)
+                result = run_child({"pdf_path": str(pdf_path), "truth_path": str(truth_path),
+                                    "base_url": fake_server.base_url, "name": name, "overrides": overrides,
+                                    "use_async": args.use_async, "work_dir": str(work_dir)})
+                result["size"] = size
+                results.append(result)
+                with open(report_path, 'at', encoding='utf-8', newline='') as f:
+                    f.write(json.dumps(result, ensure_ascii=False) + '\n')
+        finally:
+            fake_server.stop()
+        LOGGER.info('fake server stats, size: %s, stats: %s', size, fake_server.stats)
+
+    print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import json
+import logging
+import random
+from pathlib import Path
+
+import cv2
+import fitz
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# 页码标记：页面底部一排方块，第一个恒为黑，之后MARKER_BITS位是页索引，最后一位是奇偶校验。
+# 模拟服务端从收到的图片中解码出页索引，再查标准答案，这样不管怎么渲染、缩放、压缩都能给出正确的回答
+MARKER_BITS = 14
+MARKER_Y = 0.965
+MARKER_X = 0.08
+MARKER_STEP = 0.05
+MARKER_SIZE = 0.03
+
+# 预设的书本规模：章数，每章节数，每节正文行数
+BOOK_SIZES = {
+    "small": (3, 3, 40),
+    "medium": (10, 5, 60),
+    "large": (30, 6, 80),
+}
+
+WORDS = ("pdf bookmark model page title chapter section layout scan image token cache outline render "
+         "batch stream async request latency memory level heading content abstract").split()
+
+
+def draw_page_marker(page, index):
+    bits = [1] + [(index >> bit) & 1 for bit in range(MARKER_BITS)]
+    bits.append(sum(bits[1:]) % 2)
+    width, height = page.rect.width, page.rect.height
+    size = MARKER_SIZE * width
+    for pos, bit in enumerate(bits):
+        if bit:
+            x0 = (MARKER_X + pos * MARKER_STEP) * width
+            y0 = MARKER_Y * height - size / 2
+            page.draw_rect(fitz.Rect(x0, y0, x0 + size, y0 + size), color=(0, 0, 0), fill=(0, 0, 0))
+
+
+def decode_page_marker(image_bytes):
+    """
+    :param image_bytes: png/jpeg/webp图片
+    :return: 页索引，不是合成的页或者解码失败返回None
+    """
+    gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    height, width = gray.shape
+    half = max(1, round(MARKER_SIZE * width / 4))
+    y = round(MARKER_Y * height)
+    bits = []
+    for pos in range(MARKER_BITS + 2):
+        x = round((MARKER_X + pos * MARKER_STEP + MARKER_SIZE / 2) * width)
+        bits.append(1 if gray[y - half: y + half, x - half: x + half].mean() < 128 else 0)
+    if bits[0] != 1 or sum(bits[1:-1]) % 2 != bits[-1]:
+        return None
+    return sum(bit << pos for pos, bit in enumerate(bits[1:-1]))
+
+
+def random_sentence(rng, word_count):
+    return " ".join(rng.choice(WORDS) for _ in range(word_count))
+
+
+def make_book(pdf_path, chapters=3, sections=3, section_lines=40, seed=0):
+    """
+    生成一本有已知标题树的书：章(1级)另起一页，节(2级)接着正文排，每页底部有页码标记。
+    同时写出{pdf文件名}.truth.json：标准答案，格式与生成的json一致，另有每页的标题(模拟服务端用)。
+    :return: truth_path
+    """
+    rng = random.Random(seed)
+    doc = fitz.open()
+    page_width, page_height = fitz.paper_size("a4")
+    top, bottom, left = 72, page_height - 90, 72
+    line_height = 14
+
+    titles = []
+    page_titles = {}
+    page = None
+    y = bottom
+
+    def new_page():
+        nonlocal page, y
+        page = doc.new_page(width=page_width, height=page_height)
+        draw_page_marker(page, doc.page_count - 1)
+        page.insert_text((page_width / 2 - 40, 40), "Synthetic Book", fontsize=8)
+        y = top
+
+    def add_title(grade, title_name, fontsize):
+        nonlocal y
+        if y + fontsize * 3 > bottom:
+            new_page()
+        y += fontsize * 1.5
+        page.insert_text((left, y), title_name, fontsize=fontsize, fontname="hebo")
+        y += fontsize
+        abstract = random_sentence(rng, 8)
+        index = doc.page_count - 1
+        titles.append({"grade": grade, "title_name": title_name, "page_number": index + 1, "abstract": abstract})
+        page_titles.setdefault(index, []).append([grade, title_name, abstract])
+
+    for chapter in range(1, chapters + 1):
+        new_page()
+        add_title(1, f"Chapter {chapter} {random_sentence(rng, 3).title()}", 22)
+        for section in range(1, sections + 1):
+            add_title(2, f"{chapter}.{section} {random_sentence(rng, 3).title()}", 15)
+            for _ in range(section_lines):
+                if y + line_height > bottom:
+                    new_page()
+                y += line_height
+                page.insert_text((left, y), random_sentence(rng, 12), fontsize=10)
+
+    pdf_path = Path(pdf_path)
+    pdf_path.parent.mkdir(parents=True, exist_ok=True)
+    doc.save(pdf_path)
+    page_count = doc.page_count
+    doc.close()
+
+    truth_path = pdf_path.with_suffix(".truth.json")
+    with open(truth_path, 'wt', encoding='utf-8', newline='') as f:
+        json.dump({"page_count": page_count, "titles": titles,
+                   "page_titles": {str(index): value for index, value in page_titles.items()}}, f,
+                  ensure_ascii=False)
+    LOGGER.info('make_book return, pdf_path: %s, pages: %d, titles: %d', pdf_path, page_count, len(titles))
+    return truth_path
+
+
+def make_books(output_dir, sizes=("small", "medium"), seed=0):
+    """
+    :return: {规模: pdf路径}
+    """
+    books = {}
+    for size in sizes:
+        chapters, sections, section_lines = BOOK_SIZES[size]
+        pdf_path = Path(output_dir) / f"synthetic_{size}.pdf"
+        make_book(pdf_path, chapters, sections, section_lines, seed=seed)
+        books[size] = pdf_path
+    return books
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="生成有已知标题树的合成pdf，以及标准答案{pdf文件名}.truth.json")
+    parser.add_argument("output_dir")
+    parser.add_argument("--sizes", nargs="+", default=list(BOOK_SIZES), choices=list(BOOK_SIZES))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for size, pdf_path in make_books(args.output_dir, args.sizes, args.seed).items():
+        print(size, pdf_path)
@@ -0,0 +1,82 @@
+import argparse
+import json
+import logging
+
+from simple_bookmark import LOGGING_NAME, parse_skip_page_ranges  # 导入时会完成日志配置
+from llm_bookmark.config import conf
+
+LOGGER = logging.getLogger(LOGGING_NAME)
+
+# 这些子命令不调模型，各自只在执行时导入用到的模块，不会加载langchain、cv2等，启动耗时见benchmarks/import_time.py
+
+
+def render(args):
+    from llm_bookmark.pdf_tools import pdf_2_pics
+
+    pdf_2_pics_conf = conf.get_conf()["pdf_2_pics"]
+    pics_dir = pdf_2_pics(args.pdf_path, dpi=args.dpi, max_workers=args.max_workers, override=args.override,
+                          exist_ok=pdf_2_pics_conf["exist_ok"], skip_page_ranges=parse_skip_page_ranges(args),
+                          chunk_size=pdf_2_pics_conf.get("chunk_size", 8))
+    print(pics_dir)
+
+
+def apply(args):
+    from apply_bookmarks import get_dest_pdf_paths
+    from llm_bookmark.pdf_tools import save_bookmarks, apply_bookmarks
+
+    dest_pdf_paths = get_dest_pdf_paths(args.pdf_paths, output_dir=args.output_dir)
+    if len(args.pdf_paths) == 1:
+        # 只有一个pdf时不用起进程池
+        save_bookmarks(args.pdf_paths[0], dest_pdf_paths[0], title_json_path=args.title_json_path, fast=True)
+        results = [(args.pdf_paths[0], None)]
+    else:
+        results = apply_bookmarks(args.pdf_paths, dest_pdf_paths, args.title_json_path, max_workers=args.max_workers)
+    for pdf_path, e in results:
+        print(f"{pdf_path}: {'ok' if e is None else e}")
+
+
+def cache(args):
+    from llm_bookmark.llm_cache import inspect_cache
+
+    info = inspect_cache(args.cache_name, backend=args.backend, contains=args.contains, limit=args.limit)
+    info["matched_keys"] = [k if len(k) <= args.key_chars else k[:args.key_chars] + '...'
+                            for k in info["matched_keys"]]
+    print(json.dumps(info, ensure_ascii=False, indent=2))
+
+
+def parse_args():
+    pdf_2_pics_conf = conf.get_conf()["pdf_2_pics"]
+    parser = argparse.ArgumentParser(description="不调模型的常用操作，启动比simple_bookmark.py快得多")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render_parser = subparsers.add_parser("render", help="只把pdf转成图片，存到pdf所在目录下的{pdf文件名}文件夹")
+    render_parser.add_argument("pdf_path", help="pdf路径")
+    render_parser.add_argument("--dpi", type=int, default=200)
+    render_parser.add_argument("--max-workers", type=int, default=pdf_2_pics_conf["max_workers"], help="进程数")
+    render_parser.add_argument("--override", action="store_true", default=pdf_2_pics_conf["override"],
+                               help="已经存在的图片也重新生成")
+    render_parser.add_argument("--skip-page-ranges", action="extend", nargs="+", type=int,
+                               help="不需要渲染的页号范围，从0开始算，写法与simple_bookmark.py的一样")
+    render_parser.set_defaults(func=render)
+
+    apply_parser = subparsers.add_parser("apply", help="把已生成的标题json写入pdf，与apply_bookmarks.py相同")
+    apply_parser.add_argument("title_json_path", help="标题json路径，即save_tmp_json生成的{pdf文件名}.json")
+    apply_parser.add_argument("pdf_paths", nargs="+", help="需要写入这份书签的pdf，可以有多个")
+    apply_parser.add_argument("--output-dir", type=str, default=None, help="结果文件夹，不指定则与原pdf在同一个文件夹")
+    apply_parser.add_argument("--max-workers", type=int, default=pdf_2_pics_conf["max_workers"], help="同时写几个pdf")
+    apply_parser.set_defaults(func=apply)
+
+    cache_parser = subparsers.add_parser("cache", help="查看缓存的大小、条数，以及包含某个字符串的key")
+    cache_parser.add_argument("cache_name", help="缓存文件名，即conf.yaml中的cache_file_name")
+    cache_parser.add_argument("--backend", choices=["text", "sqlite"],
+                              default=conf.get_conf()["vl_model"].get("cache_backend", "text"))
+    cache_parser.add_argument("--contains", type=str, default=None, help="只列出包含此字符串的key")
+    cache_parser.add_argument("--limit", type=int, default=20, help="最多列出几个key")
+    cache_parser.add_argument("--key-chars", type=int, default=200, help="每个key最多显示几个字符")
+    cache_parser.set_defaults(func=cache)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.func(args)
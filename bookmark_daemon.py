@@ -0,0 +1,38 @@
+import argparse
+import logging
+
+from simple_bookmark import LOGGING_NAME  # 导入时会完成日志配置
+from llm_bookmark.daemon import BookmarkDaemon, JobStore, serve
+from llm_bookmark.config import conf
+
+LOGGER = logging.getLogger(LOGGING_NAME)
+
+
+def parse_args():
+    daemon_conf = conf.get_conf()["daemon"]
+    parser = argparse.ArgumentParser(description="常驻服务，通过本机的http接口提交任务、查询状态")
+    parser.add_argument("--host", type=str, default=daemon_conf["host"], help="监听地址")
+    parser.add_argument("--port", type=int, default=daemon_conf["port"], help="监听端口")
+    parser.add_argument("--db-path", type=str, default=daemon_conf["db_path"],
+                        help="sqlite任务库路径，重启后继续处理上次没完成的任务")
+    parser.add_argument("--max-concurrent-docs", type=int, default=daemon_conf["max_concurrent_docs"],
+                        help="同时处理几个pdf")
+    parser.add_argument("--max-inflight-requests", type=int, default=daemon_conf["max_inflight_requests"],
+                        help="所有任务共用的模型请求并发上限")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    daemon_conf = conf.get_conf()["daemon"]
+    store = JobStore(args.db_path)
+    bookmark_daemon = BookmarkDaemon(store, max_concurrent_docs=args.max_concurrent_docs,
+                                     max_inflight_requests=args.max_inflight_requests,
+                                     render_workers=conf.get_conf()["pdf_2_pics"]["max_workers"],
+                                     max_warm_instances=daemon_conf["max_warm_instances"],
+                                     dest_suffix=conf.get_conf()["batch"]["dest_suffix"])
+    try:
+        serve(bookmark_daemon, host=args.host, port=args.port)
+    finally:
+        store.close()
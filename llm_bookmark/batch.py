@@ -0,0 +1,141 @@
+import json
+import logging
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from threading import BoundedSemaphore, Lock
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_jobs(input_path, output_dir=None, dest_suffix="_带书签"):
+    """
+    :param input_path: pdf所在的文件夹，或者jsonl格式的任务清单，每行一个任务，例如：
+        {"pdf_path": "d:/a.pdf", "dest_pdf_path": "d:/a_带书签.pdf", "skip_page_ranges": [[0, 2], [7, 8]],
+         "extra_prompt_path": "d:/a_prompt.txt"}
+        其中只有pdf_path是必填的
+    :param output_dir: 结果文件夹，为None则与原pdf在同一个文件夹
+    :param dest_suffix: 未指定dest_pdf_path时，结果文件名为原文件名加上此后缀
+    :return: 任务列表
+    """
+    input_path = Path(input_path)
+    if input_path.is_dir():
+        # 跳过之前生成的结果文件，否则结果文件和原文件在同一个文件夹时，会被当成新任务
+        raw_jobs = [{"pdf_path": str(pdf_path)} for pdf_path in sorted(input_path.glob("*.pdf"))
+                    if not pdf_path.stem.endswith(dest_suffix)]
+    else:
+        with open(input_path, 'rt', encoding='utf-8') as f:
+            raw_jobs = [json.loads(line) for line in f if line.strip()]
+
+    return [normalize_job(raw_job, output_dir=output_dir, dest_suffix=dest_suffix) for raw_job in raw_jobs]
+
+
+def normalize_job(raw_job: dict, output_dir=None, dest_suffix="_带书签"):
+    """
+    补全任务清单中的一行，参数见load_jobs
+    """
+    pdf_path = Path(raw_job["pdf_path"])
+    dest_pdf_path = raw_job.get("dest_pdf_path")
+    if not dest_pdf_path:
+        dest_dir = Path(output_dir) if output_dir else pdf_path.parent
+        dest_pdf_path = str(dest_dir / (pdf_path.stem + dest_suffix + pdf_path.suffix))
+
+    skip_page_ranges = raw_job.get("skip_page_ranges")
+    return {
+        "pdf_path": str(pdf_path),
+        "dest_pdf_path": dest_pdf_path,
+        "skip_page_ranges": [tuple(page_range) for page_range in skip_page_ranges] if skip_page_ranges else None,
+        "extra_prompt_path": raw_job.get("extra_prompt_path"),
+    }
+
+
+def load_finished(report_path):
+    """
+    读取之前的报告，返回已成功完成的pdf_path集合，用于断点续跑。
+    """
+    finished = set()
+    report_path = Path(report_path)
+    if not report_path.exists():
+        return finished
+
+    with open(report_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["status"] == "done" and Path(record["dest_pdf_path"]).exists():
+                finished.add(record["pdf_path"])
+            else:
+                finished.discard(record["pdf_path"])
+    return finished
+
+
+class BatchBookmark:
+    """
+    批量生成书签。所有pdf共用一个LLMBookmark（即共用缓存和模型客户端）、一个pdf转图片的进程池，以及一个全局的模型请求并发上限。
+    每处理完一个pdf就往报告里追加一行，中途中断后用同一个报告重新运行，会跳过已经成功的pdf。
+    """
+
+    def __init__(self, llm_bookmarkor, report_path, max_concurrent_docs=2, max_inflight_requests=8,
+                 render_workers=8, resume=False):
+        self.llm_bookmarkor = llm_bookmarkor
+        self.resume = resume
+        self.report_path = Path(report_path)
+        self.max_concurrent_docs = max_concurrent_docs
+        self.render_workers = render_workers
+        self.llm_bookmarkor.request_semaphore = BoundedSemaphore(max_inflight_requests)
+        self.report_lock = Lock()
+
+    def write_report(self, record):
+        with self.report_lock:
+            with open(self.report_path, 'at', encoding='utf-8', newline='') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def run_one(self, job, render_executor):
+        LOGGER.info('run_one enter, job: %s', job)
+        start_time = time.time()
+        record = {"pdf_path": job["pdf_path"], "dest_pdf_path": job["dest_pdf_path"]}
+        try:
+            extra_prompt = self.llm_bookmarkor.load_prompt_from_path(job["extra_prompt_path"]) \
+                if job["extra_prompt_path"] else None
+            bookmarks = self.llm_bookmarkor.do_bookmark(job["pdf_path"], job["dest_pdf_path"],
+                                                        skip_page_ranges=job["skip_page_ranges"],
+                                                        extra_prompt=extra_prompt, executor=render_executor,
+                                                        resume=self.resume)
+            record.update(status="done", title_count=len(bookmarks))
+        except Exception as e:
+            LOGGER.error('run_one failed, job: %s\n%s', job, traceback.format_exc())
+            record.update(status="failed", error=f"{type(e).__name__}: {e}")
+
+        record["seconds"] = round(time.time() - start_time, 2)
+        self.write_report(record)
+        LOGGER.info('run_one return, record: %s', record)
+        return record
+
+    def run(self, jobs):
+        """
+        :return: 汇总信息，包括成功、失败、跳过的数量，以及本次每个pdf的结果
+        """
+        finished = load_finished(self.report_path)
+        todo_jobs = [job for job in jobs if job["pdf_path"] not in finished]
+        LOGGER.info('run enter, total: %d, finished before: %d, todo: %d',
+                    len(jobs), len(jobs) - len(todo_jobs), len(todo_jobs))
+
+        records = []
+        with ProcessPoolExecutor(max_workers=self.render_workers) as render_executor, \
+                ThreadPoolExecutor(max_workers=self.max_concurrent_docs) as doc_executor:
+            futures = [doc_executor.submit(self.run_one, job, render_executor) for job in todo_jobs]
+            for future in as_completed(futures):
+                records.append(future.result())
+
+        summary = {
+            "total": len(jobs),
+            "skipped": len(jobs) - len(todo_jobs),
+            "done": sum(1 for record in records if record["status"] == "done"),
+            "failed": sum(1 for record in records if record["status"] == "failed"),
+            "records": records,
+        }
+        LOGGER.info('run return, total: %d, skipped: %d, done: %d, failed: %d',
+                    summary["total"], summary["skipped"], summary["done"], summary["failed"])
+        return summary
@@ -1,20 +1,63 @@
-from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-
 import json
+import hashlib
+import os
 from pathlib import Path
 import logging
+import asyncio
+import bisect
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
-from llm_bookmark.title_info import Title, titles_str, title_name_equal, TitleEncoder
-from llm_bookmark.llm_cache import LLmCache
-from llm_bookmark.vl_tools import encode_image
-from llm_bookmark.config import conf
+from llm_bookmark.title_info import Title, titles_str, title_name_equal
+from llm_bookmark.llm_cache import create_llm_cache
+from llm_bookmark.config import conf, merge_conf
 from llm_bookmark.pdf_tools import pdf_2_pics, save_bookmarks
+from llm_bookmark.journal import PageJournal, get_journal_path, load_journal, fingerprint
+from llm_bookmark.cascade import VlModelTier, CASCADE_RULES, cascade_model_confs, is_sampled, response_titles_key
+from llm_bookmark.tolerance import FaultLog, repair_json, parse_judge_answer, get_review_path
+from llm_bookmark.outline import Outline
+from llm_bookmark.rate_limiter import get_rate_limiter, call_with_retry, acall_with_retry
+from llm_bookmark import metrics
+
+# langchain、cv2、numpy、httpx等较重的依赖，以及用到它们的功能模块，都在用到时才导入，
+# 只导入本模块时不会加载它们，导入耗时见benchmarks/import_time.py
+if TYPE_CHECKING:
+    from llm_bookmark.text_layer import TextLayerHeadingDetector
+    from llm_bookmark.context_images import ContextSelector
 
 
 LOGGER = logging.getLogger(__name__)
 
+def is_skip_page(index, skip_page_ranges: list[tuple[int, int]]=None):
+    if skip_page_ranges:
+        for page_start, page_end in skip_page_ranges:
+            if page_start <= index <= page_end:
+                return True
+    return False
+
+
+class VlRequest:
+    """
+    bookmark_steps中yield出来的vl_model请求
+    """
+    def __init__(self, pages, page_indexs: list[int], human_message_text: str, pre_titles="", model_tier=None):
+        self.pages = pages
+        self.page_indexs = page_indexs
+        self.human_message_text = human_message_text
+        self.pre_titles = pre_titles
+        # VlModelTier，为空则用vl_model
+        self.model_tier = model_tier
+
+
+class JudgeRequest:
+    """
+    bookmark_steps中yield出来的判断是否目录页的请求
+    """
+    def __init__(self, res_content: str):
+        self.res_content = res_content
+
+
 def remove_think_from_message(message):
     content = message.content
     think_end_tag = '</think>'
@@ -27,52 +70,290 @@ def remove_think_from_message(message):
     return message
 
 
+def split_batch_response(res_content: str, page_count: int, repair=None):
+    """
+    把多页请求的返回结果按页序号拆成每页的返回结果，格式与单页请求的返回结果一样，供deal_title_steps使用。
+    :param repair: 不为空则用它代替json.loads，比如tolerance.repair_json
+    :return: 每页的返回结果
+    """
+    res = (repair or json.loads)(res_content)
+    if not isinstance(res["最终答案"], list):
+        raise SyntaxError(f'batch answer is not a list: {res["最终答案"]}')
+    page_titles = [[] for _ in range(page_count)]
+    for res_title in res["最终答案"]:
+        match res_title:
+            case [int(page_no), int(grade), str(title_name), str(abstract)] if 1 <= page_no <= page_count:
+                page_titles[page_no - 1].append([grade, title_name, abstract])
+            case _:
+                raise SyntaxError(f'match batch title failed: {res_title}')
+    key_thoughts = res.get("关键思考", "")
+    return [json.dumps({"关键思考": key_thoughts, "最终答案": response_titles}, ensure_ascii=False)
+            for response_titles in page_titles]
+
+
 class LLMBookmark:
-    def __init__(self, extra_prompt_path=None):
-        self.conf = conf.get_conf()
+    def __init__(self, extra_prompt_path=None, conf_overrides: dict=None, cache_pool: dict=None):
+        """
+        :param extra_prompt_path: 额外提示词文本路径
+        :param conf_overrides: 覆盖conf.yaml中的部分配置，比如{"bookmark": {"vl_batch_pages": 4}}，用于对比不同配置
+        :param cache_pool: (缓存文件名，backend) -> 缓存，多个LLMBookmark传入同一个dict时，同名的缓存只读取一次并且共用，
+            常驻服务中按任务配置创建的LLMBookmark就是这样共用缓存的
+        """
+        self.cache_pool = cache_pool
+        self.conf = merge_conf(conf.get_conf(), conf_overrides) if conf_overrides else conf.get_conf()
 
         bookmark_conf = self.conf["bookmark"]
         self.contents_page_thresh = bookmark_conf["contents_page_thresh"]
         self.contents_judge_by_llm = bookmark_conf["contents_judge_by_llm"]
         self.save_tmp_json = bookmark_conf["save_tmp_json"]
+        self.journal = bookmark_conf.get("journal", True)
+        self.journal_fsync_every = bookmark_conf.get("journal_fsync_every", 16)
+        self.journal_fsync_seconds = bookmark_conf.get("journal_fsync_seconds", 2)
+        self.incremental = bookmark_conf.get("incremental", False)
+        self.fast_save = bookmark_conf.get("fast_save", False)
+        metrics_conf = self.conf.get("metrics") or {}
+        self.metrics_enabled = metrics_conf.get("enabled", False)
+        self.metrics_dir = metrics_conf.get("output_dir")
+        self.profile_stages = metrics_conf.get("profile_stages") or []
         self.max_title_grade = bookmark_conf["max_title_grade"]
         self.need_resize = bookmark_conf["need_resize"]
         self.max_image_tokens = bookmark_conf["max_image_tokens"]
+        from llm_bookmark.page_images import PageEncoder
+        self.page_encoder = PageEncoder(image_format=bookmark_conf.get("image_format", "png"),
+                                        quality=bookmark_conf.get("image_quality", 85),
+                                        color_mode=bookmark_conf.get("color_mode", "color"),
+                                        cache_size=bookmark_conf.get("payload_cache_size", 256))
+        self.cache_key_mode = bookmark_conf.get("cache_key_mode", "path")
+        if self.cache_key_mode not in ("path", "content"):
+            raise ValueError(f"cache_key_mode must be path or content, cache_key_mode: {self.cache_key_mode}")
+        self.vl_concurrency = bookmark_conf.get("vl_concurrency", 1)
+        self.vl_prefetch_pages = bookmark_conf.get("vl_prefetch_pages", self.vl_concurrency * 2)
+        self.vl_batch_pages = bookmark_conf.get("vl_batch_pages", 1)
+        self.vl_batch_max_image_tokens = bookmark_conf.get("vl_batch_max_image_tokens", 0)
+        self.text_layer = bookmark_conf.get("text_layer", False)
+        self.text_layer_min_confidence = bookmark_conf.get("text_layer_min_confidence", 0.8)
+        self.context_tiers = bookmark_conf.get("context_tiers") or ["full"]
+        self.context_token_budget = bookmark_conf.get("context_token_budget", 0)
+        self.context_thumbnail_tokens = bookmark_conf.get("context_thumbnail_tokens", 256)
+        self.context_crop_tokens = bookmark_conf.get("context_crop_tokens", 256)
+        # 比max_image_tokens小的档位从低到高依次尝试，最后一档即max_image_tokens，None表示不缩小
+        self.resolution_tiers = sorted(set(tier for tier in bookmark_conf.get("resolution_tiers") or []
+                                           if tier < self.max_image_tokens)) + [None]
+        self.resolution_min_confidence = bookmark_conf.get("resolution_min_confidence", 0)
+        self.tolerant = bookmark_conf.get("tolerant", False)
+        self.tolerant_page_retries = bookmark_conf.get("tolerant_page_retries", 1)
+        self.tolerant_retry_budget = bookmark_conf.get("tolerant_retry_budget", 20)
+        # yaml会把off解析成false
+        self.toc_mode = bookmark_conf.get("toc_mode") or "off"
+        if self.toc_mode not in ("off", "auto"):
+            raise ValueError(f"toc_mode must be off or auto, toc_mode: {self.toc_mode}")
+        self.toc_scan_pages = bookmark_conf.get("toc_scan_pages", 20)
+        self.toc_offset_samples = bookmark_conf.get("toc_offset_samples", 3)
+        if self.toc_offset_samples < 1:
+            raise ValueError(f"toc_offset_samples must be >= 1, toc_offset_samples: {self.toc_offset_samples}")
+        self.toc_offset_search = bookmark_conf.get("toc_offset_search", 30)
+        self.toc_min_verified_ratio = bookmark_conf.get("toc_min_verified_ratio", 0.7)
+
+        page_filter_conf = dict(self.conf.get("page_filter") or {})
+        self.page_filter = None
+        if page_filter_conf.pop("enabled", False):
+            from llm_bookmark.page_filter import PageFilter
+            self.page_filter = PageFilter(**page_filter_conf)
 
         vl_model_conf = self.conf["vl_model"]
-        self.vl_model = ChatOpenAI(
-            model=vl_model_conf["model_name"], openai_api_key=vl_model_conf["openai_api_key"],
-            openai_api_base=vl_model_conf["openai_api_base"], temperature=vl_model_conf["temperature"],
-            streaming=vl_model_conf["streaming"], timeout=vl_model_conf["timeout"]
-        )
+        self.vl_model_conf = vl_model_conf
+        self.vl_model_name = vl_model_conf["model_name"]
+        self.vl_rate_limiter = get_rate_limiter(vl_model_conf)
+        self.vl_model = self.create_vl_model(vl_model_conf)
 
-        self.vl_model_cache = LLmCache(vl_model_conf["cache_file_name"])
+        self.vl_model_cache = self.create_cache(vl_model_conf, vl_model_conf["cache_file_name"])
+        self.vl_tier = VlModelTier("vl_model", vl_model_conf, self.vl_model, self.vl_rate_limiter, self.vl_model_cache)
+        cascade_conf = self.conf.get("vl_cascade") or {}
+        self.vl_cascade = [VlModelTier(f"vl_{name}", model_conf, self.create_vl_model(model_conf),
+                                       get_rate_limiter(model_conf),
+                                       self.create_cache(model_conf, model_conf["cache_file_name"]))
+                           for name, model_conf in cascade_model_confs(cascade_conf, vl_model_conf)]
+        self.cascade_escalate_on = cascade_conf.get("escalate_on") or list(CASCADE_RULES)
+        unknown_rules = [rule for rule in self.cascade_escalate_on if rule not in CASCADE_RULES]
+        if unknown_rules:
+            raise ValueError(f"vl_cascade.escalate_on must be in {CASCADE_RULES}, unknown: {unknown_rules}")
+        self.cascade_sample_rate = cascade_conf.get("sample_rate", 0)
+        # 每页依次尝试的(模型，分辨率档位)：先是vl_cascade中的模型(原分辨率)，再是vl_model的各个分辨率档位
+        self.escalation_steps = [(model_tier, None) for model_tier in self.vl_cascade] + \
+                                [(self.vl_tier, tier) for tier in self.resolution_tiers]
+        # content模式下，缓存key是hash，不方便查看，故另存一份"图片路径 -> 图片hash"的索引
+        self.vl_image_index = self.create_cache(vl_model_conf, vl_model_conf["cache_file_name"] + "_image_index") \
+            if self.cache_key_mode == "content" else None
 
         llm_model_conf = self.conf["llm_model"]
-        self.llm_model = ChatOpenAI(
-            model=llm_model_conf["model_name"], openai_api_key=llm_model_conf["openai_api_key"],
-            openai_api_base=llm_model_conf["openai_api_base"], temperature=llm_model_conf["temperature"],
-            streaming=llm_model_conf["streaming"], timeout=llm_model_conf["timeout"]
-        ) | remove_think_from_message
+        self.llm_model_conf = llm_model_conf
+        self.llm_rate_limiter = get_rate_limiter(llm_model_conf)
+        self.llm_model = self.create_llm_model(llm_model_conf)
 
-        self.llm_model_cache = LLmCache(llm_model_conf["cache_file_name"])
+        self.llm_model_cache = self.create_cache(llm_model_conf, llm_model_conf["cache_file_name"])
         self.extra_prompt = self.load_prompt_from_path(extra_prompt_path) if extra_prompt_path else "无"
         LOGGER.info("extra_prompt: %s", self.extra_prompt)
 
         self.prompt_cache = {}
+        self.request_semaphore = None
 
-    def do_bookmark(self, pdf_path, dest_pdf_path, skip_page_ranges: list[tuple[int, int]]=None):
+    @staticmethod
+    def get_transport(model_conf):
+        """
+        :return: langchain：ChatOpenAI；http：HttpChatModel，直接调/chat/completions
+        """
+        from llm_bookmark.http_transport import TRANSPORTS
+
+        transport = model_conf.get("transport", "langchain")
+        if transport not in TRANSPORTS:
+            raise ValueError(f"transport must be in {TRANSPORTS}, transport: {transport}")
+        return transport
+
+    @staticmethod
+    def create_vl_model(model_conf):
+        if LLMBookmark.get_transport(model_conf) == "http":
+            from llm_bookmark.http_transport import HttpChatModel
+            return HttpChatModel(model_conf)
+
+        from langchain_openai import ChatOpenAI
+        # 关掉openai客户端自带的重试，重试统一由call_with_retry做，每次重试前都要经过限流器
+        return ChatOpenAI(
+            model=model_conf["model_name"], openai_api_key=model_conf["openai_api_key"],
+            openai_api_base=model_conf["openai_api_base"], temperature=model_conf["temperature"],
+            streaming=model_conf["streaming"], timeout=model_conf["timeout"], max_retries=0
+        )
+
+    @staticmethod
+    def create_llm_model(model_conf):
+        if LLMBookmark.get_transport(model_conf) == "http":
+            from llm_bookmark.http_transport import HttpChatModel
+            return HttpChatModel(model_conf, post_process=remove_think_from_message)
+        return LLMBookmark.create_vl_model(model_conf) | remove_think_from_message
+
+    def create_cache(self, model_conf, cache_name):
+        backend = model_conf.get("cache_backend", "text")
+        if self.cache_pool is None:
+            return create_llm_cache(cache_name, backend=backend, lru_size=model_conf.get("cache_lru_size", 1024))
+        key = (cache_name, backend)
+        if key not in self.cache_pool:
+            self.cache_pool[key] = create_llm_cache(cache_name, backend=backend,
+                                                    lru_size=model_conf.get("cache_lru_size", 1024))
+        return self.cache_pool[key]
+
+    def do_bookmark(self, pdf_path, dest_pdf_path, skip_page_ranges: list[tuple[int, int]]=None,
+                    extra_prompt=None, executor=None, resume=False, base_pdf_path=None):
         """
         :param pdf_path:
         :param dest_pdf_path:
         :param skip_page_ranges: 需要跳过的页索引范围，从0开始算，前闭后闭，比如0,1,2,3,4,5页，则[(0, 2), (4, 5)]会跳过0,1,2,4,5
-        :return:
+        :param extra_prompt: 额外提示词，为None则用构造时extra_prompt_path中的
+        :param executor: pdf转图片用的进程池，为None则临时创建一个，批量处理时可以传入共用的进程池
+        :param resume: 为true则从上次中断的地方继续，见get_bookmark_by_pages
+        :param base_pdf_path: 上一版pdf的路径，incremental为true时沿用上一版中没变的页的结果，见get_bookmark_by_pages
+        :return: 书签列表
+        """
+        run_metrics = self.create_run_metrics(pdf_path)
+        pages = None
+        try:
+            with metrics.track_run(run_metrics):
+                with metrics.stage("render"):
+                    incremental_result = self.get_render_incremental(pdf_path, base_pdf_path, resume)
+                    pages = self.get_pages(pdf_path, executor=executor, skip_page_ranges=skip_page_ranges,
+                                           lazy_indexs=incremental_result and incremental_result[1])
+                bookmarks = self.get_bookmark_by_pages(pages, skip_page_ranges=skip_page_ranges,
+                                                       extra_prompt=extra_prompt, pdf_path=pdf_path, resume=resume,
+                                                       base_pdf_path=base_pdf_path,
+                                                       incremental_result=incremental_result)
+                with metrics.stage("save"):
+                    save_bookmarks(pdf_path, dest_pdf_path, bookmarks=bookmarks, fast=self.fast_save)
+        finally:
+            # memory模式下关掉打开的pdf，批量处理和常驻服务中不用等到垃圾回收
+            if pages is not None:
+                pages.close()
+            self.dump_run_metrics(run_metrics, pdf_path)
+        return bookmarks
+
+    async def ado_bookmark(self, pdf_path, dest_pdf_path, skip_page_ranges: list[tuple[int, int]]=None,
+                           extra_prompt=None, resume=False, base_pdf_path=None):
+        """
+        do_bookmark的异步版本，pdf转图片、保存书签等同步操作都放到线程里执行，不会阻塞事件循环。
+        """
+        run_metrics = self.create_run_metrics(pdf_path)
+        pages = None
+        try:
+            with metrics.track_run(run_metrics):
+                with metrics.stage("render"):
+                    incremental_result = await asyncio.to_thread(self.get_render_incremental, pdf_path,
+                                                                 base_pdf_path, resume)
+                    pages = await asyncio.to_thread(self.get_pages, pdf_path, skip_page_ranges=skip_page_ranges,
+                                                    lazy_indexs=incremental_result and incremental_result[1])
+                bookmarks = await self.aget_bookmark_by_pages(pages, skip_page_ranges=skip_page_ranges,
+                                                              extra_prompt=extra_prompt, pdf_path=pdf_path,
+                                                              resume=resume, base_pdf_path=base_pdf_path,
+                                                              incremental_result=incremental_result)
+                with metrics.stage("save"):
+                    await asyncio.to_thread(save_bookmarks, pdf_path, dest_pdf_path, bookmarks=bookmarks,
+                                            fast=self.fast_save)
+        finally:
+            if pages is not None:
+                pages.close()
+            await asyncio.to_thread(self.dump_run_metrics, run_metrics, pdf_path)
+        return bookmarks
+
+    def create_run_metrics(self, pdf_path):
+        """
+        metrics.enabled为true时，创建这次运行的统计，否则返回None，什么都不记
+        """
+        return metrics.RunMetrics(pdf_path, profile_stages=self.profile_stages) if self.metrics_enabled else None
+
+    def dump_run_metrics(self, run_metrics, pdf_path):
+        if run_metrics is None:
+            return
+        pdf_path = Path(pdf_path)
+        run_metrics.dump(self.metrics_dir or pdf_path.parent, pdf_path.stem)
+
+    def get_pages(self, pdf_path, executor=None, skip_page_ranges: list[tuple[int, int]]=None, lazy_indexs=None):
+        """
+        render_mode为file时，先用pdf_2_pics把每页存成png，再按需resize，streaming为true时边渲染边处理；
+        render_mode为memory时，直接按max_image_tokens渲染成目标尺寸，在内存中编码，不写磁盘。
+        跳过的页不会渲染。
+        :param lazy_indexs: 增量处理时沿用上一版标题的页，render_mode为file时先不渲染，用到时才渲染，见LazyImageDirPages
         """
+        from llm_bookmark.page_images import ImageDirPages, StreamingImageDirPages, LazyImageDirPages, PdfPages
+
         pdf_2_pics_conf = self.conf["pdf_2_pics"]
-        image_dir = pdf_2_pics(pdf_path, max_workers=pdf_2_pics_conf["max_workers"],
-                               exist_ok=pdf_2_pics_conf["exist_ok"], override=pdf_2_pics_conf["override"])
-        bookmarks = self.get_bookmark_by_images(image_dir, skip_page_ranges=skip_page_ranges)
-        save_bookmarks(pdf_path, dest_pdf_path, bookmarks=bookmarks)
+        if pdf_2_pics_conf.get("render_mode", "file") == "memory":
+            pdf_path = Path(pdf_path)
+            debug_dir = pdf_path.parent / (pdf_path.stem + "_vl") if pdf_2_pics_conf.get("save_rendered") else None
+            return PdfPages(pdf_path, need_resize=self.need_resize, max_image_tokens=self.max_image_tokens,
+                            debug_dir=debug_dir, encoder=self.page_encoder)
+
+        if lazy_indexs:
+            return LazyImageDirPages(pdf_path, need_resize=self.need_resize, max_image_tokens=self.max_image_tokens,
+                                     skip_page_ranges=skip_page_ranges, lazy_indexs=lazy_indexs,
+                                     encoder=self.page_encoder, max_workers=pdf_2_pics_conf["max_workers"],
+                                     exist_ok=pdf_2_pics_conf["exist_ok"], executor=executor,
+                                     chunk_size=pdf_2_pics_conf.get("chunk_size", 8))
+
+        pdf_2_pics_kwargs = dict(max_workers=pdf_2_pics_conf["max_workers"], exist_ok=pdf_2_pics_conf["exist_ok"],
+                                 override=pdf_2_pics_conf["override"], executor=executor,
+                                 chunk_size=pdf_2_pics_conf.get("chunk_size", 8))
+        if pdf_2_pics_conf.get("streaming"):
+            return StreamingImageDirPages(pdf_path, need_resize=self.need_resize,
+                                          max_image_tokens=self.max_image_tokens, skip_page_ranges=skip_page_ranges,
+                                          encoder=self.page_encoder, **pdf_2_pics_kwargs)
+
+        image_dir = pdf_2_pics(pdf_path, skip_page_ranges=skip_page_ranges, **pdf_2_pics_kwargs)
+        return ImageDirPages(image_dir, need_resize=self.need_resize, max_image_tokens=self.max_image_tokens,
+                             encoder=self.page_encoder)
+
+    def format_prompt(self, prompt_file_name, **variables):
+        """
+        用prompts下的提示词模板生成提示词，langchain_core在这里才导入
+        """
+        from langchain_core.prompts import PromptTemplate
+
+        return PromptTemplate.from_template(self.load_prompt(prompt_file_name)).invoke(variables).text
 
     def load_prompt(self, prompt_file_name):
         if prompt_file_name in self.prompt_cache:
@@ -86,92 +367,1067 @@ class LLMBookmark:
         with open(prompt_path, 'rt', encoding='utf-8', newline='') as f:
             return f.read()
 
-    def get_bookmark_by_images(self, image_dir, skip_page_ranges: list[tuple[int, int]]=None):
+    def get_bookmark_by_images(self, image_dir, skip_page_ranges: list[tuple[int, int]]=None, extra_prompt=None,
+                               resume=False):
         """
         :param image_dir:
         :param skip_page_ranges: 需要跳过的页索引范围，从0开始算，前闭后闭，比如0,1,2,3,4,5页，则[(0, 2), (4, 5)]会跳过0,1,2,4,5
+        :param extra_prompt: 额外提示词，为None则用构造时extra_prompt_path中的
+        :param resume: 为true则从上次中断的地方继续
         :return:
         """
-        LOGGER.info('get_bookmark_by_images enter, image_dir: %s', image_dir)
-        image_dir = Path(image_dir)
-        json_path = image_dir.parent / (image_dir.stem + ".json")
+        from llm_bookmark.page_images import ImageDirPages
+
+        pages = ImageDirPages(image_dir, need_resize=self.need_resize, max_image_tokens=self.max_image_tokens,
+                              encoder=self.page_encoder)
+        return self.get_bookmark_by_pages(pages, skip_page_ranges=skip_page_ranges, extra_prompt=extra_prompt,
+                                          resume=resume)
+
+    async def aget_bookmark_by_images(self, image_dir, skip_page_ranges: list[tuple[int, int]]=None,
+                                      extra_prompt=None, resume=False):
+        """
+        get_bookmark_by_images的异步版本。
+        """
+        from llm_bookmark.page_images import ImageDirPages
 
-        images = [image_path.name for image_path in image_dir.glob('*.png')]
-        images.sort()
+        pages = await asyncio.to_thread(ImageDirPages, image_dir, need_resize=self.need_resize,
+                                        max_image_tokens=self.max_image_tokens, encoder=self.page_encoder)
+        return await self.aget_bookmark_by_pages(pages, skip_page_ranges=skip_page_ranges, extra_prompt=extra_prompt,
+                                                 resume=resume)
+
+    def get_bookmark_by_pages(self, pages, skip_page_ranges: list[tuple[int, int]]=None, extra_prompt=None,
+                              pdf_path=None, resume=False, base_pdf_path=None, incremental_result=None):
+        """
+        :param pages: ImageDirPages或PdfPages
+        :param skip_page_ranges: 同get_bookmark_by_images
+        :param extra_prompt: 同get_bookmark_by_images
+        :param pdf_path: 原pdf路径，text_layer为true时用于读取文字层，为None时取pages.pdf_path（如果有）
+        :param resume: 为true则回放上次中断时留下的日志，从第一个没处理的页继续
+        :param base_pdf_path: incremental为true时，上一版pdf的路径，为None则认为新版覆盖了旧版，用本pdf已有的日志
+        :param incremental_result: 渲染前已经算好的get_incremental的结果，为None则在这里算
+        :return:
+        """
+        LOGGER.info('get_bookmark_by_pages enter, pages: %s', pages.json_path)
+        pdf_path = pdf_path or getattr(pages, "pdf_path", None)
+        titles = self.get_embedded_toc_titles(pdf_path)
+        if titles:
+            LOGGER.info('get_bookmark_by_pages return embedded toc, titles:\n%s', titles_str(titles))
+            return titles
+
+        with metrics.stage("filter"):
+            skip_page_ranges = self.filter_pages(pages, pdf_path, skip_page_ranges)
+        text_layer = self.get_text_layer(pdf_path)
+        page_hashes, carried_titles = incremental_result or self.get_incremental(pages.json_path, pdf_path,
+                                                                                   base_pdf_path, resume)
+        journal = self.open_journal(pages, resume, page_hashes, pdf_path=pdf_path,
+                                    skip_page_ranges=skip_page_ranges, extra_prompt=extra_prompt)
+        context_selector = self.get_context_selector(pdf_path)
+        try:
+            titles = self.run_steps(self.bookmark_steps(pages, skip_page_ranges, extra_prompt, text_layer=text_layer,
+                                                        journal=journal, carried_titles=carried_titles,
+                                                        context_selector=context_selector))
+        finally:
+            if journal:
+                journal.close()
+            if context_selector:
+                context_selector.close()
+        LOGGER.info('get_bookmark_by_pages return, titles:\n%s', titles_str(titles))
+        return titles
+
+    async def aget_bookmark_by_pages(self, pages, skip_page_ranges: list[tuple[int, int]]=None, extra_prompt=None,
+                                     pdf_path=None, resume=False, base_pdf_path=None, incremental_result=None):
+        """
+        get_bookmark_by_pages的异步版本，处理逻辑完全一样，只是调模型用的是ainvoke。
+        """
+        LOGGER.info('aget_bookmark_by_pages enter, pages: %s', pages.json_path)
+        pdf_path = pdf_path or getattr(pages, "pdf_path", None)
+        titles = await asyncio.to_thread(self.get_embedded_toc_titles, pdf_path)
+        if titles:
+            LOGGER.info('aget_bookmark_by_pages return embedded toc, titles:\n%s', titles_str(titles))
+            return titles
+
+        with metrics.stage("filter"):
+            skip_page_ranges = await asyncio.to_thread(self.filter_pages, pages, pdf_path, skip_page_ranges)
+        text_layer = await asyncio.to_thread(self.get_text_layer, pdf_path)
+        page_hashes, carried_titles = incremental_result or await asyncio.to_thread(
+            self.get_incremental, pages.json_path, pdf_path, base_pdf_path, resume)
+        journal = await asyncio.to_thread(self.open_journal, pages, resume, page_hashes, pdf_path=pdf_path,
+                                          skip_page_ranges=skip_page_ranges, extra_prompt=extra_prompt)
+        context_selector = await asyncio.to_thread(self.get_context_selector, pdf_path)
+        try:
+            titles = await self.arun_steps(self.bookmark_steps(pages, skip_page_ranges, extra_prompt,
+                                                               text_layer=text_layer, journal=journal,
+                                                               carried_titles=carried_titles,
+                                                               context_selector=context_selector))
+        finally:
+            if journal:
+                journal.close()
+            if context_selector:
+                context_selector.close()
+        LOGGER.info('aget_bookmark_by_pages return, titles:\n%s', titles_str(titles))
+        return titles
+
+    def open_journal(self, pages, resume=False, page_hashes=None, pdf_path=None,
+                     skip_page_ranges: list[tuple[int, int]]=None, extra_prompt=None):
+        if not self.journal:
+            return None
+        return PageJournal(get_journal_path(pages.json_path), len(pages), resume=resume,
+                           fsync_every=self.journal_fsync_every, fsync_seconds=self.journal_fsync_seconds,
+                           page_hashes=page_hashes,
+                           fingerprints=self.get_journal_fingerprints(pages, pdf_path, skip_page_ranges, extra_prompt))
+
+    def get_journal_fingerprints(self, pages, pdf_path=None, skip_page_ranges: list[tuple[int, int]]=None,
+                                 extra_prompt=None):
+        """
+        写在日志头部的指纹，续跑时与本次的不一致就不回放，免得把另一本书(页数碰巧相同)或另一套配置下的标题接进来。
+        source：pdf的大小和首尾两页的内容hash，没有pdf时为图片文件夹中各图片的名字和大小，都不用读整本书；
+        config：跳过的页(含page_filter过滤掉的)和单页提示词(含额外提示词)。
+        """
+        from llm_bookmark.incremental import page_content_hashes
 
-        titles: list[Title] = []
+        if pdf_path:
+            source = [os.path.getsize(pdf_path)] + page_content_hashes(pdf_path, indexs=[0, -1])
+        else:
+            source = [(image, os.path.getsize(pages.image_dir / image)) for image in pages.images if image]
+        config = {"skip_page_ranges": sorted([start, end] for start, end in skip_page_ranges or []),
+                  "prompt": self.get_human_message_text("", extra_prompt)}
+        return {"source": fingerprint(source), "config": fingerprint(config)}
+
+    def get_render_incremental(self, pdf_path, base_pdf_path=None, resume=False):
+        """
+        render_mode为file时，渲染前先比对上一版，沿用标题的页就不用先渲染了。
+        :return: get_incremental的结果，不是file模式或没开incremental时为None，由get_bookmark_by_pages自己算
+        """
+        if not self.incremental or self.conf["pdf_2_pics"].get("render_mode", "file") == "memory":
+            return None
+        pdf_path = Path(pdf_path)
+        return self.get_incremental(pdf_path.parent / (pdf_path.stem + ".json"), pdf_path, base_pdf_path, resume)
+
+    def get_incremental(self, json_path, pdf_path, base_pdf_path=None, resume=False):
+        """
+        incremental为true时，计算各页内容的hash(写入日志头部，供下一版比对)，并与上一版的日志比对，
+        内容没变的页沿用上一版的标题。上一版的日志：指定了base_pdf_path则用它的日志，否则用本pdf已有的日志。
+        续跑时日志是本次的，不再比对。
+        :param json_path: 本pdf生成的json路径，日志在它旁边
+        :return: 各页的hash，{页索引: 沿用的标题}
+        """
+        if not self.incremental or not pdf_path:
+            return None, None
+        from llm_bookmark.incremental import page_content_hashes, carry_over_titles
+
+        page_hashes = page_content_hashes(pdf_path)
+        if resume:
+            return page_hashes, None
+
+        base_json_path = Path(base_pdf_path).parent / (Path(base_pdf_path).stem + ".json") if base_pdf_path \
+            else json_path
+        header, records = load_journal(get_journal_path(base_json_path))
+        if not records:
+            LOGGER.info('no previous journal records, process all pages, base_json_path: %s', base_json_path)
+            return page_hashes, None
+        old_hashes = header.get("page_hashes")
+        if not old_hashes and base_pdf_path and Path(base_pdf_path).exists():
+            old_hashes = page_content_hashes(base_pdf_path)
+        if not old_hashes:
+            LOGGER.info('no previous journal with page hashes, process all pages, base_json_path: %s', base_json_path)
+            return page_hashes, None
+        return page_hashes, carry_over_titles(old_hashes, records, page_hashes)
+
+    def get_embedded_toc_titles(self, pdf_path):
+        """
+        toc_mode为auto时，pdf自带书签且级别关系正确，则直接用它，不再调模型。
+        :return: 标题列表，不满足条件时为空
+        """
+        if self.toc_mode == "off" or not pdf_path:
+            return []
+        from llm_bookmark.contents import read_embedded_toc
+
+        titles = read_embedded_toc(pdf_path, max_title_grade=self.max_title_grade)
+        if titles and not self.is_titles_order_valid(titles):
+            LOGGER.warning('embedded toc grade error, ignore it, pdf_path: %s', pdf_path)
+            return []
+        return titles
+
+    def is_titles_order_valid(self, titles: list[Title]):
+        try:
+            title_stack = []
+            self.update_title_stack(title_stack, titles)
+            return True
+        except ValueError:
+            return False
+
+    def filter_pages(self, pages, pdf_path, skip_page_ranges: list[tuple[int, int]]=None):
+        """
+        page_filter.enabled为true时，把空白页、图片页、重复页加到skip_page_ranges中。
+        有pdf时从pdf渲染缩略图，否则读pages中的图片。
+        :return: 新的skip_page_ranges
+        """
+        if not self.page_filter:
+            return skip_page_ranges
+        indexs = [index for index in range(len(pages)) if not is_skip_page(index, skip_page_ranges)]
+        image_paths = None if pdf_path else [pages.page_key(index) for index in indexs]
+        skipped = self.page_filter.filter_pages(indexs, pdf_path=pdf_path, image_paths=image_paths)
+        return list(skip_page_ranges or []) + [(index, index) for index in sorted(skipped)]
+
+    def get_context_selector(self, pdf_path):
+        """
+        context_tiers只有full且不限预算时返回None，目录栈对应的页和原来一样发整页
+        """
+        if self.context_tiers == ["full"] and not self.context_token_budget:
+            return None
+        from llm_bookmark.context_images import ContextSelector
+
+        return ContextSelector(pdf_path, tiers=self.context_tiers, token_budget=self.context_token_budget,
+                               max_image_tokens=self.max_image_tokens,
+                               thumbnail_tokens=self.context_thumbnail_tokens, crop_tokens=self.context_crop_tokens)
+
+    def get_context(self, pages, title_stack: list[Title], titles: list[Title], context_selector, index):
+        """
+        :return: pre_titles，要发送的目录栈页索引，请求用的pages(目录栈对应的页可能是缩略图或裁剪图)
+        """
+        pre_titles, pre_indexs = self.get_pre_titles(title_stack, titles)
+        if context_selector is None or not pre_indexs:
+            return pre_titles, pre_indexs, pages
+        tier, request_pages, pre_indexs = context_selector.select(pages, pre_indexs, title_stack)
+        LOGGER.info("context tier: %s, index: %d, pre_indexs: %s", tier, index, pre_indexs)
+        metrics.count(f"context_tier_{tier}", index=index)
+        return pre_titles, pre_indexs, request_pages
+
+    def get_text_layer(self, pdf_path):
+        """
+        text_layer为true，或者vl_cascade要检查"有像标题的行却没有提取出标题"时，返回文字层的标题识别器
+        """
+        need_headings = self.vl_cascade and "headings" in self.cascade_escalate_on
+        if not (self.text_layer or need_headings) or not pdf_path:
+            return None
+        from llm_bookmark.text_layer import TextLayerHeadingDetector
+
+        return TextLayerHeadingDetector(pdf_path, max_title_grade=self.max_title_grade,
+                                        contents_page_thresh=self.contents_page_thresh)
+
+    def bookmark_steps(self, pages, skip_page_ranges: list[tuple[int, int]]=None, extra_prompt=None,
+                       text_layer: "TextLayerHeadingDetector"=None, journal: PageJournal=None,
+                       carried_titles: dict=None, context_selector: "ContextSelector"=None):
+        """
+        逐页提取标题的主流程。这里不直接调模型，而是以生成器的方式把要调模型的请求yield出去，由run_steps(同步)或
+        arun_steps(异步)执行后把结果send回来，这样同步和异步共用同一套处理逻辑。yield的内容有三种：
+        ("call", request): 执行请求，返回结果；
+        ("submit", request): 提交请求到后台并发执行，返回句柄，不支持并发时返回None；
+        ("wait", handle): 等待句柄对应的请求执行完，返回结果。
+        request为VlRequest或JudgeRequest。
+        toc_mode为auto时，先尝试根据目录页生成书签，不成功再逐页提取。
+        text_layer不为空时，文字层识别标题置信度足够的页直接用识别结果，不调vl_model。
+        journal不为空时，每处理完一页追加一行日志，日志中已有记录(续跑)则先回放，从下一页继续。
+        carried_titles为增量处理时从上一版沿用的{页索引: 标题}，与文字层的结果一样，与目录栈对得上才采用。
+        context_selector不为空时，由它决定目录栈对应的页以什么形式(文字、裁剪图、缩略图、整页)发送。
+        tolerant为true时，某一页的返回内容无法使用或调模型出错，只重新请求这一页，仍然失败则隔离这一页，不中断整次运行。
+        :return: 标题列表
+        """
+        page_indexs = []
+        for index in range(len(pages)):
+            if is_skip_page(index, skip_page_ranges):
+                LOGGER.info("skip page, index: %d, page_name: %s", index, pages.page_name(index))
+                continue
+            page_indexs.append(index)
+
+        titles = Outline()
         title_stack: list[Title] = []
+        fault_log = FaultLog(self.tolerant_retry_budget) if self.tolerant else None
+        if journal and journal.records:
+            for record in journal.records:
+                cur_titles = [Title(grade=grade, title_name=title_name, abstract=abstract,
+                                    page_number=record["index"] + 1)
+                              for grade, title_name, abstract in record["titles"]]
+                self.update_title_stack(title_stack, cur_titles)
+                titles.extend(cur_titles)
+                if fault_log and record.get("error"):
+                    fault_log.quarantine(record["index"], pages.page_name(record["index"]), record["error"],
+                                         record["res_content"])
+            done_index = journal.records[-1]["index"]
+            page_indexs = [index for index in page_indexs if index > done_index]
+            LOGGER.info("resume from journal, done pages: %d, titles: %d, todo pages: %d",
+                        len(journal.records), len(titles), len(page_indexs))
+        elif self.toc_mode == "auto" and not carried_titles:
+            titles = yield from self.toc_steps(pages, page_indexs, extra_prompt)
+            if titles:
+                if self.save_tmp_json:
+                    self.dump_titles(pages.json_path, titles)
+                return titles
+            titles = Outline()
 
-        human_message_prompt = PromptTemplate.from_template(self.load_prompt("bookmark_with_pretitles_prompt.txt"))
-        human_message_prompt_no_pre = PromptTemplate.from_template(self.load_prompt("bookmark_single_page_prompt.txt"))
+        # 不用调vl_model的页，{页索引: (标题, 来源)}
+        known_titles = {}
+        if text_layer and self.text_layer:
+            for index in page_indexs:
+                response_titles, confidence = text_layer.detect(index)
+                if confidence >= self.text_layer_min_confidence:
+                    known_titles[index] = (response_titles, "text layer")
+            LOGGER.info("text layer confident pages: %d/%d", len(known_titles), len(page_indexs))
+        if carried_titles:
+            for index in page_indexs:
+                if index in carried_titles:
+                    known_titles[index] = (carried_titles[index], "previous version")
+        vl_page_indexs = [index for index in page_indexs if index not in known_titles]
 
-        for index, image_name in enumerate(images):
-            LOGGER.info("index: %d, image_name: %s", index, image_name)
-            if skip_page_ranges:
-                skip = False
-                for page_start, page_end in skip_page_ranges:
-                    if page_start <= index <= page_end:
-                        skip = True
-                        break
+        # vl_concurrency大于1时，提前并发地按单页提示词(不带pre_titles)去请求后面的页，即"预测"这一页不需要目录栈上下文，
+        # 然后再按顺序逐页核对，预测不成立的页才用正确的pre_titles重新请求。多页合并请求时不预测。
+        speculative_handles = {}
+        pos = 0
+        while pos < len(page_indexs):
+            index = page_indexs[pos]
+            pos += 1
+            LOGGER.info("index: %d, page_name: %s", index, pages.page_name(index))
+            if index in known_titles:
+                response_titles, source = known_titles[index]
+                if self.is_titles_valid(response_titles, index, title_stack):
+                    LOGGER.info("use %s titles, index: %d, titles: %s", source, index, response_titles)
+                    titles_count = len(titles)
+                    self.add_response_titles(response_titles, index, titles, title_stack)
+                    self.journal_page(journal, index, None, titles[titles_count:], fault_log)
+                    continue
+                LOGGER.info("%s titles conflict with title_stack, use vl_model, index: %d", source, index)
 
-                if skip:
-                    LOGGER.info("skip page, index: %d, image_name: %s", index, image_name)
+            if self.vl_batch_pages > 1:
+                pre_titles, pre_indexs, request_pages = self.get_context(pages, title_stack, titles,
+                                                                         context_selector, index)
+                batch_size = self.get_batch_size(len(pre_indexs))
+                batch_indexs = [index]
+                # 不用调vl_model的页不放进来，保证按顺序处理
+                while len(batch_indexs) < batch_size and pos < len(page_indexs) and \
+                        page_indexs[pos] not in known_titles:
+                    batch_indexs.append(page_indexs[pos])
+                    pos += 1
+                if len(batch_indexs) > 1:
+                    yield from self.batch_steps(pages, batch_indexs, pre_titles, pre_indexs, titles, title_stack,
+                                                extra_prompt, journal=journal, context_selector=context_selector,
+                                                request_pages=request_pages, text_layer=text_layer,
+                                                fault_log=fault_log)
                     continue
 
-            pre_titles, pre_indexs = self.get_pre_titles(title_stack, titles)
-            if pre_titles:
-                human_message_text = human_message_prompt.invoke({"pre_titles": pre_titles,
-                                                                  "extra_prompt": self.extra_prompt}).text
-            else:
-                human_message_text = human_message_prompt_no_pre.invoke({"extra_prompt": self.extra_prompt}).text
-
-            image_messages = []
-            image_paths_str = ""
-            for per_index in pre_indexs + [index]:
-                image_path = str(image_dir / images[per_index])
-                image_paths_str += image_path + '\n'
-                image_messages.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{encode_image(image_path, need_resize=self.need_resize, 
-                                                                         max_image_tokens=self.max_image_tokens)}"
-                        },
-                    })
-
-            prompt = [
-                SystemMessage([{"type": "text", "text": "你是一个pdf书签助手。"}]),
-                HumanMessage(image_messages + [
-                    {"type": "text", "text": human_message_text},
-                  ])]
-
-            LOGGER.info('vl_model input, image_paths_str: \n%s\npre_titles:\n%s', image_paths_str, pre_titles)
-            # 这里其实并不是很严谨，主要是为了方便查看cache文件，比如图片如果路径没变，但图片变了，key却是一样的。
-            vl_model_cache_key = image_paths_str + human_message_text
-            if vl_model_cache_key in self.vl_model_cache:
-                res_content = self.vl_model_cache.get(vl_model_cache_key)
-                LOGGER.info('use cache, res_content: %s', res_content)
+            if self.vl_concurrency > 1 and self.vl_batch_pages <= 1:
+                vl_pos = bisect.bisect_left(vl_page_indexs, index)
+                for ahead_index in vl_page_indexs[vl_pos: vl_pos + self.vl_prefetch_pages]:
+                    if ahead_index not in speculative_handles:
+                        model_tier, resolution = self.escalation_steps[0]
+                        speculative_handles[ahead_index] = yield "submit", VlRequest(
+                            self.resolution_pages(pages, [ahead_index], resolution), [ahead_index],
+                            self.get_human_message_text("", extra_prompt), model_tier=model_tier)
+
+            pre_titles, pre_indexs, request_pages = self.get_context(pages, title_stack, titles, context_selector,
+                                                                     index)
+
+            res_content = None
+            if speculative_handles.get(index) is not None:
+                try:
+                    speculative_res_content = yield "wait", speculative_handles.pop(index)
+                except Exception as e:
+                    if not self.tolerant:
+                        raise
+                    LOGGER.warning("speculative request failed, index: %d, error: %s", index, e)
+                    speculative_res_content = None
+                if speculative_res_content is not None and \
+                        self.is_speculation_valid(speculative_res_content, pre_titles):
+                    res_content = speculative_res_content
+                else:
+                    LOGGER.info("speculation failed, re-query with pre_titles, index: %d", index)
+
+            titles_count = len(titles)
+            res_content = yield from self.page_steps(pages, index, titles, title_stack, extra_prompt,
+                                                     context_selector=context_selector, res_content=res_content,
+                                                     context=(pre_titles, pre_indexs, request_pages),
+                                                     text_layer=text_layer, fault_log=fault_log)
+            self.journal_page(journal, index, res_content, titles[titles_count:], fault_log)
+
+        if self.save_tmp_json:
+            self.dump_titles(pages.json_path, titles)
+        if fault_log:
+            fault_log.dump(get_review_path(pages.json_path))
+        return titles.to_titles()
+
+    @staticmethod
+    def journal_page(journal: PageJournal, index, res_content, new_titles: list[Title], fault_log: FaultLog=None):
+        if journal:
+            journal.append(index, res_content,
+                           [[title.grade, title.title_name, title.abstract] for title in new_titles],
+                           error=fault_log.get_error(index) if fault_log else None)
+
+    def toc_steps(self, pages, page_indexs: list[int], extra_prompt=None):
+        """
+        目录页模式：在前toc_scan_pages页中找到目录页，一次性提取出所有目录条目及印刷页码，再用少量页推算出印刷页码与页索引的偏移，
+        最后只核对预计有标题的页，不用逐页调vl_model。任何一步不成立都返回None，由bookmark_steps回退到逐页提取。
+        """
+        contents_indexs, entries = yield from self.find_contents_steps(pages, page_indexs[:self.toc_scan_pages],
+                                                                       extra_prompt)
+        if not entries:
+            LOGGER.info("toc_steps no contents page found, fallback to page by page")
+            return None
+        LOGGER.info("toc_steps contents pages: %s, entries: %d", contents_indexs, len(entries))
+
+        body_indexs = [index for index in page_indexs if index > contents_indexs[-1]]
+        offset = yield from self.learn_page_offset_steps(pages, body_indexs, entries, extra_prompt)
+        if offset is None:
+            LOGGER.info("toc_steps learn page offset failed, fallback to page by page")
+            return None
+        LOGGER.info("toc_steps page offset: %d", offset)
+
+        titles = yield from self.verify_contents_steps(pages, page_indexs, entries, offset, extra_prompt)
+        if titles is None or not self.is_titles_order_valid(titles):
+            LOGGER.info("toc_steps verify failed, fallback to page by page")
+            return None
+        return titles
+
+    def page_requests_steps(self, requests: list):
+        """
+        并发执行一组相互独立的请求，按顺序返回结果，不支持并发时逐个执行。
+        """
+        handles = []
+        for request in requests:
+            handles.append((yield "submit", request))
+
+        results = []
+        for request, handle in zip(requests, handles):
+            if handle is None:
+                results.append((yield "call", request))
             else:
-                res_content = self.vl_model.invoke(prompt).content
-                self.vl_model_cache.save_one(vl_model_cache_key, res_content)
-                LOGGER.info('res_content: %s', res_content)
+                results.append((yield "wait", handle))
+        return results
+
+    def single_page_request(self, pages, index, extra_prompt=None):
+        # 与bookmark_steps中预取的请求完全一样，回退到逐页提取时可以直接命中缓存
+        return VlRequest(pages, [index], self.get_human_message_text("", extra_prompt))
+
+    def find_contents_steps(self, pages, scan_indexs: list[int], extra_prompt=None):
+        """
+        按vl_concurrency分批请求前面的页，请求与逐页提取的完全一样，回退时能命中缓存。
+        与deal_title_steps一样，标题数超过contents_page_thresh且is_title_page认为是目录页的，才用目录页提示词提取目录条目。
+        找到连续的目录页后遇到第一个非目录页，或者还没找到目录页就遇到了有标题的页(正文已经开始)，就停止。
+        :return: 目录页索引，目录条目[(标题级别，标题，印刷页码)]
+        """
+        from llm_bookmark.contents import parse_contents_response
+
+        contents_text = self.format_prompt("contents_page_prompt.txt", extra_prompt=extra_prompt or self.extra_prompt)
+        contents_indexs = []
+        entries = []
+        batch_size = max(1, self.vl_concurrency)
+        for start in range(0, len(scan_indexs), batch_size):
+            batch_indexs = scan_indexs[start: start + batch_size]
+            results = yield from self.page_requests_steps(
+                [self.single_page_request(pages, index, extra_prompt) for index in batch_indexs])
+            for index, res_content in zip(batch_indexs, results):
+                response_titles = self.get_response_titles(res_content)
+                is_contents_page, page_entries = False, []
+                if len(response_titles) > self.contents_page_thresh and (yield "call", JudgeRequest(res_content)):
+                    contents_content = yield "call", VlRequest(pages, [index], contents_text)
+                    is_contents_page, page_entries = parse_contents_response(contents_content, self.max_title_grade)
+                if is_contents_page and page_entries:
+                    contents_indexs.append(index)
+                    entries.extend(page_entries)
+                elif contents_indexs or response_titles:
+                    return contents_indexs, entries
+        return contents_indexs, entries
+
+    def get_response_titles(self, res_content):
+        """
+        :return: 逐页提取结果中的"最终答案"，格式不对时为空列表
+        """
+        try:
+            response_titles = self.load_response(res_content)["最终答案"]
+        except (ValueError, SyntaxError, KeyError, TypeError):
+            return []
+        return response_titles if isinstance(response_titles, list) else []
+
+    def learn_page_offset_steps(self, pages, body_indexs: list[int], entries: list, extra_prompt=None):
+        """
+        先在正文的前toc_offset_search页中找第一个抽样条目，得到偏移(页索引 - 印刷页码)，再用其余抽样条目核对，
+        过半落在预计页或其前后一页才认为偏移可靠。
+        :return: 偏移，找不到时为None
+        """
+        from llm_bookmark.contents import pick_samples, find_title_in_response
+
+        samples = pick_samples(entries, self.toc_offset_samples)
+        _, first_title_name, first_printed_page = samples[0]
+        search_indexs = body_indexs[:self.toc_offset_search]
+        batch_size = max(1, self.vl_concurrency)
+        offset = None
+        for start in range(0, len(search_indexs), batch_size):
+            batch_indexs = search_indexs[start: start + batch_size]
+            results = yield from self.page_requests_steps(
+                [self.single_page_request(pages, index, extra_prompt) for index in batch_indexs])
+            for index, res_content in zip(batch_indexs, results):
+                if find_title_in_response(first_title_name, res_content):
+                    offset = index - first_printed_page
+                    break
+            if offset is not None:
+                break
+        if offset is None:
+            return None
+
+        confirm_samples = samples[1:]
+        if not confirm_samples:
+            return offset
+        confirmed = 0
+        for _, title_name, printed_page in confirm_samples:
+            found_index = yield from self.find_title_near_steps(pages, title_name, printed_page + offset,
+                                                                set(body_indexs), extra_prompt)
+            if found_index is not None:
+                confirmed += 1
+        LOGGER.info("learn_page_offset_steps offset: %d, confirmed: %d/%d", offset, confirmed, len(confirm_samples))
+        return offset if confirmed * 2 >= len(confirm_samples) else None
+
+    def find_title_near_steps(self, pages, title_name, expected_index, allowed_indexs: set, extra_prompt=None):
+        """
+        依次在预计页、后一页、前一页找该标题，插页、跨页等会导致个别标题的偏移差一页。
+        :return: 找到标题的页索引，找不到时为None
+        """
+        from llm_bookmark.contents import find_title_in_response
+
+        for index in (expected_index, expected_index + 1, expected_index - 1):
+            if index not in allowed_indexs:
+                continue
+            res_content = yield "call", self.single_page_request(pages, index, extra_prompt)
+            if find_title_in_response(title_name, res_content):
+                return index
+        return None
+
+    def verify_contents_steps(self, pages, page_indexs: list[int], entries: list, offset: int, extra_prompt=None):
+        """
+        只请求目录条目预计所在的页，核对标题是否真的在这一页，不在则到前后一页找。
+        核对通过的比例低于toc_min_verified_ratio时返回None，核对不通过的条目按预计页生成书签。
+        """
+        from llm_bookmark.contents import find_title_in_response
 
-            self.deal_title_with_response(res_content, index, titles, title_stack)
-            if self.save_tmp_json:
-                with open(json_path, 'wt', encoding='utf-8', newline='') as f:
-                    json.dump(titles, f, ensure_ascii=False, cls=TitleEncoder)
+        allowed_indexs = set(page_indexs)
+        expected_indexs = sorted(set(printed_page + offset for _, _, printed_page in entries) & allowed_indexs)
+        results = yield from self.page_requests_steps(
+            [self.single_page_request(pages, index, extra_prompt) for index in expected_indexs])
+        res_by_index = dict(zip(expected_indexs, results))
 
-        LOGGER.info('get_bookmark_by_images return, titles:\n%s', titles_str(titles))
+        titles = []
+        verified = 0
+        for grade, title_name, printed_page in entries:
+            expected_index = printed_page + offset
+            if expected_index not in allowed_indexs:
+                LOGGER.info("contents entry out of range, ignore: %s", (grade, title_name, printed_page))
+                continue
+
+            found_index = expected_index if find_title_in_response(title_name, res_by_index[expected_index]) else None
+            if found_index is None:
+                found_index = yield from self.find_title_near_steps(pages, title_name, expected_index,
+                                                                    allowed_indexs - {expected_index}, extra_prompt)
+            if found_index is None:
+                LOGGER.warning("contents entry not verified: %s, expected index: %d",
+                               (grade, title_name, printed_page), expected_index)
+                found_index = expected_index
+            else:
+                verified += 1
+            titles.append(Title(grade=grade, title_name=title_name, abstract="", page_number=found_index + 1))
+
+        LOGGER.info("verify_contents_steps verified: %d/%d", verified, len(entries))
+        if not entries or verified < len(entries) * self.toc_min_verified_ratio:
+            return None
+        # 个别条目找到的页可能与目录顺序不一致，按页排序，同一页内保持目录中的顺序
+        titles.sort(key=lambda title: title.page_number)
         return titles
 
+    def get_batch_size(self, pre_page_count):
+        """
+        多页合并请求时一次提取几页：不超过vl_batch_pages，且连同目录栈对应的页，图片token数不超过vl_batch_max_image_tokens
+        """
+        if not self.vl_batch_max_image_tokens:
+            return self.vl_batch_pages
+        return max(1, min(self.vl_batch_pages, self.vl_batch_max_image_tokens // self.max_image_tokens - pre_page_count))
+
+    def batch_steps(self, pages, batch_indexs: list[int], pre_titles: str, pre_indexs: list[int], titles: list[Title],
+                    title_stack: list[Title], extra_prompt=None, journal: PageJournal=None,
+                    context_selector: "ContextSelector"=None, request_pages=None,
+                    text_layer: "TextLayerHeadingDetector"=None, fault_log: FaultLog=None):
+        """
+        一次请求提取batch_indexs这几页的标题，返回结果拆成每页的结果后，再逐页交给deal_title_steps处理。
+        返回格式不对时，这几页回退到逐页请求。
+        :param request_pages: get_context返回的请求用的pages，为空则用pages
+        """
+        model_tier, resolution = self.escalation_steps[0]
+        try:
+            res_content = yield "call", VlRequest(
+                self.resolution_pages(request_pages or pages, batch_indexs, resolution), pre_indexs + batch_indexs,
+                self.get_batch_message_text(pre_titles, len(batch_indexs), extra_prompt), pre_titles=pre_titles,
+                model_tier=model_tier)
+        except Exception as e:
+            if not self.tolerant:
+                raise
+            LOGGER.warning("batch request failed, query page by page, batch_indexs: %s, error: %s", batch_indexs, e)
+            res_content = None
+
+        page_res_contents = None
+        if res_content is not None:
+            try:
+                page_res_contents = split_batch_response(res_content, len(batch_indexs),
+                                                         repair=repair_json if self.tolerant else None)
+            except (ValueError, KeyError, TypeError, SyntaxError) as e:
+                LOGGER.warning("split batch response failed, query page by page, batch_indexs: %s, error: %s",
+                               batch_indexs, e)
+
+        for batch_pos, index in enumerate(batch_indexs):
+            titles_count = len(titles)
+            page_res_content = yield from self.page_steps(
+                pages, index, titles, title_stack, extra_prompt, context_selector=context_selector,
+                res_content=page_res_contents[batch_pos] if page_res_contents else None, text_layer=text_layer,
+                fault_log=fault_log)
+            self.journal_page(journal, index, page_res_content, titles[titles_count:], fault_log)
+
+    def page_steps(self, pages, index, titles: list[Title], title_stack: list[Title], extra_prompt=None,
+                   context_selector: "ContextSelector"=None, res_content=None, context=None,
+                   text_layer: "TextLayerHeadingDetector"=None, fault_log: FaultLog=None):
+        """
+        提取一页的标题：escalate_steps拿到模型返回内容，再交给deal_title_steps。
+        fault_log不为空(tolerant模式)时，返回内容无法使用、判断目录页出错或者调模型出错，都只影响这一页：
+        在重试预算内带上重试提示用vl_model重新请求这一页(提示词不同，不会命中缓存)，仍然失败则隔离这一页，不加标题。
+        参数见escalate_steps
+        :return: 最终采用的模型返回内容，隔离的页为最后一次的返回内容(调模型出错则为None)
+        """
+        attempt = 0
+        while True:
+            try:
+                if attempt == 0:
+                    res_content = yield from self.escalate_steps(pages, index, titles, title_stack, extra_prompt,
+                                                                 context_selector=context_selector,
+                                                                 res_content=res_content, context=context,
+                                                                 text_layer=text_layer)
+                else:
+                    res_content = None
+                    pre_titles, pre_indexs, request_pages = context or self.get_context(
+                        pages, title_stack, titles, context_selector, index)
+                    res_content = yield "call", VlRequest(
+                        request_pages, pre_indexs + [index],
+                        self.get_human_message_text(pre_titles, extra_prompt) + "\n" +
+                        self.load_prompt("retry_prompt.txt").format(attempt=attempt), pre_titles=pre_titles)
+                yield from self.deal_title_steps(res_content, index, titles, title_stack)
+                return res_content
+            except Exception as e:
+                if fault_log is None:
+                    raise
+                error = f"{type(e).__name__}: {e}"
+                LOGGER.warning("page failed, index: %d, attempt: %d, error: %s", index, attempt, error)
+                metrics.count("page_failures", index=index)
+                if attempt >= self.tolerant_page_retries or not fault_log.take_retry():
+                    fault_log.quarantine(index, pages.page_name(index), error, res_content)
+                    metrics.count("quarantined_pages", index=index)
+                    return res_content
+                attempt += 1
+                metrics.count("page_retries", index=index)
+
+    def escalate_steps(self, pages, index, titles: list[Title], title_stack: list[Title], extra_prompt=None,
+                       context_selector: "ContextSelector"=None, res_content=None, context=None,
+                       text_layer: "TextLayerHeadingDetector"=None):
+        """
+        提取一页的标题，按escalation_steps依次请求：先是vl_cascade中较便宜的模型，再是vl_model从低到高的分辨率档位。
+        返回内容解析失败、级别与目录栈对不上、有像标题的行却没提取出标题、自评的置信度不够，或者被抽查时，
+        换下一档重新请求，最后一档(vl_model，max_image_tokens)的结果交给deal_title_steps按原来的逻辑处理。
+        :param res_content: 已有的第一档的结果(预取或多页合并请求的)，为空则先请求
+        :param context: get_context的结果，为空则需要请求时再取
+        :param text_layer: 用于检查有像标题的行却没提取出标题
+        :return: 最终采用的模型返回内容，还没有交给deal_title_steps
+        """
+        sampled_res_content = None
+        for step_pos, (model_tier, resolution) in enumerate(self.escalation_steps):
+            if res_content is None:
+                if context is None:
+                    context = self.get_context(pages, title_stack, titles, context_selector, index)
+                pre_titles, pre_indexs, request_pages = context
+                res_content = yield "call", VlRequest(self.resolution_pages(request_pages, [index], resolution),
+                                                      pre_indexs + [index],
+                                                      self.get_human_message_text(pre_titles, extra_prompt),
+                                                      pre_titles=pre_titles, model_tier=model_tier)
+            if sampled_res_content is not None:
+                agree = response_titles_key(sampled_res_content) == response_titles_key(res_content)
+                metrics.count("cascade_agreements" if agree else "cascade_disagreements", index=index)
+                LOGGER.info("cascade sampled check, index: %d, agree: %s", index, agree)
+                sampled_res_content = None
+            if step_pos == len(self.escalation_steps) - 1:
+                break
+
+            reason = self.get_escalate_reason(res_content, index, title_stack, model_tier, text_layer)
+            if reason is None and model_tier is not self.vl_tier and is_sampled(pages.page_key(index),
+                                                                                  self.cascade_sample_rate):
+                reason = "sampled consistency check"
+                sampled_res_content = res_content
+            if reason is None:
+                break
+            next_model_tier = self.escalation_steps[step_pos + 1][0]
+            LOGGER.info("escalate, index: %d, from: %s %s, to: %s %s, reason: %s", index, model_tier.name,
+                        resolution or self.max_image_tokens, next_model_tier.name,
+                        self.escalation_steps[step_pos + 1][1] or self.max_image_tokens, reason)
+            metrics.count("cascade_escalations" if next_model_tier is not model_tier else "resolution_escalations",
+                          index=index)
+            res_content = None
+
+        if self.vl_cascade:
+            metrics.count(f"cascade_settled_{model_tier.name}", index=index)
+        if len(self.resolution_tiers) > 1 and model_tier is self.vl_tier:
+            metrics.count(f"resolution_tier_{resolution or self.max_image_tokens}", index=index)
+        return res_content
+
+    def resolution_pages(self, pages, page_indexs: list[int], tier):
+        if tier is None:
+            return pages
+        from llm_bookmark.context_images import ResolutionPages
+
+        return ResolutionPages(pages, page_indexs, tier)
+
+    def get_escalate_reason(self, res_content, index, title_stack: list[Title], model_tier: VlModelTier=None,
+                            text_layer: "TextLayerHeadingDetector"=None):
+        """
+        分辨率升档时总是检查解析失败、级别跳级，vl_cascade中的模型按vl_cascade.escalate_on检查
+        :return: 需要升档的原因，不需要时为None
+        """
+        rules = self.cascade_escalate_on if model_tier is not None and model_tier is not self.vl_tier \
+            else ("parse", "grade")
+        try:
+            response = self.load_response(res_content)
+            response_titles = response["最终答案"]
+            if not isinstance(response_titles, list):
+                raise TypeError(f'最终答案 is not a list: {response_titles}')
+        except (ValueError, KeyError, TypeError) as e:
+            if "parse" in rules:
+                return f"parse failed: {e}"
+            # 不升档时交给deal_title_steps，与原来一样报错
+            return None
+        # 标题很多的可能是目录页，级别本来就对不上，交给deal_title_steps判断
+        if "grade" in rules and len(response_titles) <= self.contents_page_thresh and \
+                not self.is_titles_valid(response_titles, index, title_stack):
+            return "titles conflict with title_stack"
+        if "headings" in rules and text_layer is not None:
+            text_layer_titles, _ = text_layer.detect(index)
+            # 级别超过max_title_grade的标题会被忽略，不算
+            kept_count = sum(1 for res_title in response_titles
+                             if isinstance(res_title, list) and res_title and isinstance(res_title[0], int)
+                             and res_title[0] <= self.max_title_grade)
+            if kept_count < len(text_layer_titles) <= self.contents_page_thresh:
+                return f"text layer has more heading-like lines: {text_layer_titles}"
+        if self.resolution_min_confidence:
+            confidence = response.get("置信度")
+            if isinstance(confidence, (int, float)) and confidence < self.resolution_min_confidence:
+                return f"low confidence: {confidence}"
+        return None
+
+    def run_steps(self, steps):
+        """
+        同步执行bookmark_steps，submit的请求放到线程池中执行。
+        """
+        executor = ThreadPoolExecutor(max_workers=self.vl_concurrency) if self.vl_concurrency > 1 else None
+        try:
+            op = next(steps)
+            while True:
+                kind, payload = op
+                try:
+                    if kind == "call":
+                        result = self.execute_request(payload)
+                    elif kind == "submit":
+                        # 带上当前的context，请求的统计才能记到这次运行上
+                        result = executor.submit(contextvars.copy_context().run, self.execute_request, payload) \
+                            if executor else None
+                    else:
+                        result = payload.result()
+                except Exception as e:
+                    # 交给bookmark_steps处理(tolerant模式下只影响这一页)，不处理则原样抛出
+                    op = steps.throw(e)
+                    continue
+                op = steps.send(result)
+        except StopIteration as e:
+            return e.value
+        finally:
+            steps.close()
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    async def arun_steps(self, steps):
+        """
+        异步执行bookmark_steps，submit的请求作为task并发执行，同时在跑的请求数不超过vl_concurrency。
+        """
+        semaphore = asyncio.Semaphore(self.vl_concurrency)
+        tasks = []
 
-    def deal_title_with_response(self, res_content:str, index: int, titles: list[Title],
-                                 title_stack: list[Title]):
-        response_titles = json.loads(res_content)["最终答案"]
+        async def aexecute_limited(request):
+            async with semaphore:
+                return await self.aexecute_request(request)
+
+        try:
+            op = next(steps)
+            while True:
+                kind, payload = op
+                try:
+                    if kind == "call":
+                        result = await aexecute_limited(payload)
+                    elif kind == "submit":
+                        result = None
+                        if self.vl_concurrency > 1:
+                            result = asyncio.create_task(aexecute_limited(payload))
+                            tasks.append(result)
+                    else:
+                        result = await payload
+                except Exception as e:
+                    op = steps.throw(e)
+                    continue
+                op = steps.send(result)
+        except StopIteration as e:
+            return e.value
+        finally:
+            steps.close()
+            for task in tasks:
+                task.cancel()
 
-        if len(response_titles) > self.contents_page_thresh and self.is_title_page(res_content):
+    def execute_request(self, request):
+        if isinstance(request, VlRequest):
+            return self.invoke_vl_model(request.pages, request.page_indexs, request.human_message_text,
+                                        pre_titles=request.pre_titles, model_tier=request.model_tier)
+        return self.is_title_page(request.res_content)
+
+    async def aexecute_request(self, request):
+        if isinstance(request, VlRequest):
+            return await self.ainvoke_vl_model(request.pages, request.page_indexs, request.human_message_text,
+                                               pre_titles=request.pre_titles, model_tier=request.model_tier)
+        return await self.ais_title_page(request.res_content)
+
+    @staticmethod
+    def dump_titles(json_path, titles):
+        """
+        :param titles: Outline或list[Title]，Outline中每个标题加入时已经序列化好，这里只是拼接
+        """
+        outline = titles if isinstance(titles, Outline) else Outline.from_titles(titles)
+        outline.dump(json_path)
+
+    def get_human_message_text(self, pre_titles, extra_prompt=None):
+        extra_prompt = extra_prompt or self.extra_prompt
+        if self.resolution_min_confidence:
+            extra_prompt = extra_prompt + "\n" + self.load_prompt("confidence_prompt.txt")
+        if pre_titles:
+            return self.format_prompt("bookmark_with_pretitles_prompt.txt", pre_titles=pre_titles,
+                                      extra_prompt=extra_prompt)
+        return self.format_prompt("bookmark_single_page_prompt.txt", extra_prompt=extra_prompt)
+
+    def get_batch_message_text(self, pre_titles, page_count, extra_prompt=None):
+        return self.format_prompt("bookmark_batch_prompt.txt", pre_titles=pre_titles or "无", page_count=page_count,
+                                  extra_prompt=extra_prompt or self.extra_prompt)
+
+    def build_vl_request(self, pages, page_indexs: list[int], human_message_text: str, model_name=None):
+        """
+        :param pages: ImageDirPages或PdfPages
+        :param page_indexs: 页索引，最后一页为当前页，前面的为目录栈对应的页
+        :param human_message_text: 提示词
+        :param model_name: 为空则为vl_model的
+        :return: 模型输入，缓存key
+        """
+        image_messages = []
+        page_keys = []
+        image_datas = []
+        for page_index in page_indexs:
+            with metrics.stage("encode", page_index) as stage_record:
+                mime_type, image_data = pages.encode(page_index)
+                stage_record.nbytes = len(image_data)
+            page_keys.append(pages.page_key(page_index))
+            image_datas.append(image_data)
+            image_messages.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{image_data}"
+                    },
+                })
+
+        # openai格式的消息，ChatOpenAI和HttpChatModel都能直接用
+        prompt = [
+            {"role": "system", "content": [{"type": "text", "text": "你是一个pdf书签助手。"}]},
+            {"role": "user", "content": image_messages + [
+                {"type": "text", "text": human_message_text},
+              ]}]
+        return prompt, self.get_vl_model_cache_key(page_keys, image_datas, human_message_text, model_name)
+
+    def estimate_tokens(self, image_count, text):
+        """
+        粗略估算一次请求的token数，用于限流。中文大约一个字一个token，图片按max_image_tokens算。
+        """
+        return image_count * self.max_image_tokens + len(text)
+
+    def get_image_tokens(self, pages, page_indexs: list[int]):
+        """
+        按max_image_tokens估算，目录栈对应的页是缩略图或裁剪图时按它们的token上限算
+        """
+        if hasattr(pages, "image_tokens"):  # ContextPages
+            return sum(pages.image_tokens(page_index, self.max_image_tokens) for page_index in page_indexs)
+        return len(page_indexs) * self.max_image_tokens
+
+    def invoke_model(self, model, model_conf, rate_limiter, prompt, tokens, stage_name="vl_model", index=None,
+                     image_tokens=0):
+        """
+        调模型，先过限流器，429和超时按抖动的指数退避重试。
+        request_semaphore不为空时（比如批量处理多本书），所有请求共用这一个并发上限。
+        :param stage_name: 统计时的阶段名，vl_model或llm_model
+        :param index: 统计时计入哪一页，多页的请求计入最后一页
+        :param image_tokens: 估算的图片token数，只用于统计
+        """
+        def invoke():
+            rate_limiter.acquire(tokens)
+            if self.request_semaphore is None:
+                return model.invoke(prompt)
+            with self.request_semaphore:
+                return model.invoke(prompt)
+
+        with metrics.stage(stage_name, index):
+            message = call_with_retry(invoke, max_retries=model_conf.get("max_retries", 0),
+                                      base_delay=model_conf.get("retry_base_delay", 1.0),
+                                      on_retry=lambda e: metrics.count(f"{stage_name}_retries", index=index))
+        metrics.record_usage(stage_name, message, index=index, image_tokens=image_tokens)
+        return message
+
+    @staticmethod
+    async def ainvoke_model(model, model_conf, rate_limiter, prompt, tokens, stage_name="vl_model", index=None,
+                            image_tokens=0):
+        async def ainvoke():
+            await rate_limiter.aacquire(tokens)
+            return await model.ainvoke(prompt)
+
+        with metrics.stage(stage_name, index):
+            message = await acall_with_retry(ainvoke, max_retries=model_conf.get("max_retries", 0),
+                                             base_delay=model_conf.get("retry_base_delay", 1.0),
+                                             on_retry=lambda e: metrics.count(f"{stage_name}_retries", index=index))
+        metrics.record_usage(stage_name, message, index=index, image_tokens=image_tokens)
+        return message
+
+    def invoke_vl_model(self, pages, page_indexs: list[int], human_message_text: str, pre_titles="",
+                        model_tier: VlModelTier=None):
+        """
+        调vl_model，优先读缓存。
+        :param pages: ImageDirPages或PdfPages
+        :param page_indexs: 页索引，最后一页为当前页，前面的为目录栈对应的页
+        :param human_message_text: 提示词
+        :param pre_titles: 仅用于打日志
+        :param model_tier: vl_cascade中的模型，为空则用vl_model，每档有自己的缓存和统计
+        :return: 模型返回的内容
+        """
+        model_tier = model_tier or self.vl_tier
+        prompt, vl_model_cache_key = self.build_vl_request(pages, page_indexs, human_message_text,
+                                                           model_tier.model_name)
+        page_keys_str = "".join(pages.page_key(page_index) + '\n' for page_index in page_indexs)
+        LOGGER.info('%s input, page_keys_str: \n%s\npre_titles:\n%s', model_tier.name, page_keys_str, pre_titles)
+        index = page_indexs[-1]
+        with metrics.stage("cache"):
+            res_content = model_tier.cache.get(vl_model_cache_key)
+        if res_content is not None:
+            metrics.count(f"{model_tier.name}_cache_hits", index=index)
+            LOGGER.info('use cache, res_content: %s', res_content)
+        else:
+            metrics.count(f"{model_tier.name}_cache_misses", index=index)
+            image_tokens = self.get_image_tokens(pages, page_indexs)
+            res_content = self.invoke_model(model_tier.model, model_tier.model_conf, model_tier.rate_limiter, prompt,
+                                            image_tokens + self.estimate_tokens(0, human_message_text),
+                                            stage_name=model_tier.name, index=index,
+                                            image_tokens=image_tokens).content
+            with metrics.stage("cache"):
+                model_tier.cache.save_one(vl_model_cache_key, res_content)
+            LOGGER.info('res_content: %s', res_content)
+        return res_content
+
+    async def ainvoke_vl_model(self, pages, page_indexs: list[int], human_message_text: str, pre_titles="",
+                               model_tier: VlModelTier=None):
+        """
+        invoke_vl_model的异步版本，图片编码、读写缓存放到线程里执行。
+        """
+        model_tier = model_tier or self.vl_tier
+        prompt, vl_model_cache_key = await asyncio.to_thread(self.build_vl_request, pages, page_indexs,
+                                                             human_message_text, model_tier.model_name)
+        page_keys_str = "".join(pages.page_key(page_index) + '\n' for page_index in page_indexs)
+        LOGGER.info('%s input, page_keys_str: \n%s\npre_titles:\n%s', model_tier.name, page_keys_str, pre_titles)
+        index = page_indexs[-1]
+        with metrics.stage("cache"):
+            res_content = await asyncio.to_thread(model_tier.cache.get, vl_model_cache_key)
+        if res_content is not None:
+            metrics.count(f"{model_tier.name}_cache_hits", index=index)
+            LOGGER.info('use cache, res_content: %s', res_content)
+        else:
+            metrics.count(f"{model_tier.name}_cache_misses", index=index)
+            image_tokens = self.get_image_tokens(pages, page_indexs)
+            res_content = (await self.ainvoke_model(model_tier.model, model_tier.model_conf, model_tier.rate_limiter,
+                                                    prompt, image_tokens + self.estimate_tokens(0, human_message_text),
+                                                    stage_name=model_tier.name, index=index,
+                                                    image_tokens=image_tokens)).content
+            with metrics.stage("cache"):
+                await asyncio.to_thread(model_tier.cache.save_one, vl_model_cache_key, res_content)
+            LOGGER.info('res_content: %s', res_content)
+        return res_content
+
+    @staticmethod
+    def is_speculation_valid(speculative_res_content: str, pre_titles: str):
+        """
+        判断不带pre_titles的单页请求结果能否直接使用：
+        1.当前目录栈为空，串行时本来也是发单页请求，结果完全一样；
+        2.该页没有提取出标题，目录栈上下文只影响标题级别，故不影响结果。
+        其它情况（包括返回内容解析失败）都需要带上pre_titles重新请求。
+        """
+        if not pre_titles:
+            return True
+
+        try:
+            return json.loads(speculative_res_content)["最终答案"] == []
+        except (ValueError, KeyError, TypeError):
+            return False
+
+    def get_vl_model_cache_key(self, image_paths: list[str], image_datas: list[str], human_message_text: str,
+                               model_name=None):
+        """
+        :param image_paths: 图片路径(PdfPages时为pdf路径#页索引)，最后一张为当前页
+        :param image_datas: 图片base64编码后的内容，与image_paths一一对应
+        :param human_message_text: 提示词
+        :return: path模式返回图片路径(非默认的编码参数时加上编码参数)+提示词；content模式返回由模型名、resize参数、图片内容hash、提示词hash组成的key，
+                 这样pdf挪了位置、重新生成了图片、或者换台机器跑，只要图片内容一样就能命中缓存。
+        """
+        if self.cache_key_mode == "path":
+            # 这里其实并不是很严谨，主要是为了方便查看cache文件，比如图片如果路径没变，但图片变了，key却是一样的。
+            key_suffix = self.page_encoder.key_suffix
+            return "".join(image_path + key_suffix + '\n' for image_path in image_paths) + human_message_text
+
+        image_hashes = []
+        for image_path, image_data in zip(image_paths, image_datas):
+            image_hash = hashlib.sha256(image_data.encode("utf-8")).hexdigest()
+            image_hashes.append(image_hash)
+            if self.vl_image_index.get(image_path) != image_hash:
+                self.vl_image_index.save_one(image_path, image_hash)
+
+        resize_str = f"max_image_tokens={self.max_image_tokens}" if self.need_resize else "no_resize"
+        prompt_hash = hashlib.sha256(human_message_text.encode("utf-8")).hexdigest()
+        return (f"model={model_name or self.vl_model_name}\nresize={resize_str}\nimages={','.join(image_hashes)}\n"
+                f"prompt={prompt_hash}")
+
+
+    def load_response(self, res_content: str):
+        """
+        tolerant模式下先修复常见的格式问题再解析
+        """
+        return repair_json(res_content) if self.tolerant else json.loads(res_content)
+
+    def deal_title_steps(self, res_content:str, index: int, titles: list[Title], title_stack: list[Title]):
+        """
+        解析一页的结果并加入标题，供bookmark_steps使用，判断目录页时通过yield交给run_steps/arun_steps调模型。
+        tolerant模式下标题级别跳级时不报错，而是降到上一级标题的下一级。
+        """
+        response_titles = self.load_response(res_content)["最终答案"]
+
+        if len(response_titles) > self.contents_page_thresh and (yield "call", JudgeRequest(res_content)):
             LOGGER.info("is title page, ignore: %s", response_titles)
             return
 
+        self.add_response_titles(response_titles, index, titles, title_stack, clamp=self.tolerant)
+
+    def is_titles_valid(self, response_titles: list, index: int, title_stack: list[Title]):
+        """
+        在目录栈的副本上试着加入这些标题，格式不对或者级别跳级则返回False，不会改动title_stack。
+        """
+        try:
+            self.add_response_titles(response_titles, index, [], list(title_stack))
+            return True
+        except (SyntaxError, ValueError):
+            return False
+
+    def add_response_titles(self, response_titles: list, index: int, titles: list[Title], title_stack: list[Title],
+                            clamp=False):
         cur_titles = []
         tmp_titles = []
         for res_index, res_title in enumerate(response_titles):
@@ -191,10 +1447,13 @@ class LLMBookmark:
                 case _:
                     raise SyntaxError(f'match title failed: {res_title}')
 
-        titles.extend(tmp_titles) # 没有异常才会一次性加进来
-        self.update_title_stack(title_stack, cur_titles)
+        self.update_title_stack(title_stack, cur_titles, clamp=clamp)
+        titles.extend(tmp_titles) # 没有异常才会一次性加进来，此时级别已经与目录栈对得上
 
-    def update_title_stack(self, title_stack: list[Title], cur_titles: list[Title]):
+    def update_title_stack(self, title_stack: list[Title], cur_titles: list[Title], clamp=False):
+        """
+        :param clamp: 为true则级别跳级时不报错，把标题的级别降到能接上目录栈的最大级别
+        """
         LOGGER.info('update_title_stack enter, \ntitle_stack: %s, \ncur_titles: %s',
                     titles_str(title_stack), titles_str(cur_titles))
         for cur_title in cur_titles:
@@ -209,26 +1468,37 @@ class LLMBookmark:
                     title_stack.pop()
                 else:
                     if cur_grade > stack_title_grade + 1:
-                        LOGGER.error(f'grade error, error title: {cur_title}, title_stack: {title_stack}')
-                        raise ValueError(f'error title: {cur_title}, title_stack: {title_stack}')
+                        if not clamp:
+                            LOGGER.error(f'grade error, error title: {cur_title}, title_stack: {title_stack}')
+                            raise ValueError(f'error title: {cur_title}, title_stack: {title_stack}')
+                        self.clamp_grade(cur_title, stack_title_grade + 1)
                     title_stack.append(cur_title)
                     break
             else:
                 # 此时title_stack必为空，则新标题的级别只能是1
                 if cur_grade != 1:
-                    LOGGER.error(f'grade error, error title: {cur_title}, title_stack: {title_stack}')
-                    raise ValueError(f'grade error, error title: {cur_title}, title_stack: {title_stack}')
+                    if not clamp:
+                        LOGGER.error(f'grade error, error title: {cur_title}, title_stack: {title_stack}')
+                        raise ValueError(f'grade error, error title: {cur_title}, title_stack: {title_stack}')
+                    self.clamp_grade(cur_title, 1)
                 title_stack.append(cur_title)
         LOGGER.info('update_title_stack return, \ntitle_stack: %s, \ncur_titles: %s',
                     titles_str(title_stack), titles_str(cur_titles))
 
-    def get_pre_titles(self, title_stack, titles):
-        pre_page_numbers = sorted(list(set([title.page_number for title in title_stack])))
+    @staticmethod
+    def clamp_grade(title: Title, grade):
+        LOGGER.warning("grade jump, clamp grade from %d to %d, title: %s", title.grade, grade, title)
+        metrics.count("grade_clamped", index=title.page_number - 1)
+        title.grade = grade
+
+    def get_pre_titles(self, title_stack, titles: Outline):
+        """
+        :return: 目录栈对应的页中的所有标题，目录栈对应的页索引。按页码索引取，与已有标题的总数无关
+        """
+        pre_page_numbers = sorted(set(title.page_number for title in title_stack))
 
-        pre_titles = ""
-        for index, title in enumerate(titles):
-            if title.page_number in pre_page_numbers:
-                pre_titles += f"[{title.grade}, \"{title.title_name}\", \"{title.abstract}\"]\n"
+        pre_titles = "".join(f"[{node.grade}, \"{node.title_name}\", \"{node.abstract}\"]\n"
+                             for pre_page_number in pre_page_numbers for node in titles.page_nodes(pre_page_number))
 
         pre_indexs = [pre_page_number - 1 for pre_page_number in pre_page_numbers]
         return pre_titles, pre_indexs
@@ -236,18 +1506,60 @@ class LLMBookmark:
 
     def is_title_page(self, res_content):
         if not self.contents_judge_by_llm:
-            LOGGER.info("is_title_page directly return True, res_content:", res_content)
+            LOGGER.info("is_title_page directly return True, res_content: %s", res_content)
             return True
 
-        human_message_prompt = PromptTemplate.from_template(self.load_prompt("is_title_page_prompt.txt"))
-        human_message_text = human_message_prompt.invoke(
-            {"res_content": res_content}).text
-        if human_message_text in self.llm_model_cache:
+        human_message_text = self.get_is_title_page_text(res_content)
+        with metrics.stage("cache"):
             judge_result = self.llm_model_cache.get(human_message_text)
+        if judge_result is not None:
+            metrics.count("llm_model_cache_hits")
         else:
-            judge_result = self.llm_model.invoke([HumanMessage(human_message_text)]).content
-            self.llm_model_cache.save_one(human_message_text, judge_result)
+            metrics.count("llm_model_cache_misses")
+            judge_result = self.invoke_model(self.llm_model, self.llm_model_conf, self.llm_rate_limiter,
+                                             [{"role": "user", "content": human_message_text}],
+                                             self.estimate_tokens(0, human_message_text),
+                                             stage_name="llm_model").content
+            with metrics.stage("cache"):
+                self.llm_model_cache.save_one(human_message_text, judge_result)
+
+        return self.parse_judge_result(res_content, judge_result, tolerant=self.tolerant)
+
+    async def ais_title_page(self, res_content):
+        if not self.contents_judge_by_llm:
+            LOGGER.info("is_title_page directly return True, res_content: %s", res_content)
+            return True
 
+        human_message_text = self.get_is_title_page_text(res_content)
+        with metrics.stage("cache"):
+            judge_result = await asyncio.to_thread(self.llm_model_cache.get, human_message_text)
+        if judge_result is not None:
+            metrics.count("llm_model_cache_hits")
+        else:
+            metrics.count("llm_model_cache_misses")
+            judge_result = (await self.ainvoke_model(self.llm_model, self.llm_model_conf, self.llm_rate_limiter,
+                                                     [{"role": "user", "content": human_message_text}],
+                                                     self.estimate_tokens(0, human_message_text),
+                                                     stage_name="llm_model")).content
+            with metrics.stage("cache"):
+                await asyncio.to_thread(self.llm_model_cache.save_one, human_message_text, judge_result)
+
+        return self.parse_judge_result(res_content, judge_result, tolerant=self.tolerant)
+
+    def get_is_title_page_text(self, res_content):
+        return self.format_prompt("is_title_page_prompt.txt", res_content=res_content)
+
+    @staticmethod
+    def parse_judge_result(res_content, judge_result, tolerant=False):
+        """
+        :param tolerant: 为true则宽松地解析，比如"是。"、"答案：不是"
+        """
+        if tolerant and judge_result not in ("是", "不是"):
+            is_title_page = parse_judge_answer(judge_result)
+            if is_title_page is not None:
+                LOGGER.warning("judge_result is not exactly 是/不是, judge_result: %s, parsed: %s", judge_result,
+                               is_title_page)
+                judge_result = "是" if is_title_page else "不是"
         if judge_result == "是":
             LOGGER.info("is_title_page return, res_content:\n%s\njudge_result:\n%s\nreturn True", res_content, judge_result)
             return True
@@ -258,4 +1570,3 @@ class LLMBookmark:
         else:
             LOGGER.error(f"judge_result cannot be 是/不是, judge_result: {judge_result}")
             raise ValueError(f"judge_result cannot be 是/不是, judge_result: {judge_result}")
-
@@ -0,0 +1,59 @@
+import json
+import logging
+import zlib
+
+from llm_bookmark.contents import normalize_title_name
+
+LOGGER = logging.getLogger(__name__)
+
+CASCADE_RULES = ("parse", "grade", "headings")
+
+
+class VlModelTier:
+    """
+    一档vl模型：模型、配置、限流器、缓存。vl_model是最后一档，其它为vl_cascade.models中配置的较便宜的模型。
+    """
+
+    def __init__(self, name, model_conf, model, rate_limiter, cache):
+        """
+        :param name: 统计时的阶段名，也是计数名的前缀，vl_model为vl_model，其它为vl_{name}
+        """
+        self.name = name
+        self.model_conf = model_conf
+        self.model_name = model_conf["model_name"]
+        self.model = model
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+
+
+def cascade_model_confs(cascade_conf: dict, vl_model_conf: dict):
+    """
+    :return: [(名字，模型配置)]，没写的项沿用vl_model的，缓存文件名默认为vl_model的加上名字
+    """
+    model_confs = []
+    for pos, model_conf in enumerate(cascade_conf.get("models") or []):
+        name = model_conf.get("name") or f"tier{pos}"
+        merged_conf = dict(vl_model_conf, cache_file_name=f'{vl_model_conf["cache_file_name"]}_{name}')
+        merged_conf.update({key: value for key, value in model_conf.items() if key != "name"})
+        model_confs.append((name, merged_conf))
+    return model_confs
+
+
+def is_sampled(page_key, sample_rate):
+    """
+    按页的标识决定是否抽查，同一页每次结果一样，重跑时能命中缓存
+    """
+    if sample_rate <= 0:
+        return False
+    return zlib.crc32(page_key.encode("utf-8")) % 10000 < sample_rate * 10000
+
+
+def response_titles_key(res_content):
+    """
+    :return: 用于比较两个模型结果是否一致的(级别，规范化的标题)列表，解析失败为None
+    """
+    try:
+        response_titles = json.loads(res_content)["最终答案"]
+        return [(title[0], normalize_title_name(title[1])) for title in response_titles]
+    except (ValueError, KeyError, TypeError, IndexError, AttributeError):
+        return None
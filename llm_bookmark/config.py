@@ -1,3 +1,4 @@
+import copy
 import yaml
 from pathlib import Path
 import logging
@@ -14,6 +15,20 @@ class Config:
         return self.conf
 
 
+def merge_conf(base: dict, overrides: dict=None):
+    """
+    :param overrides: 要覆盖的配置，结构与conf.yaml一致，可以只写需要改的项，比如{"bookmark": {"vl_batch_pages": 4}}
+    :return: 合并后的新配置，不会改动base
+    """
+    merged = copy.deepcopy(base)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_conf(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
 conf_path = Path(__file__).parent.parent / "conf.yaml"
 conf = Config(conf_path)
 LOGGER.info("load conf, conf_path: %s, values: %s", conf_path, conf)
\ No newline at end of file
@@ -0,0 +1,89 @@
+import json
+import logging
+import re
+
+import fitz
+
+from llm_bookmark.title_info import Title
+
+LOGGER = logging.getLogger(__name__)
+
+
+def read_embedded_toc(pdf_path, max_title_grade=3):
+    """
+    读取pdf自带的书签（大纲），没有目标页的条目和级别超过max_title_grade的条目会被去掉。
+    :return: 标题列表，pdf没有书签时为空
+    """
+    with fitz.open(pdf_path) as doc:
+        toc = doc.get_toc(simple=True)
+    titles = [Title(grade=grade, title_name=title_name.strip(), abstract="", page_number=page_number)
+              for grade, title_name, page_number in toc
+              if grade <= max_title_grade and page_number >= 1 and title_name.strip()]
+    LOGGER.info('read_embedded_toc return, pdf_path: %s, toc size: %d, titles size: %d',
+                pdf_path, len(toc), len(titles))
+    return titles
+
+
+def parse_contents_response(res_content, max_title_grade=3):
+    """
+    解析contents_page_prompt.txt的返回结果。
+    :return: 是否目录页，目录条目[(标题级别，标题，印刷页码)]，印刷页码不是阿拉伯数字的条目会被去掉
+    """
+    try:
+        res = json.loads(res_content)
+    except json.JSONDecodeError:
+        LOGGER.warning('parse_contents_response failed, res_content: %s', res_content)
+        return False, []
+
+    entries = []
+    for res_entry in res.get("最终答案") or []:
+        match res_entry:
+            case [int(grade), str(title_name), int(printed_page)] if grade <= max_title_grade:
+                entries.append((grade, title_name.strip(), printed_page))
+            case [int(grade), str(title_name), str(printed_page)] if grade <= max_title_grade and \
+                                                                     printed_page.strip().isdigit():
+                entries.append((grade, title_name.strip(), int(printed_page)))
+            case _:
+                LOGGER.info('ignore contents entry: %s', res_entry)
+    return bool(res.get("是目录页")), entries
+
+
+def normalize_title_name(title_name: str):
+    return re.sub(r"[\s\W_]+", "", title_name.lower())
+
+
+def contents_title_match(contents_title_name: str, page_title_name: str):
+    """
+    目录里的标题和正文里的标题经常有细微差别（空格、标点、省略），故去掉空白和标点后比较，较长时允许互相包含。
+    """
+    name1 = normalize_title_name(contents_title_name)
+    name2 = normalize_title_name(page_title_name)
+    if not name1 or not name2:
+        return False
+    if name1 == name2:
+        return True
+    return min(len(name1), len(name2)) >= 4 and (name1 in name2 or name2 in name1)
+
+
+def find_title_in_response(title_name: str, res_content: str):
+    """
+    :param title_name: 目录中的标题
+    :param res_content: 逐页提取标题的返回结果
+    :return: 这一页是否提取出了该标题
+    """
+    try:
+        response_titles = json.loads(res_content)["最终答案"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return False
+    return any(isinstance(res_title, list) and len(res_title) >= 2 and isinstance(res_title[1], str)
+               and contents_title_match(title_name, res_title[1]) for res_title in response_titles)
+
+
+def pick_samples(entries: list, sample_count: int):
+    """
+    从目录条目中均匀地挑出sample_count个用于推算页码偏移，第一个总是第一个条目。
+    """
+    if len(entries) <= sample_count:
+        return list(entries)
+    step = (len(entries) - 1) / (sample_count - 1) if sample_count > 1 else 0
+    return [entries[round(i * step)] for i in range(sample_count)]
@@ -0,0 +1,193 @@
+import base64
+import logging
+import math
+import re
+from threading import Lock
+
+import cv2
+import fitz
+import numpy as np
+
+from llm_bookmark.pdf_tools import calc_size_by_tokens
+from llm_bookmark.vl_tools import encode_image_array
+
+LOGGER = logging.getLogger(__name__)
+
+CONTEXT_TIERS = ("text", "crop", "thumbnail", "full")
+
+# 标题带这些编号时，级别从文字上就能看出来，不需要再看图。
+# 阿拉伯数字只认带点的多级编号(1.2、1.2.3)和1-2位的短编号(1. 1、 1) 1 )，"2024 Annual Report"这种不算；
+# 罗马数字只认后面紧跟.或)的整个词(I. IV))，"Civil War"、"Ill Winds"这种以罗马数字字母开头的普通单词不算
+NUMBERED_TITLE_PATTERN = re.compile(r"^\s*(第[0-9一二三四五六七八九十百零]+[章节篇部讲课]|[一二三四五六七八九十]+、|"
+                                    r"(chapter|part|section)\s+(\d+|[ivxl]+)\b|"
+                                    r"\d{1,3}(\.\d{1,3})+(?![\d.])|"
+                                    r"\d{1,2}([.、)](?!\d)|\s)|"
+                                    r"(?=[ivxl])(xl|l?x{0,3})(ix|iv|v?i{0,3})[.)](?=\s|$))", re.IGNORECASE)
+
+
+def image_tokens(width, height):
+    """
+    qwen-vl的规则，28乘28像素为1个token
+    """
+    return math.ceil(width / 28) * math.ceil(height / 28)
+
+
+def resize_to_tokens(image: np.ndarray, max_tokens):
+    size = calc_size_by_tokens(image.shape[1], image.shape[0], min_pixels=28 * 28, max_pixels=max_tokens * 28 * 28)
+    if size is None:
+        return image
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def crop_title_strips(image: np.ndarray, regions: list[tuple[float, float]], padding=0.01):
+    """
+    :param regions: 标题所在行的(上，下)，占页高的比例
+    :return: 这些行(整页宽，保留缩进)按从上到下拼成的一张图
+    """
+    height = image.shape[0]
+    strips = []
+    for top, bottom in sorted(regions):
+        y0 = max(0, math.floor((top - padding) * height))
+        y1 = min(height, math.ceil((bottom + padding) * height))
+        if y1 > y0:
+            strips.append(image[y0: y1])
+    return np.concatenate(strips, axis=0)
+
+
+class ContextPages:
+    """
+    包装ImageDirPages或PdfPages：目录栈对应的页按选中的形式(缩略图或标题裁剪图)编码，当前页仍是整页。
+    page_key带上形式，path模式的缓存key不会和整页的混淆。
+    """
+
+    def __init__(self, pages, tier, context_indexs: list[int], regions: dict=None, max_tokens=256):
+        self.pages = pages
+        self.tier = tier
+        self.context_indexs = set(context_indexs)
+        self.regions = regions or {}
+        self.max_tokens = max_tokens
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getattr__(self, name):
+        # json_path、pdf_path等直接取被包装的pages的
+        return getattr(self.pages, name)
+
+    def page_name(self, index):
+        return self.pages.page_name(index)
+
+    def page_key(self, index):
+        if index not in self.context_indexs:
+            return self.pages.page_key(index)
+        return f'{self.pages.page_key(index)}#{self.tier}{self.max_tokens}'
+
+    def image_tokens(self, index, max_image_tokens):
+        if index in self.context_indexs:
+            return self.max_tokens
+        if isinstance(self.pages, ContextPages):
+            return self.pages.image_tokens(index, max_image_tokens)
+        return max_image_tokens
+
+    def encode(self, index):
+        if index not in self.context_indexs:
+            return self.pages.encode(index)
+        encoder = self.pages.encoder
+        key = (self.page_key(index), tuple(self.regions.get(index, ())))
+        return encoder.cached(key, lambda: self.render(index))
+
+    def render(self, index):
+        _, image_data = self.pages.encode(index)
+        image = cv2.imdecode(np.frombuffer(base64.b64decode(image_data), np.uint8), cv2.IMREAD_COLOR)
+        if self.tier == "crop":
+            image = crop_title_strips(image, self.regions[index])
+        image = resize_to_tokens(image, self.max_tokens)
+        encoder = self.pages.encoder
+        return encode_image_array(image, encoder.image_format, encoder.quality, encoder.color_mode)
+
+
+class ResolutionPages(ContextPages):
+    """
+    当前页按较低的分辨率档位发送，从已编码(已缓存)的最高档位缩小得到，升档重试时不会再从pdf渲染。
+    """
+
+    def __init__(self, pages, page_indexs: list[int], max_tokens):
+        super().__init__(pages, "resolution", page_indexs, max_tokens=max_tokens)
+
+
+class ContextSelector:
+    """
+    为目录栈对应的页选择最省的、够用的上下文形式，按context_tiers的顺序选第一个够用且不超出预算的：
+    text：只发文字的pre_titles，目录栈中的标题都带编号时才够用；
+    crop：只发标题所在的那几行，需要能在文字层中找到这些标题；
+    thumbnail：缩略图；
+    full：整页，原来的做法。
+    都超出预算时只发文字。
+    """
+
+    def __init__(self, pdf_path=None, tiers: list[str]=("full",), token_budget=0, max_image_tokens=1280,
+                 thumbnail_tokens=256, crop_tokens=256):
+        """
+        :param pdf_path: 用于在文字层中查找标题的位置，为None则crop不可用
+        :param token_budget: 一个请求中上下文图片的token上限，0为不限制
+        """
+        unknown_tiers = [tier for tier in tiers if tier not in CONTEXT_TIERS]
+        if unknown_tiers:
+            raise ValueError(f"context tiers must be in {CONTEXT_TIERS}, unknown: {unknown_tiers}")
+        self.tiers = list(tiers)
+        self.token_budget = token_budget
+        self.max_image_tokens = max_image_tokens
+        self.thumbnail_tokens = thumbnail_tokens
+        self.crop_tokens = crop_tokens
+        self.doc = fitz.open(pdf_path) if pdf_path and "crop" in self.tiers else None
+        self.lock = Lock()
+
+    def find_title_regions(self, title_stack, pre_indexs: list[int]):
+        """
+        :return: {页索引: [(上，下)]}，有一个标题找不到就返回None
+        """
+        if self.doc is None:
+            return None
+        regions = {index: [] for index in pre_indexs}
+        with self.lock:
+            for title in title_stack:
+                page = self.doc[title.page_number - 1]
+                rects = page.search_for(title.title_name.strip()[:60])
+                if not rects:
+                    return None
+                page_height = page.rect.height
+                regions[title.page_number - 1].append((rects[0].y0 / page_height, rects[0].y1 / page_height))
+        return regions
+
+    def select(self, pages, pre_indexs: list[int], title_stack):
+        """
+        :return: 选中的形式，用于请求的pages，要发送的目录栈页索引(text时为空)
+        """
+        for tier in self.tiers:
+            if tier == "text":
+                if all(NUMBERED_TITLE_PATTERN.match(title.title_name) for title in title_stack):
+                    return tier, pages, []
+                continue
+
+            if tier == "crop":
+                regions = self.find_title_regions(title_stack, pre_indexs)
+                if regions is None:
+                    continue
+                cost = len(pre_indexs) * self.crop_tokens
+                request_pages = ContextPages(pages, tier, pre_indexs, regions=regions, max_tokens=self.crop_tokens)
+            elif tier == "thumbnail":
+                cost = len(pre_indexs) * self.thumbnail_tokens
+                request_pages = ContextPages(pages, tier, pre_indexs, max_tokens=self.thumbnail_tokens)
+            else:
+                cost = len(pre_indexs) * self.max_image_tokens
+                request_pages = pages
+            if not self.token_budget or cost <= self.token_budget:
+                return tier, request_pages, pre_indexs
+
+        LOGGER.info("no context tier fits the budget, send pre_titles only, pre_indexs: %s", pre_indexs)
+        return "text", pages, []
+
+    def close(self):
+        if self.doc is not None:
+            with self.lock:
+                self.doc.close()
@@ -0,0 +1,355 @@
+import json
+import logging
+import sqlite3
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+from llm_bookmark.batch import normalize_job
+from llm_bookmark.bookmark import LLMBookmark
+
+LOGGER = logging.getLogger(__name__)
+
+JOB_STATUSES = ("queued", "running", "done", "failed", "canceled")
+JOB_COLUMNS = ("id", "status", "pdf_path", "dest_pdf_path", "skip_page_ranges", "extra_prompt_path", "base_pdf_path",
+               "resume", "conf_overrides", "title_count", "error", "created_at", "started_at", "finished_at")
+JSON_COLUMNS = ("skip_page_ranges", "conf_overrides")
+
+
+class JobStore:
+    """
+    基于sqlite的任务库，任务按提交顺序处理。服务重启后，上次正在处理的任务重新排队，并从中断的地方继续。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                              'status TEXT NOT NULL, pdf_path TEXT NOT NULL, dest_pdf_path TEXT NOT NULL, '
+                              'skip_page_ranges TEXT, extra_prompt_path TEXT, base_pdf_path TEXT, '
+                              'resume INTEGER NOT NULL DEFAULT 0, conf_overrides TEXT, title_count INTEGER, '
+                              'error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+            self.conn.commit()
+
+    @staticmethod
+    def to_record(row):
+        if row is None:
+            return None
+        record = dict(zip(JOB_COLUMNS, row))
+        for column in JSON_COLUMNS:
+            record[column] = json.loads(record[column]) if record[column] else None
+        record["resume"] = bool(record["resume"])
+        return record
+
+    def submit(self, job: dict):
+        """
+        :param job: normalize_job的结果，再加上base_pdf_path、resume、conf_overrides
+        :return: 任务id
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                'INSERT INTO jobs (status, pdf_path, dest_pdf_path, skip_page_ranges, extra_prompt_path, '
+                'base_pdf_path, resume, conf_overrides, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ("queued", job["pdf_path"], job["dest_pdf_path"],
+                 json.dumps(job["skip_page_ranges"]) if job["skip_page_ranges"] else None,
+                 job["extra_prompt_path"], job.get("base_pdf_path"), int(job.get("resume", False)),
+                 json.dumps(job["conf_overrides"], ensure_ascii=False) if job.get("conf_overrides") else None,
+                 time.time()))
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def claim(self):
+        """
+        取出最早提交的排队中的任务，并标记为running。
+        同一个pdf的图片文件夹和日志是共用的，所以同一个pdf同时只处理一个任务，其它的继续排队。
+        :return: 任务，没有可以处理的任务时为None
+        """
+        with self.lock:
+            row = self.conn.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE status = ? AND pdf_path NOT IN '
+                                    f'(SELECT pdf_path FROM jobs WHERE status = ?) ORDER BY id LIMIT 1',
+                                    ("queued", "running")).fetchone()
+            if row is None:
+                return None
+            started_at = time.time()
+            self.conn.execute('UPDATE jobs SET status = ?, started_at = ? WHERE id = ?', ("running", started_at, row[0]))
+            self.conn.commit()
+        record = self.to_record(row)
+        record.update(status="running", started_at=started_at)
+        return record
+
+    def finish(self, job_id, status, title_count=None, error=None):
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET status = ?, title_count = ?, error = ?, finished_at = ? WHERE id = ?',
+                              (status, title_count, error, time.time(), job_id))
+            self.conn.commit()
+
+    def cancel(self, job_id):
+        """
+        只能取消排队中的任务
+        :return: 是否取消成功
+        """
+        with self.lock:
+            cursor = self.conn.execute('UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?',
+                                       ("canceled", time.time(), job_id, "queued"))
+            self.conn.commit()
+            return cursor.rowcount == 1
+
+    def requeue_running(self):
+        """
+        服务启动时调用：上次被中断的任务重新排队，并打开resume，已处理的页从日志中读取
+        :return: 重新排队的任务数
+        """
+        with self.lock:
+            cursor = self.conn.execute('UPDATE jobs SET status = ?, resume = 1, started_at = NULL WHERE status = ?',
+                                       ("queued", "running"))
+            self.conn.commit()
+            return cursor.rowcount
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.conn.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self.to_record(row)
+
+    def list(self, status=None, limit=100):
+        sql = f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs'
+        params = []
+        if status:
+            sql += ' WHERE status = ?'
+            params.append(status)
+        sql += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [self.to_record(row) for row in rows]
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict({status: 0 for status in JOB_STATUSES}, **dict(rows))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class BookmarkDaemon:
+    """
+    常驻服务：启动时创建好LLMBookmark(模型客户端、缓存)和pdf转图片的进程池，之后每个任务只花处理页的时间。
+    任务可以带conf_overrides，同样的conf_overrides共用一个LLMBookmark，最多保留max_warm_instances个(不含默认配置的那个)，
+    所有LLMBookmark共用缓存和模型请求并发上限。
+    """
+
+    def __init__(self, store: JobStore, max_concurrent_docs=2, max_inflight_requests=8, render_workers=8,
+                 max_warm_instances=4, dest_suffix="_带书签"):
+        self.store = store
+        self.max_concurrent_docs = max_concurrent_docs
+        self.render_workers = render_workers
+        self.max_warm_instances = max_warm_instances
+        self.dest_suffix = dest_suffix
+        self.request_semaphore = BoundedSemaphore(max_inflight_requests)
+        self.cache_pool = {}
+        self.instances = OrderedDict()
+        self.instances_lock = Lock()
+        self.job_ready = Condition()
+        self.stopping = Event()
+        self.workers = []
+        self.render_executor = None
+        self.default_bookmarkor = self.create_bookmarkor(None)
+
+    def create_bookmarkor(self, conf_overrides):
+        llm_bookmarkor = LLMBookmark(conf_overrides=conf_overrides, cache_pool=self.cache_pool)
+        llm_bookmarkor.request_semaphore = self.request_semaphore
+        return llm_bookmarkor
+
+    def get_bookmarkor(self, conf_overrides: dict=None):
+        if not conf_overrides:
+            return self.default_bookmarkor
+        key = json.dumps(conf_overrides, ensure_ascii=False, sort_keys=True)
+        with self.instances_lock:
+            if key in self.instances:
+                self.instances.move_to_end(key)
+                return self.instances[key]
+            LOGGER.info('create warm instance, conf_overrides: %s', key)
+            llm_bookmarkor = self.create_bookmarkor(conf_overrides)
+            self.instances[key] = llm_bookmarkor
+            while len(self.instances) > self.max_warm_instances:
+                self.instances.popitem(last=False)
+            return llm_bookmarkor
+
+    def submit(self, raw_job: dict):
+        """
+        :param raw_job: 与batch_bookmark.py任务清单中的一行一样，另外可以带base_pdf_path、resume、conf_overrides
+        :return: 任务id
+        """
+        if not raw_job.get("pdf_path"):
+            raise ValueError("pdf_path is required")
+        conf_overrides = raw_job.get("conf_overrides")
+        if conf_overrides is not None and not isinstance(conf_overrides, dict):
+            raise ValueError("conf_overrides must be an object")
+        job = normalize_job(raw_job, dest_suffix=self.dest_suffix)
+        job.update(base_pdf_path=raw_job.get("base_pdf_path"), resume=bool(raw_job.get("resume", False)),
+                   conf_overrides=conf_overrides)
+        # 配置有误时在提交时就报错，而不是等到处理时
+        self.get_bookmarkor(conf_overrides)
+        job_id = self.store.submit(job)
+        LOGGER.info('submit job, job_id: %d, job: %s', job_id, job)
+        with self.job_ready:
+            self.job_ready.notify()
+        return job_id
+
+    def run_job(self, job):
+        LOGGER.info('run_job enter, job: %s', job)
+        try:
+            llm_bookmarkor = self.get_bookmarkor(job["conf_overrides"])
+            extra_prompt = llm_bookmarkor.load_prompt_from_path(job["extra_prompt_path"]) \
+                if job["extra_prompt_path"] else None
+            skip_page_ranges = [tuple(page_range) for page_range in job["skip_page_ranges"]] \
+                if job["skip_page_ranges"] else None
+            bookmarks = llm_bookmarkor.do_bookmark(job["pdf_path"], job["dest_pdf_path"],
+                                                   skip_page_ranges=skip_page_ranges, extra_prompt=extra_prompt,
+                                                   executor=self.render_executor, resume=job["resume"],
+                                                   base_pdf_path=job["base_pdf_path"])
+            self.store.finish(job["id"], "done", title_count=len(bookmarks))
+        except Exception as e:
+            LOGGER.error('run_job failed, job: %s\n%s', job, traceback.format_exc())
+            self.store.finish(job["id"], "failed", error=f"{type(e).__name__}: {e}")
+        LOGGER.info('run_job return, job_id: %d, seconds: %.2f', job["id"], time.time() - job["started_at"])
+
+    def work(self):
+        while not self.stopping.is_set():
+            job = self.store.claim()
+            if job is None:
+                with self.job_ready:
+                    self.job_ready.wait(timeout=1)
+                continue
+            self.run_job(job)
+
+    def start(self):
+        requeued = self.store.requeue_running()
+        LOGGER.info('start daemon, requeued jobs: %d, counts: %s', requeued, self.store.counts())
+        self.render_executor = ProcessPoolExecutor(max_workers=self.render_workers)
+        self.workers = [Thread(target=self.work, name=f'bookmark_worker_{pos}', daemon=True)
+                        for pos in range(self.max_concurrent_docs)]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """
+        等正在处理的任务完成后返回，排队中的任务留在任务库中，下次启动继续处理
+        """
+        self.stopping.set()
+        with self.job_ready:
+            self.job_ready.notify_all()
+        for worker in self.workers:
+            worker.join()
+        if self.render_executor is not None:
+            self.render_executor.shutdown()
+        LOGGER.info('stop daemon, counts: %s', self.store.counts())
+
+    def status(self):
+        with self.instances_lock:
+            warm_instances = len(self.instances) + 1
+        return {"jobs": self.store.counts(), "warm_instances": warm_instances, "workers": len(self.workers)}
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs：提交任务，返回{"id": 任务id}
+    GET /jobs/{id}：查询任务状态和结果
+    GET /jobs?status=queued&limit=100：按提交时间倒序列出任务
+    DELETE /jobs/{id}：取消排队中的任务
+    GET /status：各状态的任务数等
+    """
+    daemon: BookmarkDaemon = None
+
+    def log_message(self, format, *args):
+        LOGGER.debug('%s %s', self.address_string(), format % args)
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_job_id(self, path):
+        """
+        :return: /jobs/{id}中的id，路径不是这种形式时为None
+        """
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/status':
+            return self.send_json(HTTPStatus.OK, self.daemon.status())
+        if url.path.rstrip('/') == '/jobs':
+            query = parse_qs(url.query)
+            status = query.get('status', [None])[0]
+            if status and status not in JOB_STATUSES:
+                return self.send_json(HTTPStatus.BAD_REQUEST, {"error": f"status must be in {JOB_STATUSES}"})
+            try:
+                limit = int(query.get('limit', ['100'])[0])
+            except ValueError:
+                limit = -1
+            if limit < 0:
+                return self.send_json(HTTPStatus.BAD_REQUEST, {"error": "limit must be a non-negative integer"})
+            return self.send_json(HTTPStatus.OK, self.daemon.store.list(status=status, limit=limit))
+        job_id = self.get_job_id(url.path)
+        if job_id is None:
+            return self.send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown path: {url.path}"})
+        job = self.daemon.store.get(job_id)
+        if job is None:
+            return self.send_json(HTTPStatus.NOT_FOUND, {"error": f"job not found: {job_id}"})
+        return self.send_json(HTTPStatus.OK, job)
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            return self.send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown path: {self.path}"})
+        try:
+            raw_job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(raw_job, dict):
+                raise ValueError("job must be an object")
+            job_id = self.daemon.submit(raw_job)
+        except Exception as e:
+            LOGGER.warning('submit job failed, path: %s, error: %s', self.path, e)
+            return self.send_json(HTTPStatus.BAD_REQUEST, {"error": f"{type(e).__name__}: {e}"})
+        return self.send_json(HTTPStatus.CREATED, {"id": job_id, "status": "queued"})
+
+    def do_DELETE(self):
+        job_id = self.get_job_id(urlparse(self.path).path)
+        if job_id is None:
+            return self.send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown path: {self.path}"})
+        if not self.daemon.store.cancel(job_id):
+            return self.send_json(HTTPStatus.CONFLICT, {"error": f"job is not queued: {job_id}"})
+        return self.send_json(HTTPStatus.OK, self.daemon.store.get(job_id))
+
+
+def serve(daemon: BookmarkDaemon, host="127.0.0.1", port=8765):
+    """
+    启动任务处理线程和http服务，阻塞到Ctrl+C为止
+    """
+    handler = type('BoundDaemonRequestHandler', (DaemonRequestHandler,), {"daemon": daemon})
+    server = ThreadingHTTPServer((host, port), handler)
+    daemon.start()
+    LOGGER.info('serve enter, address: http://%s:%d', host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        LOGGER.info('serve interrupted')
+    finally:
+        server.server_close()
+        daemon.stop()
+    LOGGER.info('serve return')
@@ -0,0 +1,181 @@
+import asyncio
+import gzip
+import importlib.util
+import json
+import logging
+import weakref
+from threading import Lock
+
+import httpx
+
+LOGGER = logging.getLogger(__name__)
+
+TRANSPORTS = ("langchain", "http")
+
+_client_pool = {}
+_async_client_pool = weakref.WeakKeyDictionary()
+_client_pool_lock = Lock()
+_http2_warned = False
+# json字符串中必须转义的字符：控制字符、引号、反斜杠
+JSON_ESCAPE_BYTES = bytes(range(0x20)) + b'"\\'
+
+
+class ChatMessage:
+    """
+    模型返回的消息，与langchain的AIMessage一样有content和usage_metadata，remove_think_from_message、metrics.record_usage可以直接用
+    """
+
+    def __init__(self, content: str, usage_metadata: dict=None):
+        self.content = content
+        self.usage_metadata = usage_metadata
+
+
+class HttpStatusError(Exception):
+    """
+    非2xx的响应，status_code为408、409、429或5xx时rate_limiter.is_retryable_error会重试
+    """
+
+    def __init__(self, status_code, text):
+        super().__init__(f"http status {status_code}: {text[:500]}")
+        self.status_code = status_code
+
+
+def http2_available():
+    return importlib.util.find_spec("h2") is not None
+
+
+def get_client_options(model_conf):
+    global _http2_warned
+    http2 = model_conf.get("http2", True)
+    if http2 and not http2_available():
+        if not _http2_warned:
+            LOGGER.info("h2 is not installed, use HTTP/1.1 keep-alive instead, pip install httpx[http2] to enable it")
+            _http2_warned = True
+        http2 = False
+    pool_size = model_conf.get("http_pool_size", 32)
+    return (model_conf["openai_api_base"], model_conf["timeout"], http2, pool_size)
+
+
+def create_client(client_class, options):
+    _, timeout, http2, pool_size = options
+    return client_class(http2=http2, timeout=timeout,
+                        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+
+
+def get_client(model_conf) -> httpx.Client:
+    """
+    同一个进程内，openai_api_base、timeout等相同的模型共用一个连接池(keep-alive)
+    """
+    options = get_client_options(model_conf)
+    with _client_pool_lock:
+        if options not in _client_pool:
+            _client_pool[options] = create_client(httpx.Client, options)
+        return _client_pool[options]
+
+
+def get_async_client(model_conf) -> httpx.AsyncClient:
+    """
+    异步连接池绑定在事件循环上，每个事件循环各用一个，事件循环结束后随之释放
+    """
+    options = get_client_options(model_conf)
+    loop = asyncio.get_running_loop()
+    with _client_pool_lock:
+        loop_clients = _async_client_pool.setdefault(loop, {})
+        if options not in loop_clients:
+            loop_clients[options] = create_client(httpx.AsyncClient, options)
+        return loop_clients[options]
+
+
+def write_json(value, chunks: list):
+    """
+    把value按json格式逐段写入chunks。data:开头的图片(base64)不需要转义，直接编码写入，省去json.dumps对大字符串的扫描和复制
+    """
+    if isinstance(value, dict):
+        chunks.append(b"{")
+        for pos, (key, item) in enumerate(value.items()):
+            if pos:
+                chunks.append(b",")
+            chunks.append(json.dumps(key, ensure_ascii=False).encode("utf-8"))
+            chunks.append(b":")
+            write_json(item, chunks)
+        chunks.append(b"}")
+    elif isinstance(value, list):
+        chunks.append(b"[")
+        for pos, item in enumerate(value):
+            if pos:
+                chunks.append(b",")
+            write_json(item, chunks)
+        chunks.append(b"]")
+    elif isinstance(value, str) and value.startswith("data:") and value.isascii():
+        data = value.encode("ascii")
+        # 正常的base64不会有需要转义的字符，有则说明不是，仍交给json.dumps
+        if len(data.translate(None, JSON_ESCAPE_BYTES)) == len(data):
+            chunks.extend((b'"', data, b'"'))
+        else:
+            chunks.append(json.dumps(value).encode("ascii"))
+    else:
+        chunks.append(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+
+def encode_chat_body(model_name, messages: list[dict], temperature):
+    chunks = []
+    write_json({"model": model_name, "messages": messages, "temperature": temperature, "stream": False}, chunks)
+    return b"".join(chunks)
+
+
+def parse_chat_response(response: httpx.Response):
+    if response.status_code >= 400:
+        raise HttpStatusError(response.status_code, response.text)
+    res = response.json()
+    content = res["choices"][0]["message"].get("content") or ""
+    usage = res.get("usage")
+    usage_metadata = {"input_tokens": usage.get("prompt_tokens", 0), "output_tokens": usage.get("completion_tokens", 0),
+                      "total_tokens": usage.get("total_tokens", 0)} if usage else None
+    return ChatMessage(content, usage_metadata)
+
+
+class HttpChatModel:
+    """
+    直接调OpenAI兼容的/chat/completions，接口与ChatOpenAI一样是invoke/ainvoke，输入为openai格式的消息列表。
+    不经过langchain的消息对象转换，请求体中的图片直接写入，连接池在同一进程内共用，可选HTTP/2和gzip压缩请求体。
+    只用非流式输出，conf中的streaming不起作用。
+    """
+
+    def __init__(self, model_conf, post_process=None):
+        """
+        :param post_process: 对返回的消息再做一次处理，比如remove_think_from_message
+        """
+        self.model_conf = model_conf
+        self.model_name = model_conf["model_name"]
+        self.temperature = model_conf["temperature"]
+        self.url = model_conf["openai_api_base"].rstrip("/") + "/chat/completions"
+        self.gzip = model_conf.get("http_gzip", False)
+        self.headers = {"Authorization": f'Bearer {model_conf["openai_api_key"]}',
+                        "Content-Type": "application/json"}
+        if self.gzip:
+            self.headers["Content-Encoding"] = "gzip"
+        self.post_process = post_process
+
+    def encode_body(self, messages: list[dict]):
+        body = encode_chat_body(self.model_name, messages, self.temperature)
+        return gzip.compress(body, compresslevel=1) if self.gzip else body
+
+    def finish(self, response: httpx.Response):
+        message = parse_chat_response(response)
+        return self.post_process(message) if self.post_process else message
+
+    def invoke(self, messages: list[dict]):
+        body = self.encode_body(messages)
+        try:
+            response = get_client(self.model_conf).post(self.url, content=body, headers=self.headers)
+        except httpx.TimeoutException as e:
+            raise TimeoutError(f"request timeout, url: {self.url}") from e
+        return self.finish(response)
+
+    async def ainvoke(self, messages: list[dict]):
+        body = self.encode_body(messages)
+        try:
+            response = await get_async_client(self.model_conf).post(self.url, content=body, headers=self.headers)
+        except httpx.TimeoutException as e:
+            raise TimeoutError(f"request timeout, url: {self.url}") from e
+        return self.finish(response)
@@ -0,0 +1,69 @@
+import difflib
+import hashlib
+import logging
+
+import fitz
+
+LOGGER = logging.getLogger(__name__)
+
+
+def page_content_hashes(pdf_path, indexs: list[int]=None):
+    """
+    按页计算内容hash：页面内容流，加上页面引用的图片的原始数据。扫描件每页的内容流几乎一样，区别都在图片里。
+    同一张图片被多页引用时只读取一次。
+    :param indexs: 只算这些页，可以是负数(从后往前数)，超出范围的忽略，为None则算所有页
+    :return: 每页的hash
+    """
+    page_hashes = []
+    image_hashes = {}
+    with fitz.open(pdf_path) as doc:
+        pages = doc if indexs is None else [doc[index] for index in indexs
+                                            if -doc.page_count <= index < doc.page_count]
+        for page in pages:
+            page_hash = hashlib.sha256(page.read_contents())
+            for image in page.get_images(full=True):
+                xref = image[0]
+                if xref not in image_hashes:
+                    image_hashes[xref] = hashlib.sha256(doc.xref_stream_raw(xref) or b"").hexdigest()
+                page_hash.update(image_hashes[xref].encode("utf-8"))
+            page_hashes.append(page_hash.hexdigest())
+    LOGGER.info('page_content_hashes return, pdf_path: %s, pages: %d', pdf_path, len(page_hashes))
+    return page_hashes
+
+
+def align_pages(old_hashes: list[str], new_hashes: list[str]):
+    """
+    用diff对齐新旧两版的页序列，插入、删除、修改的页都对不上。
+    :return: {新页索引: 旧页索引}，只包含内容没变的页
+    """
+    matcher = difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False)
+    page_map = {}
+    for old_start, new_start, size in matcher.get_matching_blocks():
+        for offset in range(size):
+            page_map[new_start + offset] = old_start + offset
+    return page_map
+
+
+def carry_over_titles(old_hashes: list[str], old_records: list[dict], new_hashes: list[str]):
+    """
+    沿用上一版中内容没变的页的标题。变了的页，以及紧跟在它们或被删除的页后面的页(标题可能从前一页延续过来、级别要参照前一页)，
+    都不沿用，需要重新调vl_model。上一版没处理过的页(比如跳过的页)也不沿用。
+    :param old_records: 上一版的日志记录，{"index": 页索引, "titles": [[标题级别，标题，内容概括]]}
+    :return: {新页索引: [[标题级别，标题，内容概括]]}
+    """
+    page_map = align_pages(old_hashes, new_hashes)
+    old_titles = {record["index"]: record["titles"] for record in old_records}
+    changed_indexs = set(range(len(new_hashes))) - set(page_map)
+    rerun_indexs = changed_indexs | {index + 1 for index in changed_indexs}
+    # 对上的旧页索引不连续，说明前面有页被删除了
+    pre_old_index = -1
+    for new_index in sorted(page_map):
+        if page_map[new_index] != pre_old_index + 1:
+            rerun_indexs.add(new_index)
+        pre_old_index = page_map[new_index]
+
+    carried_titles = {new_index: old_titles[old_index] for new_index, old_index in page_map.items()
+                      if new_index not in rerun_indexs and old_index in old_titles}
+    LOGGER.info('carry_over_titles return, old pages: %d, new pages: %d, changed: %d, carried: %d',
+                len(old_hashes), len(new_hashes), len(changed_indexs), len(carried_titles))
+    return carried_titles
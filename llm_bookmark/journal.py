@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+
+
+def get_journal_path(json_path):
+    json_path = Path(json_path)
+    return json_path.parent / (json_path.stem + ".journal.jsonl")
+
+
+def fingerprint(value):
+    """
+    :param value: 可以json序列化的值
+    :return: 它的hash，写在日志头部，续跑时比对
+    """
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_journal(journal_path):
+    """
+    读取日志，第一行为头部，之后每行是一页的处理结果。进程被杀时最后一行可能只写了一半，直接忽略。
+    :return: 头部，每页的处理结果(按处理顺序)，日志不存在或版本不对时头部为None
+    """
+    journal_path = Path(journal_path)
+    if not journal_path.exists():
+        return None, []
+
+    header = None
+    records = []
+    # 最后一行可能断在多字节字符中间，解码失败的字节替换掉，这一行随后会因为json解析失败被忽略
+    with open(journal_path, 'rt', encoding='utf-8', errors='replace') as f:
+        lines = f.read().splitlines()
+    for line_no, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            LOGGER.warning('ignore broken journal line, journal_path: %s, line_no: %d', journal_path, line_no)
+            break
+        if line_no == 0:
+            if record.get("version") != JOURNAL_VERSION:
+                LOGGER.warning('journal version mismatch, ignore it, journal_path: %s', journal_path)
+                return None, []
+            header = record
+            continue
+        records.append(record)
+    return header, records
+
+
+def load_journal_records(journal_path, page_count, page_hashes=None, fingerprints: dict=None):
+    """
+    读取日志用于续跑。
+    :param page_count: 本次的总页数，与头部不一致说明不是同一本书，返回空
+    :param page_hashes: 本次各页的hash，不为空且头部中也有时，两者不一致也返回空
+    :param fingerprints: 本次的指纹，{"source": 书的指纹, "config": 配置的指纹}，不为空时与头部中的任一项不一致
+        (比如页数相同的另一本书或另一版，改了跳过的页或额外提示词)也返回空，头部中没有指纹的旧日志同样不回放
+    :return: 每页的处理结果，按处理顺序
+    """
+    header, records = load_journal(journal_path)
+    if header is None:
+        return []
+    if header.get("page_count") != page_count or \
+            (page_hashes and header.get("page_hashes") and header["page_hashes"] != page_hashes):
+        LOGGER.warning('journal header mismatch, ignore it, journal_path: %s, page_count: %s',
+                       journal_path, header.get("page_count"))
+        return []
+    if fingerprints:
+        mismatched = [name for name, value in fingerprints.items()
+                      if (header.get("fingerprints") or {}).get(name) != value]
+        if mismatched:
+            LOGGER.warning('journal fingerprint mismatch, not resume, process from the beginning, journal_path: %s, '
+                           'mismatched: %s', journal_path, mismatched)
+            return []
+    return records
+
+
+class PageJournal:
+    """
+    逐页追加写的处理日志(jsonl)，每行记录一页的页索引、模型原始返回内容和这一页最终采用的标题。
+    为了不拖慢处理速度，不是每行都fsync，而是每fsync_every行或者距上次fsync超过fsync_seconds秒才fsync一次，
+    进程被杀最多丢最近几页，续跑时重新处理即可。
+    """
+
+    def __init__(self, journal_path, page_count, resume=False, fsync_every=16, fsync_seconds=2.0, page_hashes=None,
+                 fingerprints: dict=None):
+        """
+        :param journal_path:
+        :param page_count: 总页数，写在头部，续跑时用于校验
+        :param resume: 为true则读取已有的日志用于续跑，并在其后继续追加；否则清空重写
+        :param fsync_every: 每写多少行fsync一次
+        :param fsync_seconds: 距上次fsync超过多少秒，写下一行时fsync
+        :param page_hashes: 各页内容的hash，写在头部，下次增量处理时用于比对哪些页变了
+        :param fingerprints: 书和配置的指纹，写在头部，续跑时用于校验，见load_journal_records
+        """
+        self.journal_path = Path(journal_path)
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self.records = load_journal_records(self.journal_path, page_count, page_hashes, fingerprints) if resume else []
+
+        # 先把头部和已读出的记录写到临时文件再替换，去掉写了一半的最后一行，替换前被杀也不会丢失原来的日志
+        tmp_path = self.journal_path.with_name(self.journal_path.name + '.tmp')
+        with open(tmp_path, 'wt', encoding='utf-8', newline='') as f:
+            header = {"version": JOURNAL_VERSION, "page_count": page_count}
+            if page_hashes:
+                header["page_hashes"] = page_hashes
+            if fingerprints:
+                header["fingerprints"] = fingerprints
+            f.write(json.dumps(header) + '\n')
+            for record in self.records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+        self.file = open(self.journal_path, 'at', encoding='utf-8', newline='')
+        self.unsynced = 0
+        self.last_fsync_time = time.monotonic()
+        LOGGER.info('PageJournal init, journal_path: %s, resume: %s, records: %d',
+                    self.journal_path, resume, len(self.records))
+
+    def append(self, index, res_content, response_titles: list, error=None):
+        """
+        :param index: 页索引
+        :param res_content: 模型返回的原始内容，文字层等不调模型的页为None
+        :param response_titles: 这一页最终加入书签的标题，[[标题级别，标题，内容概括]]
+        :param error: tolerant模式下被隔离的页的错误信息，续跑时重新加入待检查的列表
+        """
+        record = {"index": index, "res_content": res_content, "titles": response_titles}
+        if error:
+            record["error"] = error
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every or time.monotonic() - self.last_fsync_time >= self.fsync_seconds:
+            self.fsync()
+
+    def fsync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_fsync_time = time.monotonic()
+
+    def close(self):
+        if not self.file.closed:
+            self.fsync()
+            self.file.close()
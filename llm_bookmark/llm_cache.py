@@ -1,7 +1,9 @@
 from threading import Lock
 from pathlib import Path
 import logging
-from collections import defaultdict
+import hashlib
+import sqlite3
+from collections import defaultdict, OrderedDict
 
 LOGGER = logging.getLogger(__name__)
 
@@ -129,3 +131,243 @@ class LLmCache:
 
     def __contains__(self, k):
         return k in self.cache_dict
+
+
+def iter_text_cache(cache_path):
+    """
+    流式读取LLmCache的文本格式缓存文件，逐条返回(key, value)，不会把整个文件读进内存。
+    """
+    read_state = 'k_start'
+    key_lines = []
+    value_lines = []
+    with open(cache_path, 'rt', encoding='utf-8', newline='') as f:
+        for line in f:
+            line = line[:-1] if line.endswith('\n') else line
+            marker = line.strip()
+            if read_state == 'k_start':
+                if not marker:
+                    LOGGER.warning(f'get empty line when look for k_start, finish read, cache_path: {cache_path}')
+                    return
+                if marker != '|*||*||*|key_start|*||*||*|':
+                    raise ValueError(f'not found key_start, cache_path: {cache_path}, line: {line}')
+                read_state = 'k_value'
+                key_lines = []
+            elif read_state == 'k_value':
+                if marker == '|*||*||*|key_end|*||*||*|':
+                    read_state = 'v_start'
+                else:
+                    key_lines.append(line)
+            elif read_state == 'v_start':
+                if marker != '|*||*||*|value_start|*||*||*|':
+                    raise ValueError(f'not found value_start, cache_path: {cache_path}, line: {line}')
+                read_state = 'v_value'
+                value_lines = []
+            else:
+                if marker == '|*||*||*|value_end|*||*||*|':
+                    read_state = 'k_start'
+                    yield '\n'.join(key_lines), '\n'.join(value_lines)
+                else:
+                    value_lines.append(line)
+
+    if read_state != 'k_start':
+        raise ValueError(f'incomplete cache entry at end of file, cache_path: {cache_path}, read_state: {read_state}')
+
+
+class SqliteLLmCache:
+    """
+    基于sqlite的缓存，接口与LLmCache一致。
+    key和value都只存在磁盘上，启动时不加载任何数据，查询时按需读取，内存中只保留最近用过的lru_size条value。
+    相同的value只存一份（按hash去重），可以用compact清理不再被引用的value并回收磁盘空间。
+    """
+    lock_pool = LLmCache.lock_pool
+
+    def __init__(self, cache_name, lru_size=1024):
+        cache_dir = Path(__file__).parent.parent / 'cache'
+        cache_dir.mkdir(exist_ok=True)
+        self.cache_path = (cache_dir / (cache_name + '.sqlite')).resolve()
+        self.lock = SqliteLLmCache.lock_pool[str(self.cache_path)]
+        self.lru_size = lru_size
+        self.hot_values = OrderedDict()
+
+        is_new = not self.cache_path.exists()
+        self.conn = sqlite3.connect(str(self.cache_path), check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cache_keys '
+                              '(key_hash TEXT PRIMARY KEY, key TEXT NOT NULL, value_hash TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cache_values '
+                              '(value_hash TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.conn.commit()
+
+        # 第一次使用sqlite时，如果同名的文本缓存存在，则自动导入，之前的缓存不会浪费
+        text_cache_path = cache_dir / cache_name
+        if is_new and text_cache_path.exists():
+            self.import_text_cache(text_cache_path)
+
+    @staticmethod
+    def hash_str(s):
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+    def _remember(self, key_hash, v):
+        self.hot_values[key_hash] = v
+        self.hot_values.move_to_end(key_hash)
+        while len(self.hot_values) > self.lru_size:
+            self.hot_values.popitem(last=False)
+
+    def reload(self):
+        with self.lock:
+            self.hot_values.clear()
+
+    def save_all(self):
+        with self.lock:
+            self.conn.commit()
+
+    def _save(self, k, v):
+        key_hash = self.hash_str(k)
+        value_hash = self.hash_str(v)
+        self.conn.execute('INSERT OR IGNORE INTO cache_values (value_hash, value) VALUES (?, ?)', (value_hash, v))
+        self.conn.execute('INSERT OR REPLACE INTO cache_keys (key_hash, key, value_hash) VALUES (?, ?, ?)',
+                          (key_hash, k, value_hash))
+        return key_hash
+
+    def save_one(self, k, v):
+        with self.lock:
+            key_hash = self._save(k, v)
+            self.conn.commit()
+            self._remember(key_hash, v)
+
+    def get(self, k):
+        key_hash = self.hash_str(k)
+        with self.lock:
+            if key_hash in self.hot_values:
+                self.hot_values.move_to_end(key_hash)
+                return self.hot_values[key_hash]
+
+            row = self.conn.execute('SELECT cache_values.value FROM cache_keys JOIN cache_values '
+                                    'ON cache_keys.value_hash = cache_values.value_hash '
+                                    'WHERE cache_keys.key_hash = ?', (key_hash,)).fetchone()
+            if row is None:
+                return None
+            self._remember(key_hash, row[0])
+            return row[0]
+
+    def __contains__(self, k):
+        key_hash = self.hash_str(k)
+        with self.lock:
+            if key_hash in self.hot_values:
+                return True
+            return self.conn.execute('SELECT 1 FROM cache_keys WHERE key_hash = ?', (key_hash,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM cache_keys').fetchone()[0]
+
+    def iter_keys(self):
+        with self.lock:
+            keys = [row[0] for row in self.conn.execute('SELECT key FROM cache_keys')]
+        yield from keys
+
+    def import_text_cache(self, text_cache_path, batch_size=1000):
+        """
+        导入LLmCache的文本格式缓存文件，同一个key以文件中最后出现的为准（与LLmCache.reload一致）。
+        """
+        LOGGER.info('import_text_cache enter, text_cache_path: %s, cache_path: %s', text_cache_path, self.cache_path)
+        count = 0
+        with self.lock:
+            for k, v in iter_text_cache(text_cache_path):
+                self._save(k, v)
+                count += 1
+                if count % batch_size == 0:
+                    self.conn.commit()
+            self.conn.commit()
+        LOGGER.info('import_text_cache return, count: %d', count)
+        return count
+
+    def compact(self):
+        """
+        离线压缩：删除不再被任何key引用的value，然后VACUUM回收磁盘空间。
+        """
+        LOGGER.info('compact enter, cache_path: %s', self.cache_path)
+        with self.lock:
+            deleted = self.conn.execute('DELETE FROM cache_values WHERE value_hash NOT IN '
+                                        '(SELECT value_hash FROM cache_keys)').rowcount
+            self.conn.commit()
+            self.conn.execute('VACUUM')
+        LOGGER.info('compact return, deleted values: %d', deleted)
+        return deleted
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def create_llm_cache(cache_name, backend='text', lru_size=1024):
+    """
+    :param cache_name: 缓存文件名，缓存文件夹为项目根目录下的cache目录
+    :param backend: text：LLmCache，启动时全量读入内存；sqlite：SqliteLLmCache，按需读取，内存占用有上限
+    :param lru_size: sqlite模式下内存中保留的value条数
+    :return:
+    """
+    if backend == 'text':
+        return LLmCache(cache_name)
+    elif backend == 'sqlite':
+        return SqliteLLmCache(cache_name, lru_size=lru_size)
+    else:
+        raise ValueError(f'unknown cache backend: {backend}')
+
+
+def inspect_cache(cache_name, backend='text', contains=None, limit=20):
+    """
+    查看缓存的概况，不会把文本缓存整个读进内存
+    :param contains: 只列出包含此字符串的key
+    :param limit: 最多列出几个key
+    :return: 缓存文件路径，大小，条数(文本缓存中同一个key可能出现多次，以最后一次为准)，列出的key
+    """
+    cache_dir = Path(__file__).parent.parent / 'cache'
+    if backend == 'text':
+        cache_path = cache_dir / cache_name
+        if not cache_path.exists():
+            raise FileNotFoundError(f'cache not found: {cache_path}')
+        keys = (k for k, _ in iter_text_cache(cache_path))
+    elif backend == 'sqlite':
+        cache_path = cache_dir / (cache_name + '.sqlite')
+        if not cache_path.exists():
+            raise FileNotFoundError(f'cache not found: {cache_path}')
+        sqlite_cache = SqliteLLmCache(cache_name)
+        keys = sqlite_cache.iter_keys()
+    else:
+        raise ValueError(f'unknown cache backend: {backend}')
+
+    key_hashes = set()
+    entries = 0
+    matched_keys = []
+    for k in keys:
+        entries += 1
+        key_hash = hashlib.sha256(k.encode('utf-8')).digest()
+        if key_hash in key_hashes:
+            continue
+        key_hashes.add(key_hash)
+        if (contains is None or contains in k) and len(matched_keys) < limit:
+            matched_keys.append(k)
+    if backend == 'sqlite':
+        sqlite_cache.close()
+    return {"cache_path": str(cache_path.resolve()), "backend": backend, "bytes": cache_path.stat().st_size,
+            "entries": entries, "keys": len(key_hashes), "matched_keys": matched_keys}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="sqlite缓存的离线维护工具")
+    parser.add_argument("action", choices=["import", "compact"],
+                        help="import：把同名的文本缓存导入sqlite缓存；compact：清理无用数据并回收磁盘空间")
+    parser.add_argument("cache_name", help="缓存文件名，即conf.yaml中的cache_file_name")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sqlite_cache = SqliteLLmCache(args.cache_name)
+    if args.action == "import":
+        sqlite_cache.import_text_cache(Path(__file__).parent.parent / 'cache' / args.cache_name)
+    else:
+        sqlite_cache.compact()
+    sqlite_cache.close()
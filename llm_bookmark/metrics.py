@@ -0,0 +1,234 @@
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+# 当前这次运行的统计，do_bookmark/ado_bookmark中设置。asyncio的task和to_thread会自动带上，
+# 线程池中执行时需要用contextvars.copy_context().run，这样批量处理时同时跑的几个pdf各记各的
+_current_metrics = contextvars.ContextVar("run_metrics", default=None)
+
+# 同一个线程里cProfile不能嵌套开启，记录当前线程是否已经有阶段在profile
+_profiling = threading.local()
+
+
+class StageRecord:
+    """
+    stage中yield出来的记录，阶段内可以补充字节数
+    """
+    __slots__ = ("nbytes",)
+
+    def __init__(self, nbytes=0):
+        self.nbytes = nbytes
+
+
+class StageStat:
+    __slots__ = ("count", "seconds", "max_seconds", "nbytes")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.nbytes = 0
+
+    def to_dict(self):
+        return {"count": self.count, "seconds": round(self.seconds, 6), "max_seconds": round(self.max_seconds, 6),
+                "bytes": self.nbytes}
+
+
+class RunMetrics:
+    """
+    一次生成书签的统计：各阶段(render、filter、encode、cache、vl_model、llm_model、save等)的次数、耗时、字节数，
+    以及token数、重试次数、缓存命中等计数，同时按页汇总。多线程下共用，内部加锁。
+    """
+
+    def __init__(self, name, profile_stages: list[str]=None):
+        """
+        :param name: 一般是pdf路径，写在结果中，也是prometheus指标的pdf标签
+        :param profile_stages: 用cProfile包住的阶段名
+        """
+        self.name = str(name)
+        self.profile_stages = set(profile_stages or [])
+        self.lock = threading.Lock()
+        self.stages = defaultdict(StageStat)
+        self.counters = defaultdict(float)
+        self.pages = defaultdict(lambda: defaultdict(float))
+        self.profiles = defaultdict(list)
+        self.start_time = time.time()
+        self.start_perf = time.perf_counter()
+        self.wall_seconds = None
+
+    def record_stage(self, name, seconds, index=None, nbytes=0):
+        with self.lock:
+            stat = self.stages[name]
+            stat.count += 1
+            stat.seconds += seconds
+            stat.max_seconds = max(stat.max_seconds, seconds)
+            stat.nbytes += nbytes
+            if index is not None:
+                self.pages[index][f"{name}_seconds"] += seconds
+                if nbytes:
+                    self.pages[index][f"{name}_bytes"] += nbytes
+
+    def count(self, name, value=1, index=None):
+        with self.lock:
+            self.counters[name] += value
+            if index is not None:
+                self.pages[index][name] += value
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self.start_perf
+
+    def summary(self):
+        with self.lock:
+            counters = dict(self.counters)
+            result = {
+                "name": self.name,
+                "start_time": self.start_time,
+                "wall_seconds": round(self.wall_seconds if self.wall_seconds is not None
+                                      else time.perf_counter() - self.start_perf, 6),
+                "stages": {name: stat.to_dict() for name, stat in self.stages.items()},
+                "counters": counters,
+                "pages": {index: dict(page) for index, page in sorted(self.pages.items())},
+            }
+        # vl_model、llm_model、vl_cascade中的各个模型，以及图片编码缓存(payload)
+        models = [name[:-len("_cache_hits")] for name in counters if name.endswith("_cache_hits")] + \
+                 [name[:-len("_cache_misses")] for name in counters if name.endswith("_cache_misses")]
+        for model in dict.fromkeys(models):
+            lookups = counters.get(f"{model}_cache_hits", 0) + counters.get(f"{model}_cache_misses", 0)
+            if lookups:
+                result[f"{model}_cache_hit_ratio"] = round(counters.get(f"{model}_cache_hits", 0) / lookups, 4)
+        return result
+
+    def to_prometheus(self, summary=None):
+        """
+        prometheus的textfile格式，供node_exporter的textfile collector读取
+        """
+        summary = summary or self.summary()
+        pdf_label = escape_label(self.name)
+        lines = ["# TYPE llm_bookmark_run_seconds gauge",
+                 f'llm_bookmark_run_seconds{{pdf="{pdf_label}"}} {summary["wall_seconds"]}']
+        for metric, field, help_text in (("stage_calls_total", "count", "次数"),
+                                         ("stage_seconds_total", "seconds", "耗时"),
+                                         ("stage_bytes_total", "bytes", "字节数")):
+            lines.append(f"# HELP llm_bookmark_{metric} 各阶段的{help_text}")
+            lines.append(f"# TYPE llm_bookmark_{metric} counter")
+            for stage_name, stat in summary["stages"].items():
+                lines.append(f'llm_bookmark_{metric}{{pdf="{pdf_label}",stage="{escape_label(stage_name)}"}} '
+                             f'{stat[field]}')
+        lines.append("# TYPE llm_bookmark_events_total counter")
+        for counter_name, value in summary["counters"].items():
+            lines.append(f'llm_bookmark_events_total{{pdf="{pdf_label}",name="{escape_label(counter_name)}"}} '
+                         f'{value}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, output_dir, file_stem):
+        """
+        写出{file_stem}.metrics.json和{file_stem}.prom，有profile结果则写出{file_stem}.{阶段}.prof(可用snakeviz查看)。
+        都是先写临时文件再改名，textfile collector不会读到写了一半的文件。
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        summary = self.summary()
+        write_atomic(output_dir / f"{file_stem}.metrics.json", json.dumps(summary, ensure_ascii=False, indent=2))
+        write_atomic(output_dir / f"{file_stem}.prom", self.to_prometheus(summary))
+        with self.lock:
+            profiles = {stage_name: list(stage_profiles) for stage_name, stage_profiles in self.profiles.items()}
+        for stage_name, stage_profiles in profiles.items():
+            stats = pstats.Stats(stage_profiles[0])
+            for profile in stage_profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(str(output_dir / f"{file_stem}.{stage_name}.prof"))
+        LOGGER.info('metrics dumped, output_dir: %s, file_stem: %s, wall_seconds: %s, stages: %s, counters: %s',
+                    output_dir, file_stem, summary["wall_seconds"], summary["stages"], summary["counters"])
+        return summary
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def write_atomic(path, text):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wt', encoding='utf-8', newline='') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def current_metrics() -> RunMetrics:
+    return _current_metrics.get()
+
+
+@contextmanager
+def track_run(metrics: RunMetrics):
+    """
+    在with块内(包括其中的to_thread和task)，stage、count都记到metrics上，metrics为None则什么都不记
+    """
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+        if metrics is not None:
+            metrics.finish()
+
+
+@contextmanager
+def stage(name, index=None):
+    """
+    统计一个阶段的耗时，没有在track_run内则只是执行。
+    :param name: 阶段名，在profile_stages中时用cProfile包住这个阶段
+    :param index: 页索引，不为空时也计入这一页
+    """
+    record = StageRecord()
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield record
+        return
+
+    profile = None
+    if name in metrics.profile_stages and not getattr(_profiling, "active", False):
+        profile = cProfile.Profile()
+        _profiling.active = True
+        profile.enable()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        if profile is not None:
+            profile.disable()
+            _profiling.active = False
+            with metrics.lock:
+                metrics.profiles[name].append(profile)
+        metrics.record_stage(name, seconds, index=index, nbytes=record.nbytes)
+
+
+def count(name, value=1, index=None):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.count(name, value, index=index)
+
+
+def record_usage(model_name, message, index=None, image_tokens=0):
+    """
+    记录模型返回的token用量(langchain的usage_metadata，服务商没返回则没有)，以及估算的图片token数
+    :param model_name: vl_model或llm_model，作为计数名的前缀
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return
+    usage = getattr(message, "usage_metadata", None) or {}
+    metrics.count(f"{model_name}_calls", index=index)
+    metrics.count(f"{model_name}_prompt_tokens", usage.get("input_tokens", 0), index=index)
+    metrics.count(f"{model_name}_completion_tokens", usage.get("output_tokens", 0), index=index)
+    if image_tokens:
+        metrics.count(f"{model_name}_image_tokens", image_tokens, index=index)
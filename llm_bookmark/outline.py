@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+from collections import defaultdict
+from pathlib import Path
+
+from llm_bookmark.title_info import Title
+
+LOGGER = logging.getLogger(__name__)
+
+
+class OutlineNode:
+    """
+    目录树中的一个标题，只有这几个字段，比Title(pydantic)省内存，创建也快得多
+    """
+    __slots__ = ("grade", "title_name", "abstract", "page_number", "parent", "children", "json_text")
+
+    def __init__(self, grade, title_name, abstract, page_number, parent=None):
+        self.grade = grade
+        self.title_name = title_name
+        self.abstract = abstract
+        self.page_number = page_number
+        self.parent = parent
+        self.children = []
+        # 加入时就序列化好，dump时直接拼接
+        self.json_text = json.dumps({"grade": grade, "title_name": title_name, "abstract": abstract,
+                                     "page_number": page_number}, ensure_ascii=False)
+
+    def to_title(self):
+        return Title(grade=self.grade, title_name=self.title_name, abstract=self.abstract,
+                     page_number=self.page_number)
+
+
+class Outline:
+    """
+    按顺序加入的标题，同时维护页码索引和父子关系的目录树。
+    bookmark_steps中代替list[Title]，接口与list一样可以extend、len、切片，切片和to_titles返回Title。
+    标题必须按页码从小到大加入，级别应当已经与目录栈对得上(update_title_stack之后)，跳级时挂到前面最近的更高级标题下。
+    """
+
+    def __init__(self):
+        self.nodes: list[OutlineNode] = []
+        self.roots: list[OutlineNode] = []
+        self.page_index: dict[int, list[OutlineNode]] = defaultdict(list)
+        # 最后加入的标题及其所有祖先，即当前的目录栈，用于确定新标题的父标题
+        self.open_path: list[OutlineNode] = []
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return (node.to_title() for node in self.nodes)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [node.to_title() for node in self.nodes[item]]
+        return self.nodes[item].to_title()
+
+    def add(self, grade, title_name, abstract, page_number):
+        while self.open_path and self.open_path[-1].grade >= grade:
+            self.open_path.pop()
+        parent = self.open_path[-1] if self.open_path else None
+        node = OutlineNode(grade, title_name, abstract, page_number, parent)
+        (parent.children if parent else self.roots).append(node)
+        self.open_path.append(node)
+        self.nodes.append(node)
+        self.page_index[page_number].append(node)
+        return node
+
+    def append(self, title: Title):
+        self.add(title.grade, title.title_name, title.abstract, title.page_number)
+
+    def extend(self, titles):
+        for title in titles:
+            self.append(title)
+
+    def page_nodes(self, page_number):
+        """
+        :return: 这一页的标题，按加入的顺序
+        """
+        return self.page_index.get(page_number, [])
+
+    def to_titles(self):
+        return [node.to_title() for node in self.nodes]
+
+    def to_json(self):
+        """
+        :return: 与json.dump(titles, cls=TitleEncoder)相同的文本，即save_bookmarks(title_json_path=...)读取的格式
+        """
+        return "[" + ", ".join(node.json_text for node in self.nodes) + "]"
+
+    def dump(self, json_path):
+        json_path = Path(json_path)
+        tmp_path = json_path.with_name(json_path.name + '.tmp')
+        with open(tmp_path, 'wt', encoding='utf-8', newline='') as f:
+            f.write(self.to_json())
+        os.replace(tmp_path, json_path)
+
+    @classmethod
+    def from_titles(cls, titles):
+        outline = cls()
+        outline.extend(titles)
+        return outline
+
+    @classmethod
+    def load(cls, json_path):
+        outline = cls()
+        with open(json_path, 'rt', encoding='utf-8', newline='') as f:
+            for title in json.load(f):
+                outline.add(title["grade"], title["title_name"], title["abstract"], title["page_number"])
+        return outline
@@ -0,0 +1,203 @@
+import logging
+
+import cv2
+import fitz
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# 缩略图的宽高比按A4纸
+PAGE_ASPECT = 1.414
+
+
+def iter_thumbnails(indexs: list[int], pdf_path=None, image_paths: list[str]=None, width=600, chunk_size=64):
+    """
+    生成灰度缩略图，统一缩放到同一尺寸，每chunk_size页一块，便于批量计算，整本书的缩略图不会同时在内存中。
+    :param indexs: 页索引
+    :param pdf_path: 不为空则直接从pdf低分辨率渲染，与vl模型用的图片是否已经生成无关
+    :param image_paths: pdf_path为空时，从这些图片读取，与indexs一一对应
+    :param width: 缩略图宽度
+    :return: 逐块返回(页数, 高, 宽)的uint8数组，最后一块可能不足chunk_size页
+    """
+    height = round(width * PAGE_ASPECT)
+    doc = fitz.open(pdf_path) if pdf_path else None
+    try:
+        for start in range(0, len(indexs), chunk_size):
+            chunk_indexs = indexs[start: start + chunk_size]
+            thumbnails = np.empty((len(chunk_indexs), height, width), dtype=np.uint8)
+            for pos, index in enumerate(chunk_indexs):
+                if doc is not None:
+                    page = doc[index]
+                    zoom = width / page.rect.width
+                    pm = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+                    gray = np.frombuffer(pm.samples, dtype=np.uint8).reshape(pm.height, pm.stride)[:, :pm.width]
+                else:
+                    image_path = image_paths[start + pos]
+                    gray = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+                    if gray is None:
+                        raise FileNotFoundError(f'read image failed: {image_path}')
+                thumbnails[pos] = cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA)
+            yield thumbnails
+    finally:
+        if doc is not None:
+            doc.close()
+
+
+def difference_hash(thumbnails: np.ndarray, hash_size=32):
+    """
+    感知哈希(dHash)：缩放到(hash_size+1)*hash_size，比较左右相邻像素的明暗。
+    :return: (页数, hash_size*hash_size/8)的uint8数组，每页hash_size*hash_size位
+    """
+    smalls = np.stack([cv2.resize(thumbnail, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+                       for thumbnail in thumbnails])
+    bits = smalls[:, :, 1:] > smalls[:, :, :-1]
+    return np.packbits(bits.reshape(len(thumbnails), -1), axis=1)
+
+
+def count_text_lines(row_inked: np.ndarray, min_line_height, max_line_height):
+    """
+    :param row_inked: (页数, 高)的bool数组，每行像素是否有墨迹
+    :return: 每页的文字行数，即高度在[min_line_height, max_line_height]之间的连续有墨迹的行
+    """
+    padded = np.pad(row_inked.astype(np.int8), ((0, 0), (1, 1)))
+    edges = np.diff(padded, axis=1)
+    line_counts = np.zeros(len(row_inked), dtype=np.int32)
+    start_pages, start_rows = np.nonzero(edges == 1)
+    _, end_rows = np.nonzero(edges == -1)
+    # 每页的起点和终点一一对应，按页、行的顺序排列
+    run_heights = end_rows - start_rows
+    is_text_line = (run_heights >= min_line_height) & (run_heights <= max_line_height)
+    np.add.at(line_counts, start_pages[is_text_line], 1)
+    return line_counts
+
+
+class PageFilter:
+    """
+    调模型前先过滤掉不可能有标题的页：空白页、没有文字的图片页、与前面某一页重复的页（比如重复的插图）。
+    每块缩略图叠成一个数组，墨迹比例、水平投影、感知哈希都是批量计算的，算完只保留每页的这几个值，
+    跨页的重复判断只用感知哈希(每页hash_size*hash_size/8字节)。
+    """
+
+    def __init__(self, thumbnail_width=600, margin_ratio=0.05, ink_delta=60, blank_ink_ratio=0.002,
+                 image_ink_ratio=0.15, row_ink_ratio=0.01, min_line_height_ratio=0.004, max_line_height_ratio=0.05,
+                 hash_size=32, duplicate_max_distance=0.04, duplicate_min_ink_ratio=0.02, skip_blank=True, skip_image=True, skip_duplicate=True,
+                 chunk_size=64):
+        """
+        :param thumbnail_width: 缩略图宽度，高度按A4纸比例
+        :param margin_ratio: 计算时去掉页面四周的边距比例，扫描件的边缘常有黑边
+        :param ink_delta: 比纸张颜色暗这么多的像素算作墨迹
+        :param blank_ink_ratio: 墨迹比例低于此值且没有文字行的为空白页
+        :param image_ink_ratio: 墨迹比例不低于此值且没有文字行的为图片页
+        :param row_ink_ratio: 一行像素中墨迹比例超过此值，算作有墨迹的行
+        :param min_line_height_ratio: 文字行的最小高度(占页高的比例)
+        :param max_line_height_ratio: 文字行的最大高度(占页高的比例)，更高的连续墨迹是图片
+        :param hash_size: 感知哈希的边长，位数为其平方
+        :param duplicate_max_distance: 与前面某一页感知哈希不同的位数占比不超过此值，为重复页
+        :param duplicate_min_ink_ratio: 墨迹比例不低于此值的页才参与重复判断。字很少的页（比如"第一部分"、"第二部分"）
+            大面积空白，感知哈希几乎一样，不能当成重复页
+        :param chunk_size: 每次计算多少页的缩略图，内存占用约为chunk_size*缩略图大小的几倍
+        """
+        self.thumbnail_width = thumbnail_width
+        self.margin_ratio = margin_ratio
+        self.ink_delta = ink_delta
+        self.blank_ink_ratio = blank_ink_ratio
+        self.image_ink_ratio = image_ink_ratio
+        self.row_ink_ratio = row_ink_ratio
+        self.min_line_height_ratio = min_line_height_ratio
+        self.max_line_height_ratio = max_line_height_ratio
+        self.hash_size = hash_size
+        self.duplicate_max_distance = duplicate_max_distance
+        self.duplicate_min_ink_ratio = duplicate_min_ink_ratio
+        self.skip_blank = skip_blank
+        self.skip_image = skip_image
+        self.skip_duplicate = skip_duplicate
+        self.chunk_size = chunk_size
+
+    def page_features(self, thumbnails: np.ndarray):
+        """
+        :param thumbnails: iter_thumbnails返回的一块
+        :return: 每页的墨迹比例，文字行数，感知哈希(skip_duplicate为false时为None)
+        """
+        page_count, height, width = thumbnails.shape
+        margin_y, margin_x = round(height * self.margin_ratio), round(width * self.margin_ratio)
+        bodies = thumbnails[:, margin_y: height - margin_y, margin_x: width - margin_x]
+
+        # 纸张颜色取较亮的像素，整页都是插图时中位数就不是纸张颜色了
+        backgrounds = np.percentile(bodies.reshape(page_count, -1), 95, axis=1)
+        # 阈值小于0时没有像素比它暗，取0即可，直接与uint8比较，不用再复制一份int16
+        ink_thresholds = np.clip(backgrounds.astype(np.int16) - self.ink_delta, 0, 255).astype(np.uint8)
+        ink = bodies < ink_thresholds[:, None, None]
+        ink_ratios = ink.mean(axis=(1, 2))
+
+        body_height = bodies.shape[1]
+        row_inked = ink.mean(axis=2) > self.row_ink_ratio
+        line_counts = count_text_lines(row_inked, self.min_line_height_ratio * body_height,
+                                       self.max_line_height_ratio * body_height)
+        hashes = difference_hash(bodies, self.hash_size) if self.skip_duplicate else None
+        return ink_ratios, line_counts, hashes
+
+    def classify(self, ink_ratios: np.ndarray, line_counts: np.ndarray, hashes: np.ndarray=None):
+        """
+        :return: 每页的过滤原因，blank、image、duplicate或None(保留)
+        """
+        page_count = len(ink_ratios)
+        reasons = [None] * page_count
+        # 只有一行字的页（比如"第二部分"）墨迹也很少，故空白页和图片页都要求没有文字行
+        no_text = line_counts == 0
+        is_blank = (ink_ratios < self.blank_ink_ratio) & no_text
+        is_image = (ink_ratios >= self.image_ink_ratio) & no_text
+        for pos in range(page_count):
+            if self.skip_blank and is_blank[pos]:
+                reasons[pos] = "blank"
+            elif self.skip_image and is_image[pos]:
+                reasons[pos] = "image"
+
+        if self.skip_duplicate:
+            max_distance = self.duplicate_max_distance * self.hash_size * self.hash_size
+            kept_positions = []
+            for pos in range(page_count):
+                if ink_ratios[pos] < self.duplicate_min_ink_ratio:
+                    continue
+                if kept_positions:
+                    distances = np.unpackbits(hashes[kept_positions] ^ hashes[pos], axis=1).sum(axis=1)
+                    if distances.min() <= max_distance and reasons[pos] is None:
+                        reasons[pos] = "duplicate"
+                        continue
+                kept_positions.append(pos)
+
+        LOGGER.debug('classify return, ink_ratios: %s, line_counts: %s', ink_ratios, line_counts)
+        return reasons
+
+    def analyze(self, thumbnails: np.ndarray):
+        """
+        :param thumbnails: 一块或整本书的缩略图，(页数, 高, 宽)的uint8数组
+        :return: 每页的过滤原因，blank、image、duplicate或None(保留)
+        """
+        return self.classify(*self.page_features(thumbnails))
+
+    def filter_pages(self, indexs: list[int], pdf_path=None, image_paths: list[str]=None):
+        """
+        :return: {页索引: 过滤原因}，只包含需要跳过的页
+        """
+        if not indexs:
+            return {}
+        ink_ratios, line_counts, hashes = [], [], []
+        for thumbnails in iter_thumbnails(indexs, pdf_path=pdf_path, image_paths=image_paths,
+                                          width=self.thumbnail_width, chunk_size=self.chunk_size):
+            chunk_ink_ratios, chunk_line_counts, chunk_hashes = self.page_features(thumbnails)
+            ink_ratios.append(chunk_ink_ratios)
+            line_counts.append(chunk_line_counts)
+            if chunk_hashes is not None:
+                hashes.append(chunk_hashes)
+        reasons = self.classify(np.concatenate(ink_ratios), np.concatenate(line_counts),
+                                np.concatenate(hashes) if hashes else None)
+        skipped = {index: reason for index, reason in zip(indexs, reasons) if reason}
+        for index, reason in skipped.items():
+            LOGGER.info('page filtered, index: %d, reason: %s', index, reason)
+        LOGGER.info('filter_pages return, pages: %d, skipped: %d (blank: %d, image: %d, duplicate: %d), '
+                    'saved %d vl_model calls', len(indexs), len(skipped),
+                    sum(1 for reason in skipped.values() if reason == "blank"),
+                    sum(1 for reason in skipped.values() if reason == "image"),
+                    sum(1 for reason in skipped.values() if reason == "duplicate"), len(skipped))
+        return skipped
+
@@ -0,0 +1,277 @@
+import base64
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock, Event, Thread
+
+import cv2
+import fitz
+import numpy as np
+
+from llm_bookmark.pdf_tools import render_page_by_tokens, fitz_doc_to_pixmap, iter_pdf_2_pics, get_pics_dir, \
+    pdf_2_pics, save_page_image
+from llm_bookmark.vl_tools import resize_by_tokens, encode_image_array, IMAGE_MIME_TYPES
+from llm_bookmark import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PageEncoder:
+    """
+    把页面编码成vl模型的输入，并把结果放在有上限的lru缓存中。
+    目录栈中的页会作为上下文反复发送，预取失败重新请求时也会再编码一次，有了缓存每页只需读取、编码一次。
+    默认png彩色，与原来的编码结果完全一样；jpeg、webp、灰度、二值化可以明显减小请求体积。
+    """
+
+    def __init__(self, image_format="png", quality=85, color_mode="color", cache_size=256):
+        """
+        :param image_format: png，jpeg或webp
+        :param quality: jpeg和webp的压缩质量，1-100
+        :param color_mode: color，gray或binary
+        :param cache_size: 最多缓存多少页的编码结果，0为不缓存
+        """
+        if image_format not in IMAGE_MIME_TYPES:
+            raise ValueError(f"image_format must be one of {list(IMAGE_MIME_TYPES)}, image_format: {image_format}")
+        if color_mode not in ("color", "gray", "binary"):
+            raise ValueError(f"color_mode must be color, gray or binary, color_mode: {color_mode}")
+        self.image_format = image_format
+        self.quality = quality
+        self.color_mode = color_mode
+        self.mime_type = IMAGE_MIME_TYPES[image_format]
+        self.cache_size = cache_size
+        self.payloads = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def is_default(self):
+        return self.image_format == "png" and self.color_mode == "color"
+
+    @property
+    def key_suffix(self):
+        """
+        cache_key_mode为path时加在页的标识后面，区分不同编码参数的结果；默认的png彩色为空，原有的缓存仍能命中
+        """
+        if self.is_default:
+            return ""
+        quality = "" if self.image_format == "png" else f"&quality={self.quality}"
+        return f"?format={self.image_format}{quality}&color={self.color_mode}"
+
+    def cached(self, key, encode_func):
+        """
+        :param key: 页的标识，需包含会影响图片内容的参数，比如图片的修改时间、resize参数
+        :param encode_func: 缓存中没有时调用，返回编码后的图片字节
+        :return: mime类型，base64编码后的图片
+        """
+        key = (key, self.image_format, self.quality, self.color_mode)
+        with self.lock:
+            if key in self.payloads:
+                self.payloads.move_to_end(key)
+                self.hits += 1
+                metrics.count("payload_cache_hits")
+                return self.mime_type, self.payloads[key]
+            self.misses += 1
+        metrics.count("payload_cache_misses")
+
+        payload = base64.b64encode(encode_func()).decode("utf-8")
+        if self.cache_size > 0:
+            with self.lock:
+                self.payloads[key] = payload
+                while len(self.payloads) > self.cache_size:
+                    self.payloads.popitem(last=False)
+        return self.mime_type, payload
+
+    def encode_path(self, image_path):
+        if self.is_default:
+            with open(image_path, "rb") as image_file:
+                return image_file.read()
+        return encode_image_array(cv2.imread(str(image_path)), self.image_format, self.quality, self.color_mode)
+
+    def encode_pixmap(self, pm):
+        if self.is_default:
+            return pm.tobytes("png")
+        image = np.frombuffer(pm.samples, dtype=np.uint8).reshape(pm.height, pm.stride)[:, :pm.width * pm.n]
+        image = image.reshape(pm.height, pm.width, pm.n)
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if pm.n == 3 else image[:, :, 0]
+        return encode_image_array(image, self.image_format, self.quality, self.color_mode)
+
+
+class ImageDirPages:
+    """
+    pdf_2_pics生成的图片文件夹，每页一张png，调模型时按需resize并编码。
+    """
+
+    def __init__(self, image_dir, need_resize=True, max_image_tokens=1280, encoder: PageEncoder=None):
+        self.image_dir = Path(image_dir)
+        self.need_resize = need_resize
+        self.max_image_tokens = max_image_tokens
+        self.encoder = encoder or PageEncoder()
+        self.json_path = self.image_dir.parent / (self.image_dir.stem + ".json")
+
+        image_paths = sorted(self.image_dir.glob('*.png'))
+        if image_paths and all(image_path.stem.isdigit() for image_path in image_paths):
+            # pdf_2_pics生成的图片名就是页索引，跳过的页不会生成图片，故按文件名而不是按顺序确定页索引
+            images_by_index = {int(image_path.stem): image_path.name for image_path in image_paths}
+            self.images = [images_by_index.get(index) for index in range(max(images_by_index) + 1)]
+        else:
+            self.images = [image_path.name for image_path in image_paths]
+
+    def __len__(self):
+        return len(self.images)
+
+    def page_name(self, index):
+        return self.images[index] or f'{index:04d}.png'
+
+    def page_key(self, index):
+        """
+        页的标识，cache_key_mode为path时加上PageEncoder.key_suffix组成缓存key
+        """
+        return str(self.image_dir / self.page_name(index))
+
+    def encode(self, index):
+        """
+        :return: mime类型，base64编码后的图片
+        """
+        image_path = self.page_key(index)
+        key = (image_path, os.stat(image_path).st_mtime_ns, self.need_resize, self.max_image_tokens)
+        return self.encoder.cached(key, lambda: self.encoder.encode_path(self.get_vl_image_path(image_path)))
+
+    def get_vl_image_path(self, image_path):
+        if self.need_resize:
+            return resize_by_tokens(image_path, max_pixels=self.max_image_tokens * 28 * 28)
+        return image_path
+
+    def close(self):
+        """
+        图片文件夹没有需要释放的资源，与PdfPages的接口一致
+        """
+
+
+class StreamingImageDirPages(ImageDirPages):
+    """
+    边渲染边处理：后台线程调iter_pdf_2_pics渲染，某一页要用到时，如果还没渲染完就等着。
+    跳过的页不会渲染。
+    """
+
+    def __init__(self, pdf_path, need_resize=True, max_image_tokens=1280, skip_page_ranges=None,
+                 encoder: PageEncoder=None, **pdf_2_pics_kwargs):
+        with fitz.open(pdf_path) as docs:
+            page_count = docs.page_count
+        super().__init__(get_pics_dir(pdf_path), need_resize=need_resize, max_image_tokens=max_image_tokens,
+                         encoder=encoder)
+        self.images = [f'{index:04d}.png' for index in range(page_count)]
+        self.ready_events = [Event() for _ in range(page_count)]
+        self.error = None
+        self.render_thread = Thread(target=self.render, args=(pdf_path, skip_page_ranges, pdf_2_pics_kwargs),
+                                    daemon=True)
+        self.render_thread.start()
+
+    def render(self, pdf_path, skip_page_ranges, pdf_2_pics_kwargs):
+        try:
+            for index, _ in iter_pdf_2_pics(pdf_path, skip_page_ranges=skip_page_ranges, **pdf_2_pics_kwargs):
+                self.ready_events[index].set()
+        except BaseException as e:
+            LOGGER.error('render failed, pdf_path: %s, error: %s', pdf_path, e)
+            self.error = e
+        finally:
+            # 出错或渲染结束后唤醒所有等待者，没有渲染出来的页由encode报错
+            for ready_event in self.ready_events:
+                ready_event.set()
+
+    def encode(self, index):
+        self.ready_events[index].wait()
+        if self.error is not None and not Path(self.page_key(index)).exists():
+            raise RuntimeError(f'render page failed, index: {index}') from self.error
+        return super().encode(index)
+
+
+class LazyImageDirPages(ImageDirPages):
+    """
+    增量处理时用：先只渲染要调vl_model的页，沿用上一版标题的页(lazy_indexs)先不渲染，
+    只有作为目录栈上下文、或者沿用的标题与目录栈对不上要重新请求时才渲染。
+    新版覆盖旧版时文件夹中的图片可能是旧版的，故要用的页都在本次重新渲染，不用已有的图片。
+    """
+
+    def __init__(self, pdf_path, need_resize=True, max_image_tokens=1280, skip_page_ranges=None,
+                 lazy_indexs=(), encoder: PageEncoder=None, dpi=200, **pdf_2_pics_kwargs):
+        self.lazy_indexs = set(lazy_indexs)
+        render_skip_page_ranges = list(skip_page_ranges or []) + [(index, index) for index in sorted(self.lazy_indexs)]
+        image_dir = pdf_2_pics(pdf_path, dpi=dpi, override=True, skip_page_ranges=render_skip_page_ranges,
+                               **pdf_2_pics_kwargs)
+        super().__init__(image_dir, need_resize=need_resize, max_image_tokens=max_image_tokens, encoder=encoder)
+        self.pdf_path = Path(pdf_path)
+        self.dpi = dpi
+        self.doc = fitz.open(pdf_path)
+        self.images = [f'{index:04d}.png' for index in range(self.doc.page_count)]
+        # fitz的文档对象不是线程安全的，vl_concurrency大于1时会在多个线程中渲染
+        self.lock = Lock()
+        LOGGER.info('LazyImageDirPages created, pages: %d, lazy pages: %d', len(self.images), len(self.lazy_indexs))
+
+    def encode(self, index):
+        if index in self.lazy_indexs:
+            with self.lock:
+                if index in self.lazy_indexs:
+                    save_page_image(self.doc, self.dpi, self.image_dir, index)
+                    self.lazy_indexs.discard(index)
+        return super().encode(index)
+
+    def close(self):
+        with self.lock:
+            self.doc.close()
+
+
+class PdfPages:
+    """
+    直接从pdf渲染出vl模型需要的尺寸，在内存中编码成png，不经过磁盘。
+    debug_dir不为空时，会把渲染结果也写一份到该文件夹，方便排查问题。
+    """
+
+    def __init__(self, pdf_path, need_resize=True, max_image_tokens=1280, dpi=200, debug_dir=None,
+                 encoder: PageEncoder=None):
+        self.pdf_path = Path(pdf_path)
+        self.need_resize = need_resize
+        self.max_image_tokens = max_image_tokens
+        self.dpi = dpi
+        self.encoder = encoder or PageEncoder()
+        self.mtime_ns = os.stat(pdf_path).st_mtime_ns
+        self.debug_dir = Path(debug_dir) if debug_dir else None
+        if self.debug_dir:
+            self.debug_dir.mkdir(parents=True, exist_ok=True)
+        self.doc = fitz.open(pdf_path)
+        # fitz的文档对象不是线程安全的，vl_concurrency大于1时会在多个线程中渲染
+        self.lock = Lock()
+        self.json_path = self.pdf_path.parent / (self.pdf_path.stem + ".json")
+
+    def __len__(self):
+        return self.doc.page_count
+
+    def page_name(self, index):
+        return f'{index:04d}.png'
+
+    def page_key(self, index):
+        return f'{self.pdf_path}#{index:04d}'
+
+    def encode(self, index):
+        key = (self.page_key(index), self.mtime_ns, self.need_resize, self.max_image_tokens, self.dpi)
+        return self.encoder.cached(key, lambda: self.render(index))
+
+    def render(self, index):
+        with self.lock:
+            page = self.doc[index]
+            if self.need_resize:
+                pm = render_page_by_tokens(page, max_image_tokens=self.max_image_tokens, dpi=self.dpi)
+            else:
+                pm = fitz_doc_to_pixmap(page, dpi=self.dpi)
+        image_bytes = self.encoder.encode_pixmap(pm)
+
+        if self.debug_dir:
+            debug_path = self.debug_dir / (Path(self.page_name(index)).stem + "." + self.encoder.image_format)
+            debug_path.write_bytes(image_bytes)
+            LOGGER.info('written %s', debug_path)
+        return image_bytes
+
+    def close(self):
+        with self.lock:
+            self.doc.close()
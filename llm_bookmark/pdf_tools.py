@@ -1,18 +1,18 @@
 import json
 import logging
+import math
+import os
+import shutil
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import fitz
 from PIL import Image
 from pathlib import Path
 
-import sys
-FORMAT = '%(asctime)-s %(name)s %(funcName)s %(lineno)d %(levelname)-8s %(message)s'
-logging.basicConfig(format=FORMAT, stream=sys.stderr, level=logging.INFO)
-
 LOGGER = logging.getLogger(__name__)
 
-def fitz_doc_to_image(doc, dpi=200) -> Image:
+def fitz_doc_to_pixmap(doc, dpi=200) -> fitz.Pixmap:
     mat = fitz.Matrix(dpi / 72, dpi / 72)
     pm = doc.get_pixmap(matrix=mat, alpha=False)
 
@@ -20,67 +20,204 @@ def fitz_doc_to_image(doc, dpi=200) -> Image:
     if pm.width > 4500 or pm.height > 4500:
         pm = doc.get_pixmap(matrix=fitz.Matrix(1, 1), alpha=False)
 
+    return pm
+
+
+def fitz_doc_to_image(doc, dpi=200) -> Image:
+    pm = fitz_doc_to_pixmap(doc, dpi=dpi)
     return Image.frombytes('RGB', (pm.width, pm.height), pm.samples)
 
 
-def doc_2_img(pdf_path, dpi, pics_dir, index):
-    # 此处之所以重新读取pdf，是因为doc无法序列化，故而无法在多进程中传递。
+def calc_size_by_tokens(width, height, min_pixels=28 * 28 * 4, max_pixels=1280 * 28 * 28):
+    """
+    与vl_tools.resize_by_tokens的规则一致：总像素数超出[min_pixels, max_pixels]时，等比缩放且宽高取28的整数倍。
+    :return: 缩放后的(宽, 高)，不需要缩放则返回None
+    """
+    h_bar = round(height / 28) * 28
+    w_bar = round(width / 28) * 28
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        return math.floor(width / beta / 28) * 28, math.floor(height / beta / 28) * 28
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        return math.ceil(width * beta / 28) * 28, math.ceil(height * beta / 28) * 28
+    return None
+
+
+def render_page_by_tokens(doc, max_image_tokens=1280, min_image_tokens=4, dpi=200) -> fitz.Pixmap:
+    """
+    根据vl模型的token上限和页面尺寸直接算出渲染比例，一次渲染出目标尺寸的图片。
+    效果等同于fitz_doc_to_image之后再resize_by_tokens，但省掉了中间的大图以及两次png编解码。
+    """
+    rect = doc.rect
+    size = calc_size_by_tokens(rect.width * dpi / 72, rect.height * dpi / 72,
+                               min_pixels=min_image_tokens * 28 * 28, max_pixels=max_image_tokens * 28 * 28)
+    if size is None:
+        return fitz_doc_to_pixmap(doc, dpi=dpi)
+
+    w_bar, h_bar = size
+    return doc.get_pixmap(matrix=fitz.Matrix(w_bar / rect.width, h_bar / rect.height), alpha=False)
+
+
+# 每个进程里缓存已打开的pdf，同一个进程渲染同一个pdf的多个分块时不用重复打开。
+# 值为(文件修改时间, 文件大小, doc)，同一路径的文件被替换(比如新版覆盖旧版)后会关掉旧的重新打开
+_worker_docs = OrderedDict()
+_WORKER_DOCS_SIZE = 4
+
+
+def get_worker_doc(pdf_path):
+    pdf_path = str(pdf_path)
+    stat = os.stat(pdf_path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if pdf_path in _worker_docs:
+        old_stamp, docs = _worker_docs[pdf_path]
+        if old_stamp == stamp:
+            _worker_docs.move_to_end(pdf_path)
+            return docs
+        LOGGER.info('pdf changed, reopen: %s', pdf_path)
+        del _worker_docs[pdf_path]
+        docs.close()
+
+    # 此处之所以在子进程里打开pdf，是因为doc无法序列化，故而无法在多进程中传递。
     docs = fitz.open(pdf_path)
-    doc = docs[index]
-    img_path = str(pics_dir / f'{index:04d}.png')
-    img = fitz_doc_to_image(doc, dpi=dpi)
-    img.save(img_path)
+    _worker_docs[pdf_path] = (stamp, docs)
+    while len(_worker_docs) > _WORKER_DOCS_SIZE:
+        _, (_, old_docs) = _worker_docs.popitem(last=False)
+        old_docs.close()
+    return docs
+
+
+
+def doc_2_img(pdf_path, dpi, pics_dir, index):
+    docs_2_imgs(pdf_path, dpi, pics_dir, [index])
+
+
+def docs_2_imgs(pdf_path, dpi, pics_dir, indexs):
+    """
+    在同一个pdf句柄上连续渲染多页，先写临时文件再改名，这样其它进程/线程看到的png一定是完整的。
+    :return: [(页索引, 图片路径)]
+    """
+    docs = get_worker_doc(pdf_path)
+    return [(index, save_page_image(docs, dpi, pics_dir, index)) for index in indexs]
+
+
+def save_page_image(docs, dpi, pics_dir, index):
+    """
+    :return: 图片路径
+    """
+    img_path = Path(pics_dir) / f'{index:04d}.png'
+    tmp_img_path = img_path.with_suffix('.tmp')
+    img = fitz_doc_to_image(docs[index], dpi=dpi)
+    img.save(tmp_img_path, format='PNG')
+    os.replace(tmp_img_path, img_path)
     LOGGER.info('written %s', img_path)
+    return str(img_path)
 
 
-def pdf_2_pics(pdf_path,
-               start_page=None,  # 从1开始
-               end_page=None,  # 含end，即前闭后闭
-               dpi=200,
-               max_workers=4,
-               override=False,
-               exist_ok=True
-               ):
-    LOGGER.info('pdf_2_pics enter, pdf_path: %s, start_page: %s, end_page: %s, dpi: %d, max_workers: %d',
-                pdf_path, start_page, end_page, dpi, max_workers)
-    docs = fitz.open(pdf_path)
+def get_pics_dir(pdf_path):
+    pdf_path = Path(pdf_path)
+    return pdf_path.parent / pdf_path.stem
+
+
+def iter_pdf_2_pics(pdf_path,
+                    start_page=None,  # 从1开始
+                    end_page=None,  # 含end，即前闭后闭
+                    dpi=200,
+                    max_workers=4,
+                    override=False,
+                    exist_ok=True,
+                    executor=None,  # 为None则临时创建进程池，批量处理时可传入共用的进程池
+                    skip_page_ranges: list[tuple[int, int]]=None,  # 不需要渲染的页索引范围，从0开始，前闭后闭
+                    chunk_size=8  # 每个任务渲染的连续页数
+                    ):
+    """
+    pdf转图片，每渲染完一个分块就返回其中的(页索引, 图片路径)，不用等整本书都渲染完。
+    图片文件夹已存在且override为false时，已有的图片直接返回，缺的页才渲染。
+    """
+    LOGGER.info('iter_pdf_2_pics enter, pdf_path: %s, start_page: %s, end_page: %s, dpi: %d, max_workers: %d, '
+                'skip_page_ranges: %s', pdf_path, start_page, end_page, dpi, max_workers, skip_page_ranges)
+    with fitz.open(pdf_path) as docs:
+        page_count = docs.page_count
 
     pdf_path = Path(pdf_path)
-    pics_dir = pdf_path.parent / pdf_path.stem
+    pics_dir = get_pics_dir(pdf_path)
 
     if pics_dir.exists():
         if not exist_ok:
             raise ValueError(f"pics_dir exists: {pics_dir}")
-
-        if not override:
-            return str(pics_dir)
     else:
         pics_dir.mkdir(parents=True)
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for index, doc in enumerate(docs):
-            page_index = index + 1
+    render_indexs = []
+    for index in range(page_count):
+        page_index = index + 1
+
+        if start_page and page_index < start_page:
+            continue
+
+        if end_page and page_index > end_page:
+            break
+
+        if skip_page_ranges and any(page_start <= index <= page_end for page_start, page_end in skip_page_ranges):
+            continue
 
-            if start_page and page_index < start_page:
-                continue
+        img_path = pics_dir / f'{index:04d}.png'
+        if not override and img_path.exists():
+            yield index, str(img_path)
+            continue
 
-            if end_page and page_index > end_page:
-                break
+        render_indexs.append(index)
 
-            futures.append(executor.submit(doc_2_img, pdf_path, dpi, pics_dir, index))
+    if not render_indexs:
+        return
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    futures = []
+    try:
+        # 按页序切成连续的分块提交，前面的页先渲染完，后面的流程可以尽早开始
+        futures = [executor.submit(docs_2_imgs, str(pdf_path), dpi, pics_dir, render_indexs[i: i + chunk_size])
+                   for i in range(0, len(render_indexs), chunk_size)]
         for future in as_completed(futures):
-            future.result()
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        if own_executor:
+            executor.shutdown()
+
+
+def pdf_2_pics(pdf_path,
+               start_page=None,  # 从1开始
+               end_page=None,  # 含end，即前闭后闭
+               dpi=200,
+               max_workers=4,
+               override=False,
+               exist_ok=True,
+               executor=None,  # 为None则临时创建进程池，批量处理时可传入共用的进程池
+               skip_page_ranges: list[tuple[int, int]]=None,  # 不需要渲染的页索引范围，从0开始，前闭后闭
+               chunk_size=8  # 每个任务渲染的连续页数
+               ):
+    LOGGER.info('pdf_2_pics enter, pdf_path: %s, start_page: %s, end_page: %s, dpi: %d, max_workers: %d',
+                pdf_path, start_page, end_page, dpi, max_workers)
+    for _ in iter_pdf_2_pics(pdf_path, start_page=start_page, end_page=end_page, dpi=dpi, max_workers=max_workers,
+                             override=override, exist_ok=exist_ok, executor=executor,
+                             skip_page_ranges=skip_page_ranges, chunk_size=chunk_size):
+        pass
 
+    pics_dir = get_pics_dir(pdf_path)
     LOGGER.info('pdf_2_pics return, pics_dir: %s', pics_dir)
     return str(pics_dir)
 
 
-def save_bookmarks(pdf_path, dest_pdf_path, bookmarks=None, title_json_path=None):
-    LOGGER.info('save_bookmarks enter, pdf_path: %s, dest_pdf_path: %s, bookmarks: %s, title_json_path: %s',
-                pdf_path, dest_pdf_path, bookmarks, title_json_path)
-    doc = fitz.open(pdf_path)
-
+def load_fitz_bookmarks(bookmarks=None, title_json_path=None):
+    """
+    :param bookmarks: TitleInfo列表
+    :param title_json_path: bookmarks为空时，从生成的json文件读取
+    :return: fitz的set_toc所需的目录列表
+    """
     if bookmarks:
         bks = [bk.model_dump() for bk in bookmarks]
     elif title_json_path:
@@ -101,17 +238,91 @@ def save_bookmarks(pdf_path, dest_pdf_path, bookmarks=None, title_json_path=None
             "to": fitz.Point(0, 0),
         }
         fitz_bookmarks.append([grade, title_name, page_nubmer, dest_dict])
+    return fitz_bookmarks
+
 
-    split_doc = fitz.open()
-    split_doc.insert_pdf(doc)
-    split_doc.set_toc(fitz_bookmarks)
-    split_doc.save(dest_pdf_path)
+def save_bookmarks(pdf_path, dest_pdf_path, bookmarks=None, title_json_path=None, fast=False, fitz_bookmarks=None):
+    """
+    :param fast: false则新建一个文档，把原文档整个插入进去再保存，整本书在内存中会再生成一份；
+        true则先把原文件按块复制到临时文件，在临时文件上设置目录后增量保存(只在文件末尾追加目录相关的对象)，
+        不能增量保存的(比如加密、损坏修复过的)则在原文档上设置目录后不做垃圾回收直接保存。
+        都是写完再改名为dest_pdf_path，中途失败不会留下写了一半的文件，dest_pdf_path与pdf_path相同也可以
+    :param fitz_bookmarks: load_fitz_bookmarks的返回结果，不为空时忽略bookmarks和title_json_path
+    """
+    LOGGER.info('save_bookmarks enter, pdf_path: %s, dest_pdf_path: %s, bookmarks: %s, title_json_path: %s, fast: %s',
+                pdf_path, dest_pdf_path, bookmarks, title_json_path, fast)
+    if fitz_bookmarks is None:
+        fitz_bookmarks = load_fitz_bookmarks(bookmarks=bookmarks, title_json_path=title_json_path)
 
-    doc.close()
-    LOGGER.info('save_bookmarks return')
+    if not fast:
+        doc = fitz.open(pdf_path)
+        split_doc = fitz.open()
+        split_doc.insert_pdf(doc)
+        split_doc.set_toc(fitz_bookmarks)
+        split_doc.save(dest_pdf_path)
+
+        doc.close()
+        LOGGER.info('save_bookmarks return')
+        return
+
+    dest_pdf_path = Path(dest_pdf_path)
+    tmp_pdf_path = dest_pdf_path.with_name(dest_pdf_path.name + '.tmp')
+    try:
+        shutil.copyfile(pdf_path, tmp_pdf_path)
+        with fitz.open(tmp_pdf_path) as doc:
+            incremental = doc.can_save_incrementally()
+            if incremental:
+                doc.set_toc(fitz_bookmarks)
+                doc.saveIncr()
+        if not incremental:
+            with fitz.open(pdf_path) as doc:
+                doc.set_toc(fitz_bookmarks)
+                doc.save(tmp_pdf_path, garbage=0)
+        os.replace(tmp_pdf_path, dest_pdf_path)
+    finally:
+        if tmp_pdf_path.exists():
+            tmp_pdf_path.unlink()
+    LOGGER.info('save_bookmarks return, incremental: %s', incremental)
+
+
+def apply_bookmarks(pdf_paths: list, dest_pdf_paths: list, title_json_path, max_workers=4, executor=None):
+    """
+    把同一份目录(比如同一本书的不同版本、不同分辨率的扫描件)写入多个pdf，目录只读取、转换一次，
+    每个pdf在进程池中按fast模式保存。
+    :param executor: 为None则临时创建进程池，可传入共用的进程池
+    :return: [(pdf_path, 异常，成功则为None)]，某个pdf失败不影响其它的
+    """
+    LOGGER.info('apply_bookmarks enter, pdfs: %d, title_json_path: %s, max_workers: %d',
+                len(pdf_paths), title_json_path, max_workers)
+    fitz_bookmarks = load_fitz_bookmarks(title_json_path=title_json_path)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    results = []
+    try:
+        futures = {executor.submit(save_bookmarks, str(pdf_path), str(dest_pdf_path), fast=True,
+                                   fitz_bookmarks=fitz_bookmarks): pdf_path
+                   for pdf_path, dest_pdf_path in zip(pdf_paths, dest_pdf_paths)}
+        for future in as_completed(futures):
+            pdf_path = futures[future]
+            try:
+                future.result()
+                results.append((pdf_path, None))
+            except Exception as e:
+                LOGGER.exception('apply bookmarks failed, pdf_path: %s', pdf_path)
+                results.append((pdf_path, e))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    LOGGER.info('apply_bookmarks return, failed: %d', sum(1 for _, e in results if e is not None))
+    return results
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)-s %(name)s %(funcName)s %(lineno)d %(levelname)-8s %(message)s',
+                        level=logging.INFO)
     # save_bookmarks(r'D:\学习\python\Python asyncio 并发编程 (马修·福勒).pdf',
     #                      r'D:\学习\python\Python asyncio 并发编程 (马修·福勒)_bk.pdf',
     #                      r'D:\学习\python\Python asyncio 并发编程 (马修·福勒).json')
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import random
+import time
+from threading import Lock
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    令牌桶，每分钟补充rate_per_minute个令牌，桶容量也为rate_per_minute。
+    采用预约的方式：令牌不够时直接预扣（令牌数可以为负），返回需要等待的秒数，这样先到的请求先拿到令牌。
+    内部用的是线程锁，不依赖具体的事件循环，故同一个实例可以同时给多线程和多个事件循环使用。
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.last_time = time.monotonic()
+        self.lock = Lock()
+
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate_per_second)
+            self.last_time = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate_per_second
+
+
+class RateLimiter:
+    """
+    按模型配置限制每分钟请求数和每分钟token数，0或不配置表示不限制。
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, tokens):
+        wait_seconds = 0
+        if self.request_bucket:
+            wait_seconds = max(wait_seconds, self.request_bucket.reserve(1))
+        if self.token_bucket:
+            wait_seconds = max(wait_seconds, self.token_bucket.reserve(tokens))
+        return wait_seconds
+
+    def acquire(self, tokens):
+        wait_seconds = self.reserve(tokens)
+        if wait_seconds > 0:
+            LOGGER.info('rate limit, sleep %.2fs', wait_seconds)
+            time.sleep(wait_seconds)
+
+    async def aacquire(self, tokens):
+        wait_seconds = self.reserve(tokens)
+        if wait_seconds > 0:
+            LOGGER.info('rate limit, sleep %.2fs', wait_seconds)
+            await asyncio.sleep(wait_seconds)
+
+
+_rate_limiter_pool = {}
+_rate_limiter_pool_lock = Lock()
+
+
+def get_rate_limiter(model_conf) -> RateLimiter:
+    """
+    同一个进程内，openai_api_base和model_name相同的模型共用一个限流器，这样同时处理多本书也不会超出服务商的限制。
+    """
+    key = (model_conf["openai_api_base"], model_conf["model_name"])
+    with _rate_limiter_pool_lock:
+        if key not in _rate_limiter_pool:
+            _rate_limiter_pool[key] = RateLimiter(model_conf.get("requests_per_minute", 0),
+                                                  model_conf.get("tokens_per_minute", 0))
+        return _rate_limiter_pool[key]
+
+
+# 与openai客户端自带的重试一致：408、409、429以及5xx
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+
+
+def is_retryable_error(e: BaseException):
+    """
+    429、5xx、超时以及连接断开(比如服务端关掉了keep-alive连接)需要重试，其它错误直接抛出。
+    """
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+        return True
+
+    import openai
+    if isinstance(e, (openai.RateLimitError, openai.APIConnectionError)):  # APITimeoutError是APIConnectionError的子类
+        return True
+
+    import httpx
+    if isinstance(e, httpx.TransportError):
+        return True
+
+    status_code = getattr(e, "status_code", None)
+    return isinstance(status_code, int) and (status_code in RETRYABLE_STATUS_CODES or status_code >= 500)
+
+
+def get_backoff_seconds(attempt, base_delay=1.0, max_delay=60.0):
+    """
+    指数退避加全抖动，attempt从0开始。
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retry(func, max_retries=3, base_delay=1.0, max_delay=60.0, on_retry=None):
+    """
+    :param on_retry: 每次重试前调用，参数为异常，用于统计重试次数
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_error(e):
+                raise
+            if on_retry:
+                on_retry(e)
+            backoff_seconds = get_backoff_seconds(attempt, base_delay, max_delay)
+            LOGGER.warning('retryable error, attempt: %d, sleep %.2fs, error: %s', attempt, backoff_seconds, e)
+            time.sleep(backoff_seconds)
+
+
+async def acall_with_retry(coro_func, max_retries=3, base_delay=1.0, max_delay=60.0, on_retry=None):
+    for attempt in range(max_retries + 1):
+        try:
+            return await coro_func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_error(e):
+                raise
+            if on_retry:
+                on_retry(e)
+            backoff_seconds = get_backoff_seconds(attempt, base_delay, max_delay)
+            LOGGER.warning('retryable error, attempt: %d, sleep %.2fs, error: %s', attempt, backoff_seconds, e)
+            await asyncio.sleep(backoff_seconds)
@@ -0,0 +1,175 @@
+import logging
+import re
+from collections import Counter
+
+import fitz
+
+LOGGER = logging.getLogger(__name__)
+
+# 以这些字符结尾的一般是正文句子，不是标题
+SENTENCE_END_CHARS = "。；;，,：:、"
+
+
+class TextLine:
+    """
+    文字层中的一行，只保留识别标题需要的信息。
+    """
+    __slots__ = ("text", "size", "bold", "y0", "y1", "in_margin")
+
+    def __init__(self, text, size, bold, y0, y1, in_margin=False):
+        self.text = text
+        self.size = size
+        self.bold = bold
+        self.y0 = y0
+        self.y1 = y1
+        self.in_margin = in_margin
+
+    @property
+    def style(self):
+        return self.size, self.bold
+
+
+class TextLayerHeadingDetector:
+    """
+    根据pdf文字层中的字体大小、是否加粗识别标题，适用于非扫描的pdf。
+    先统计全书各字体样式（字号+加粗）的字数，字数最多的为正文字号，比正文大或者加粗的样式按字号从大到小依次定为1，2，3级标题，
+    最多max_title_grade级。每页给出识别结果和置信度，置信度低的页（比如扫描页、样式不在上述分级中的页）交给vl_model处理。
+    """
+
+    def __init__(self, pdf_path, max_title_grade=3, contents_page_thresh=6, min_page_chars=50, size_ratio=1.15,
+                 max_title_chars=60, min_style_count=2, running_line_ratio=0.3, margin_ratio=0.12):
+        """
+        :param pdf_path:
+        :param max_title_grade: 最多识别几级标题
+        :param contents_page_thresh: 一页中识别出的标题超过此数，可能是目录页，置信度降低
+        :param min_page_chars: 一页文字层的字数少于此数，认为是扫描页或图片页
+        :param size_ratio: 字号至少是正文字号的多少倍才算标题样式，加粗的只需不小于正文字号
+        :param max_title_chars: 超过此字数的行不是标题
+        :param min_style_count: 全书出现次数少于此数的样式不参与分级，比如封面上的大字
+        :param running_line_ratio: 去掉数字后，在超过此比例的页中都出现在页面上下边缘的行认为是页眉页脚
+        :param margin_ratio: 距页面顶部或底部不超过页高的此比例，算作页面上下边缘
+        """
+        self.max_title_grade = max_title_grade
+        self.contents_page_thresh = contents_page_thresh
+        self.min_page_chars = min_page_chars
+        self.size_ratio = size_ratio
+        self.max_title_chars = max_title_chars
+        self.min_style_count = min_style_count
+        self.running_line_ratio = running_line_ratio
+        self.margin_ratio = margin_ratio
+
+        self.page_lines: list[list[TextLine]] = []
+        self.page_chars: list[int] = []
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                lines, chars = self.extract_lines(page, margin_ratio)
+                self.page_lines.append(lines)
+                self.page_chars.append(chars)
+
+        self.body_size = None
+        self.grade_by_style = {}
+        self.title_styles = set()
+        self.running_texts = set()
+        self.analyze()
+        LOGGER.info('TextLayerHeadingDetector init, pdf_path: %s, body_size: %s, grade_by_style: %s',
+                    pdf_path, self.body_size, self.grade_by_style)
+
+    @staticmethod
+    def extract_lines(page, margin_ratio):
+        lines = []
+        margin = page.rect.height * margin_ratio
+        chars = 0
+        for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)["blocks"]:
+            for line in block.get("lines", []):
+                spans = [span for span in line["spans"] if span["text"].strip()]
+                if not spans:
+                    continue
+                text = "".join(span["text"] for span in spans).strip()
+                size = round(max(span["size"] for span in spans) * 2) / 2
+                bold = all(span["flags"] & fitz.TEXT_FONT_BOLD or "bold" in span["font"].lower() for span in spans)
+                y0, y1 = line["bbox"][1], line["bbox"][3]
+                in_margin = y1 <= page.rect.y0 + margin or y0 >= page.rect.y1 - margin
+                lines.append(TextLine(text, size, bold, y0, y1, in_margin))
+                chars += len(text)
+        return lines, chars
+
+    @staticmethod
+    def normalize_running_text(text):
+        return re.sub(r"\d+", "", text).strip().lower()
+
+    def analyze(self):
+        style_chars = Counter()
+        for lines in self.page_lines:
+            for line in lines:
+                style_chars[line.style] += len(line.text)
+        if not style_chars:
+            return
+
+        self.body_size = style_chars.most_common(1)[0][0][0]
+
+        text_pages = Counter()
+        for lines in self.page_lines:
+            text_pages.update(set(self.normalize_running_text(line.text) for line in lines if line.in_margin))
+        page_count = len(self.page_lines)
+        self.running_texts = {text for text, count in text_pages.items()
+                              if page_count >= 5 and count > page_count * self.running_line_ratio}
+
+        style_counts = Counter()
+        for lines in self.page_lines:
+            for line in lines:
+                if self.is_title_like(line):
+                    style_counts[line.style] += 1
+
+        title_styles = [style for style, count in style_counts.items() if count >= self.min_style_count]
+        # 字号大的级别高，字号相同时加粗的级别高
+        title_styles.sort(key=lambda style: (style[0], style[1]), reverse=True)
+        self.grade_by_style = {style: grade for grade, style in enumerate(title_styles[:self.max_title_grade], 1)}
+        self.title_styles = set(title_styles)
+
+    def is_title_like(self, line: TextLine):
+        text = line.text
+        if len(text) > self.max_title_chars or text[-1] in SENTENCE_END_CHARS or text.isdigit():
+            return False
+        if line.in_margin and self.normalize_running_text(text) in self.running_texts:
+            return False
+        if line.size >= self.body_size * self.size_ratio:
+            return True
+        return line.bold and line.size >= self.body_size
+
+    def detect(self, index):
+        """
+        :param index: 页索引，从0开始
+        :return: 标题列表[[标题级别，标题，内容概括]]（内容概括为空），置信度(0-1)
+        """
+        if self.body_size is None or self.page_chars[index] < self.min_page_chars:
+            return [], 0.0
+
+        titles = []
+        pre_line = None
+        unknown_title_like = 0
+        for line in self.page_lines[index]:
+            if not self.is_title_like(line):
+                pre_line = None
+                continue
+
+            grade = self.grade_by_style.get(line.style)
+            if grade is None:
+                # 级别超过max_title_grade的样式直接忽略，全书很少出现的样式则说明没把握
+                if line.style not in self.title_styles:
+                    unknown_title_like += 1
+                pre_line = None
+                continue
+
+            # 同一个标题折成了多行，或者"第X章"与标题分成了两行，样式相同且上下紧挨着，则合并
+            if pre_line is not None and pre_line.style == line.style and titles and \
+                    line.y0 - pre_line.y1 < line.size * 1.5:
+                titles[-1][1] = f"{titles[-1][1]} {line.text}"
+            else:
+                titles.append([grade, line.text, ""])
+            pre_line = line
+
+        if len(titles) > self.contents_page_thresh:
+            return titles, 0.3
+        if unknown_title_like:
+            return titles, 0.5
+        return titles, 1.0 if titles else 0.9
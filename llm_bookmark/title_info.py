@@ -1,8 +1,4 @@
-from langchain_openai.chat_models import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
-
 from pydantic import BaseModel, Field
-from langchain_openai import ChatOpenAI
 
 from json import JSONEncoder
 
@@ -0,0 +1,111 @@
+import ast
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([\]}])")
+THINK_END_TAG = "</think>"
+
+
+def repair_json(res_content: str):
+    """
+    修复模型返回内容中常见的格式问题后再解析：思考过程、code wrapper(```json ```)、json前后多出的说明文字、
+    中文引号、列表或对象末尾多余的逗号、python写法的单引号(按python字面量解析)。
+    :return: 解析后的对象，修不好则抛出ValueError
+    """
+    text = res_content.split(THINK_END_TAG)[-1].strip()
+    candidates = [text]
+    candidates.extend(match.group(1).strip() for match in FENCE_PATTERN.finditer(text))
+    start, end = text.find("{"), text.rfind("}")
+    if 0 <= start < end:
+        candidates.append(text[start: end + 1])
+    candidates.extend([TRAILING_COMMA_PATTERN.sub(r"\1", candidate) for candidate in candidates])
+    candidates.extend([candidate.replace("“", "\"").replace("”", "\"") for candidate in candidates])
+
+    candidates = list(dict.fromkeys(candidates))
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            continue
+    for candidate in candidates:
+        try:
+            res = ast.literal_eval(candidate)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+        if isinstance(res, (dict, list)):
+            return res
+    raise ValueError(f"repair json failed: {res_content[:200]}")
+
+
+def parse_judge_answer(judge_result: str):
+    """
+    宽松地解析"是/不是"，比如"是。"、"答案：不是"
+    :return: True/False，看不出来时为None
+    """
+    text = re.sub(r"[\s\W_]+", "", judge_result.split(THINK_END_TAG)[-1])
+    for prefix in ("答案", "回答", "结论"):
+        text = text.removeprefix(prefix)
+    if text.startswith(("不是", "否")):
+        return False
+    if text.startswith("是"):
+        return True
+    return None
+
+
+class FaultLog:
+    """
+    tolerant模式下一次运行的重试预算，以及重试后仍然失败、被隔离的页。
+    被隔离的页不生成标题，运行结束后写到{pdf文件名}.review.json，供人工检查。
+    """
+
+    def __init__(self, retry_budget=20):
+        """
+        :param retry_budget: 整次运行最多重新请求多少次，0为不限制
+        """
+        self.retry_budget = retry_budget
+        self.retries = 0
+        self.quarantined = []
+
+    def take_retry(self):
+        if self.retry_budget and self.retries >= self.retry_budget:
+            return False
+        self.retries += 1
+        return True
+
+    def quarantine(self, index, page_name, error, res_content=None):
+        LOGGER.warning("quarantine page, index: %d, page_name: %s, error: %s", index, page_name, error)
+        self.quarantined.append({"index": index, "page_number": index + 1, "page_name": page_name,
+                                 "error": error, "res_content": res_content})
+
+    def get_error(self, index):
+        for page in reversed(self.quarantined):
+            if page["index"] == index:
+                return page["error"]
+        return None
+
+    def dump(self, review_path):
+        """
+        没有被隔离的页时删除上次留下的文件
+        """
+        review_path = Path(review_path)
+        if not self.quarantined:
+            if review_path.exists():
+                review_path.unlink()
+            return
+        tmp_path = review_path.with_name(review_path.name + '.tmp')
+        with open(tmp_path, 'wt', encoding='utf-8', newline='') as f:
+            json.dump({"retries": self.retries, "pages": sorted(self.quarantined, key=lambda page: page["index"])},
+                      f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, review_path)
+        LOGGER.warning("quarantined pages: %d, review_path: %s", len(self.quarantined), review_path)
+
+
+def get_review_path(json_path):
+    json_path = Path(json_path)
+    return json_path.with_name(json_path.stem + ".review.json")
@@ -77,3 +77,40 @@ def encode_image(image_path, need_resize=True, max_image_tokens=1280):
 
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode("utf-8")
+
+
+IMAGE_MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def convert_color(image, color_mode="color"):
+    """
+    :param image: BGR或灰度图
+    :param color_mode: color：不变；gray：灰度；binary：大津法二值化，扫描的文字页二值化后png会小很多
+    """
+    if color_mode == "color":
+        return image
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    if color_mode == "gray":
+        return gray
+    return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+
+def encode_image_array(image, image_format="png", quality=85, color_mode="color"):
+    """
+    :param image: BGR或灰度图
+    :param image_format: png，jpeg或webp
+    :param quality: jpeg和webp的压缩质量，1-100
+    :return: 编码后的图片字节
+    """
+    image = convert_color(image, color_mode)
+    if image_format == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif image_format == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        params = []
+    ok, buf = cv2.imencode(f".{image_format}", image, params)
+    if not ok:
+        raise ValueError(f'encode image failed, image_format: {image_format}')
+    return buf.tobytes()
+
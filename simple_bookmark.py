@@ -3,8 +3,6 @@ import logging.config
 import os, sys
 import argparse
 
-from llm_bookmark.bookmark import LLMBookmark
-
 
 FORMAT = '%(asctime)-s %(name)s %(funcName)s %(lineno)d %(levelname)-8s %(message)s'
 logging.basicConfig(format=FORMAT, stream=sys.stderr, level=logging.INFO)
@@ -55,6 +53,10 @@ def parse_args():
                         help="需要跳过的页号范围，从0开始算。必须是成对的，比如:0 2 表示跳过0-2页，0 2 7 8 表示跳过0-2，7-8，每一对都是前闭后闭的")
     parser.add_argument("--extra-prompt-path", type=str, default=None,
                         help="额外提示词文本路径，请输入全路径，比如d:/xxx/xxx.txt，注意：该文件的编码字符集必须用utf-8")
+    parser.add_argument("--base-pdf-path", type=str, default=None,
+                        help="conf.yaml中incremental为true时，上一版pdf的路径，内容没变的页沿用上一版的标题")
+    parser.add_argument("--resume", action="store_true",
+                        help="从上次中断的地方继续，已处理的页直接读取pdf所在目录下的{pdf文件名}.journal.jsonl，不再重新处理")
     args = parser.parse_args()
     return args
 
@@ -71,5 +73,8 @@ def parse_skip_page_ranges(args):
 
 if __name__ == '__main__':
     args = parse_args()
+    # 导入时才加载langchain等较重的依赖，bookmark_cli.py等只借用这里日志配置的脚本不受影响
+    from llm_bookmark.bookmark import LLMBookmark
     llm_bookmarkor = LLMBookmark(extra_prompt_path=args.extra_prompt_path)
-    llm_bookmarkor.do_bookmark(args.pdf_path, args.dest_pdf_path, skip_page_ranges=parse_skip_page_ranges(args))
+    llm_bookmarkor.do_bookmark(args.pdf_path, args.dest_pdf_path, skip_page_ranges=parse_skip_page_ranges(args),
+                               resume=args.resume, base_pdf_path=args.base_pdf_path)
@@ -0,0 +1,111 @@
+import json
+
+from llm_bookmark.journal import PageJournal, load_journal, load_journal_records, fingerprint, get_journal_path
+
+FINGERPRINTS = {"source": fingerprint([1024, "hash0"]), "config": fingerprint({"extra_prompt": ""})}
+
+
+def write_journal(journal_path, page_count=5, pages=3, **kwargs):
+    journal = PageJournal(journal_path, page_count, **kwargs)
+    for index in range(pages):
+        journal.append(index, f'{{"最终答案": [[1, "第{index}章", ""]]}}', [[1, f"第{index}章", ""]])
+    journal.close()
+    return journal
+
+
+def read_lines(journal_path):
+    with open(journal_path, 'rt', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def test_resume_replays_records(tmp_path):
+    journal_path = get_journal_path(tmp_path / "book.json")
+    write_journal(journal_path, fingerprints=FINGERPRINTS)
+
+    journal = PageJournal(journal_path, 5, resume=True, fingerprints=FINGERPRINTS)
+    journal.close()
+    assert [record["index"] for record in journal.records] == [0, 1, 2]
+    assert journal.records[1]["titles"] == [[1, "第1章", ""]]
+
+
+def test_resume_after_truncated_last_line(tmp_path):
+    journal_path = tmp_path / "book.journal.jsonl"
+    write_journal(journal_path, fingerprints=FINGERPRINTS)
+    # 模拟写最后一行时进程被杀，断在"第2章"的"章"字中间
+    data = journal_path.read_bytes()
+    journal_path.write_bytes(data[:-10])
+
+    journal = PageJournal(journal_path, 5, resume=True, fingerprints=FINGERPRINTS)
+    assert [record["index"] for record in journal.records] == [0, 1]
+    # 写了一半的行被去掉，之后追加的记录能正常读出
+    journal.append(2, None, [[1, "第2章", ""]])
+    journal.close()
+    _, records = load_journal(journal_path)
+    assert [record["index"] for record in records] == [0, 1, 2]
+    assert records[-1]["res_content"] is None
+    assert len(read_lines(journal_path)) == 4
+
+
+def test_page_count_mismatch(tmp_path):
+    journal_path = tmp_path / "book.journal.jsonl"
+    write_journal(journal_path, fingerprints=FINGERPRINTS)
+    assert load_journal_records(journal_path, 6, fingerprints=FINGERPRINTS) == []
+
+    journal = PageJournal(journal_path, 6, resume=True, fingerprints=FINGERPRINTS)
+    journal.close()
+    assert journal.records == []
+    header, records = load_journal(journal_path)
+    assert header["page_count"] == 6
+    assert records == []
+
+
+def test_page_hashes_mismatch(tmp_path):
+    journal_path = tmp_path / "book.journal.jsonl"
+    write_journal(journal_path, page_count=2, pages=2, page_hashes=["a", "b"])
+    assert load_journal_records(journal_path, 2, page_hashes=["a", "c"]) == []
+    assert len(load_journal_records(journal_path, 2, page_hashes=["a", "b"])) == 2
+
+
+def test_fingerprint_mismatch(tmp_path):
+    journal_path = tmp_path / "book.journal.jsonl"
+    write_journal(journal_path, fingerprints=FINGERPRINTS)
+
+    assert len(load_journal_records(journal_path, 5, fingerprints=FINGERPRINTS)) == 3
+    other_source = dict(FINGERPRINTS, source=fingerprint([1024, "hash1"]))
+    assert load_journal_records(journal_path, 5, fingerprints=other_source) == []
+    other_config = dict(FINGERPRINTS, config=fingerprint({"extra_prompt": "只要一级标题"}))
+    assert load_journal_records(journal_path, 5, fingerprints=other_config) == []
+
+
+def test_no_fingerprint_in_old_journal(tmp_path):
+    journal_path = tmp_path / "book.journal.jsonl"
+    write_journal(journal_path)
+    assert len(load_journal_records(journal_path, 5)) == 3
+    assert load_journal_records(journal_path, 5, fingerprints=FINGERPRINTS) == []
+
+
+def test_header_rewritten_without_resume(tmp_path):
+    journal_path = tmp_path / "book.journal.jsonl"
+    write_journal(journal_path, fingerprints=FINGERPRINTS)
+
+    other_fingerprints = dict(FINGERPRINTS, config=fingerprint({"extra_prompt": "只要一级标题"}))
+    journal = PageJournal(journal_path, 5, page_hashes=list("abcde"), fingerprints=other_fingerprints)
+    journal.close()
+    assert journal.records == []
+    lines = read_lines(journal_path)
+    assert len(lines) == 1
+    assert json.loads(lines[0]) == {"version": 1, "page_count": 5, "page_hashes": list("abcde"),
+                                    "fingerprints": other_fingerprints}
+    assert not journal_path.with_name(journal_path.name + '.tmp').exists()
+
+
+def test_version_mismatch(tmp_path):
+    journal_path = tmp_path / "book.journal.jsonl"
+    journal_path.write_text(json.dumps({"version": 0, "page_count": 5}) + '\n' +
+                            json.dumps({"index": 0, "res_content": None, "titles": []}) + '\n', encoding='utf-8')
+    assert load_journal(journal_path) == (None, [])
+    assert load_journal_records(journal_path, 5) == []
+
+
+def test_missing_journal(tmp_path):
+    assert load_journal(tmp_path / "none.journal.jsonl") == (None, [])
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from llm_bookmark.bookmark import split_batch_response
+from llm_bookmark.tolerance import repair_json
+
+# batch_steps中捕获这些异常后回退到逐页请求
+BATCH_ERRORS = (ValueError, KeyError, TypeError, SyntaxError)
+
+
+def batch_response(answer, key_thoughts="第1页是章标题，第3页是节标题"):
+    return json.dumps({"关键思考": key_thoughts, "最终答案": answer}, ensure_ascii=False)
+
+
+def test_split_multi_page_answer():
+    res_content = batch_response([[1, 1, "第一章 绪论", "介绍背景"],
+                                  [3, 2, "1.1 研究现状", "综述"],
+                                  [3, 2, "1.2 本文工作", "贡献"]])
+    page_res_contents = split_batch_response(res_content, 3)
+
+    assert len(page_res_contents) == 3
+    pages = [json.loads(page_res_content) for page_res_content in page_res_contents]
+    assert pages[0]["最终答案"] == [[1, "第一章 绪论", "介绍背景"]]
+    assert pages[1]["最终答案"] == []
+    assert pages[2]["最终答案"] == [[2, "1.1 研究现状", "综述"], [2, "1.2 本文工作", "贡献"]]
+    assert all(page["关键思考"] == "第1页是章标题，第3页是节标题" for page in pages)
+
+
+def test_split_with_repair():
+    res_content = '```json\n{"关键思考": "", "最终答案": [[2, 1, "第二章", "",],],}\n```'
+    page_res_contents = split_batch_response(res_content, 2, repair=repair_json)
+    assert [json.loads(page_res_content)["最终答案"] for page_res_content in page_res_contents] == \
+           [[], [[1, "第二章", ""]]]
+
+
+@pytest.mark.parametrize("page_no", [0, 3, -1])
+def test_page_no_out_of_range(page_no):
+    res_content = batch_response([[1, 1, "第一章", ""], [page_no, 2, "1.1 节", ""]])
+    with pytest.raises(BATCH_ERRORS):
+        split_batch_response(res_content, 2)
+
+
+@pytest.mark.parametrize("answer", [None, 3, "第一章", "", {"1": [1, "第一章", ""]}])
+def test_answer_not_list(answer):
+    with pytest.raises(BATCH_ERRORS):
+        split_batch_response(batch_response(answer), 2)
+
+
+@pytest.mark.parametrize("res_title", [
+    [1, "第一章", ""],  # 少了页序号
+    ["1", 1, "第一章", ""],  # 页序号不是整数
+    [1, 1, "第一章", None],  # 内容概括不是字符串
+    [1, 1, "第一章", "", "多余"],
+    "第一章",
+])
+def test_malformed_entry(res_title):
+    with pytest.raises(BATCH_ERRORS):
+        split_batch_response(batch_response([res_title]), 2)
+
+
+@pytest.mark.parametrize("res_content", ['{"关键思考": ""}', 'not json', '{"最终答案": [[1, 1, "第一章", ""]'])
+def test_malformed_response(res_content):
+    with pytest.raises(BATCH_ERRORS):
+        split_batch_response(res_content, 2)
@@ -0,0 +1,65 @@
+import pytest
+
+from llm_bookmark.tolerance import repair_json, parse_judge_answer
+
+ANSWER = {"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研究背景"]]}
+
+
+@pytest.mark.parametrize("res_content", [
+    # 末尾多余的逗号
+    '{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研究背景"],],}',
+    '{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研究背景",]\n,\n]}',
+    # code wrapper
+    '```json\n{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研究背景"]]}\n```',
+    '```\n{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研究背景"]]}\n```',
+    '结果如下：\n```JSON\n{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研究背景"],]}\n```\n以上。',
+    # json前后多出的说明文字、思考过程
+    '好的，{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研究背景"]]} 希望对你有帮助',
+    '<think>先看页面顶部{的大字}</think>\n{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研究背景"]]}',
+    # 中文引号
+    '{“关键思考”: “本页有一个章标题”, “最终答案”: [[1, “第一章 绪论”, “介绍研究背景”]]}',
+    # 单引号
+    "{'关键思考': '本页有一个章标题', '最终答案': [[1, '第一章 绪论', '介绍研究背景']]}",
+    "```json\n{'关键思考': '本页有一个章标题', '最终答案': [[1, '第一章 绪论', '介绍研究背景'],],}\n```",
+])
+def test_repair_json(res_content):
+    assert repair_json(res_content) == ANSWER
+
+
+def test_repair_json_keeps_valid_json():
+    assert repair_json('{"最终答案": [[2, "1.1 it\'s \\"ok\\"", ""]]}') == {"最终答案": [[2, "1.1 it's \"ok\"", ""]]}
+
+
+@pytest.mark.parametrize("res_content", [
+    # 输出被截断
+    '{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论", "介绍研',
+    '```json\n{"关键思考": "本页有一个章标题", "最终答案": [[1, "第一章 绪论"',
+    "{'关键思考': '本页有一个章标题', '最终答案': [[1, '第一章",
+    '',
+    '本页没有标题',
+    # python字面量也只接受对象和列表
+    "'本页没有标题'",
+])
+def test_repair_json_failed(res_content):
+    with pytest.raises(ValueError):
+        repair_json(res_content)
+
+
+@pytest.mark.parametrize("judge_result, expected", [
+    ("是", True),
+    ("是。", True),
+    ("是的，这是目录页", True),
+    ("答案：是", True),
+    ("**结论**：是", True),
+    ("<think>页面上有很多标题和页码</think>\n是", True),
+    ("不是", False),
+    ("不是。", False),
+    ("否", False),
+    ("回答: 不是目录页", False),
+    ("<think>是不是目录页呢</think>不是", False),
+    ("", None),
+    ("无法判断", None),
+    ("这一页是目录页", None),
+])
+def test_parse_judge_answer(judge_result, expected):
+    assert parse_judge_answer(judge_result) is expected